@@ -0,0 +1,183 @@
+import base64
+import json
+import os
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+from sqlalchemy import text
+
+import db
+import replicas
+import versions
+from search import COMMENT_RESULT_LIMIT, comment_index, search_comments
+
+# JSON versions of the list pages. Pages are keyset paginated: the cursor is
+# the sort key of the last row sent, so every page is an index range scan no
+# matter how deep the client has paged, and rows are streamed out as they are
+# read instead of being built into one response in memory.
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+API_FETCH_SIZE = 100
+
+api = Blueprint('api', __name__)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400, 'invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        abort(400, 'invalid cursor')
+    return values
+
+
+def page_size():
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    return min(max(limit, 1), API_MAX_PAGE_SIZE)
+
+
+def stream_page(query, params, limit, row_to_dict, cursor_of):
+    # One row past the page is read to know whether there is a next page;
+    # the cursor goes at the end of the document since it is only known once
+    # the last row has been sent.
+    def generate():
+        with replicas.read_engine().connect() as conn:
+            rows = conn.execution_options(stream_results=True, yield_per=API_FETCH_SIZE).execute(
+                query, dict(params, limit=limit + 1))
+            yield '{"data": ['
+            last = None
+            next_cursor = None
+            for count, row in enumerate(rows):
+                if count == limit:
+                    next_cursor = encode_cursor(cursor_of(last))
+                    break
+                yield (',' if count else '') + json.dumps(row_to_dict(row))
+                last = row
+            rows.close()
+        yield '], "next": {}}}'.format(json.dumps(next_cursor))
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+COURSES_QUERY = '''
+    SELECT s.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName,
+        s.CommentCount, s.RatingCount, s.AverageRating
+    FROM CourseStats s
+    JOIN Courses c ON c.CourseID = s.CourseID
+    JOIN Professors p ON c.ProfessorID = p.ProfessorID
+    {where}
+    ORDER BY s.CommentCount DESC, s.AverageRating DESC, s.CourseID DESC
+    LIMIT :limit
+'''
+
+
+@api.route('/courses')
+def courses():
+    limit = page_size()
+    after = request.args.get('after')
+    where = ''
+    params = {}
+    if after:
+        comment_count, average, course_id = decode_cursor(after, 3)
+        params = {'comment_count': comment_count, 'average': average, 'course_id': course_id}
+        # AverageRating is NULL until a course is rated and NULLs sort last
+        if average is None:
+            where = '''WHERE s.CommentCount < :comment_count OR (s.CommentCount = :comment_count
+                AND s.AverageRating IS NULL AND s.CourseID < :course_id)'''
+        else:
+            where = '''WHERE s.CommentCount < :comment_count OR (s.CommentCount = :comment_count AND (
+                s.AverageRating < :average OR s.AverageRating IS NULL
+                OR (s.AverageRating = :average AND s.CourseID < :course_id)))'''
+
+    return versions.conditional([versions.LEADERBOARDS], lambda: stream_page(
+        text(COURSES_QUERY.format(where=where)), params, limit,
+        lambda row: {'CourseID': row.CourseID, 'CourseNumber': row.CourseNumber, 'Title': row.Title,
+                     'ProfessorID': row.ProfessorID, 'ProfessorName': row.ProfessorName,
+                     'NumberOfComments': row.CommentCount, 'NumberOfRatings': row.RatingCount,
+                     'AverageRating': row.AverageRating},
+        lambda row: [row.CommentCount, row.AverageRating, row.CourseID]))
+
+
+PROFESSORS_QUERY = '''
+    SELECT s.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName, p.Department,
+        s.AverageRating
+    FROM CourseStats s
+    JOIN Courses c ON c.CourseID = s.CourseID
+    JOIN Professors p ON c.ProfessorID = p.ProfessorID
+    WHERE s.RatingCount > 0 {where}
+    ORDER BY s.AverageRating DESC, s.CourseID DESC
+    LIMIT :limit
+'''
+
+
+@api.route('/professors')
+def professors():
+    limit = page_size()
+    after = request.args.get('after')
+    where = ''
+    params = {}
+    if after:
+        average, course_id = decode_cursor(after, 2)
+        params = {'average': average, 'course_id': course_id}
+        where = '''AND (s.AverageRating < :average
+            OR (s.AverageRating = :average AND s.CourseID < :course_id))'''
+
+    return versions.conditional([versions.LEADERBOARDS], lambda: stream_page(
+        text(PROFESSORS_QUERY.format(where=where)), params, limit,
+        lambda row: {'CourseID': row.CourseID, 'CourseNumber': row.CourseNumber, 'Title': row.Title,
+                     'ProfessorID': row.ProfessorID, 'ProfessorName': row.ProfessorName,
+                     'Department': row.Department, 'AverageRating': row.AverageRating},
+        lambda row: [row.AverageRating, row.CourseID]))
+
+
+COMMENTS_QUERY = '''
+    SELECT com.CommentID, com.CourseID, c.CourseNumber, com.Content
+    FROM Comments com
+    JOIN Courses c ON c.CourseID = com.CourseID
+    WHERE c.ProfessorID = :prof_id {where}
+    ORDER BY com.CommentID DESC
+    LIMIT :limit
+'''
+
+
+@api.route('/professors/<int:prof_id>/comments')
+def professor_comments(prof_id):
+    limit = page_size()
+    after = request.args.get('after')
+    where = ''
+    params = {'prof_id': prof_id}
+    if after:
+        comment_id, = decode_cursor(after, 1)
+        params['comment_id'] = comment_id
+        where = 'AND com.CommentID < :comment_id'
+
+    return versions.conditional([versions.professor_scope(prof_id)], lambda: stream_page(
+        text(COMMENTS_QUERY.format(where=where)), params, limit,
+        lambda row: {'CommentID': row.CommentID, 'CourseID': row.CourseID, 'CourseNumber': row.CourseNumber,
+                     'Content': row.Content},
+        lambda row: [row.CommentID]))
+
+
+@api.route('/comments/search')
+def comment_search():
+    # ranked, so a single page: limit is how many of the best matches
+    query = request.args.get('q', '').strip()
+    if not query:
+        abort(400, 'missing q')
+    limit = min(max(request.args.get('limit', COMMENT_RESULT_LIMIT, type=int), 1), API_MAX_PAGE_SIZE)
+    comment_index.maintain(db.get_engine())
+    hits = search_comments(replicas.read_engine(), query, limit)
+    return jsonify({'data': [{'CommentID': hit['CommentID'], 'CourseID': hit['CourseID'],
+                              'CourseNumber': hit['CourseNumber'], 'Title': hit['Title'],
+                              'ProfessorID': hit['ProfessorID'], 'ProfessorName': hit['ProfessorName'],
+                              'Content': hit['Content'], 'Score': hit['Score'], 'Snippet': str(hit['Snippet'])}
+                             for hit in hits]})
+
+
+@api.errorhandler(400)
+def bad_request(e):
+    return jsonify({'error': e.description}), 400
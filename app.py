@@ -1,64 +1,83 @@
 from flask import Flask, jsonify, render_template, request, redirect, url_for
+import click
 import os
-from google.cloud.sql.connector import Connector
-import sqlalchemy
+import time
 from sqlalchemy import text
 import jinja2
+from markupsafe import Markup
+
+import identity
+import importer
+import metrics
+import ratelimit
+import replicas
+import schema
+import stats
+import versions
+import writebehind
+from api import api
+from catalog import catalog
+from cache import (LEADERBOARD_INSIGHTFUL, LEADERBOARD_POPULAR, LEADERBOARD_PROFESSORS, get_cache,
+                   invalidate_leaderboards, invalidate_professor, professor_key)
+from db import get_engine
+from health import health, readiness
+from search import comment_index, search_comments, search_index, sql_search
 
 app = Flask(__name__)
+metrics.init_app(app)
+identity.init_app(app)
+ratelimit.init_app(app)
+app.register_blueprint(health)
+app.register_blueprint(api, url_prefix='/api/v1')
+# unversioned alias for the current API version
+app.register_blueprint(api, url_prefix='/api', name='api_latest')
 
 credential_path = "./CRED.json"
 root_path = os.getcwd()
 credential_path = os.path.join(root_path, "CRED.json")
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credential_path
-DB_USER = "chef"
-DB_PASS = "food"
-DB_NAME = "omniscient"
-INSTANCE_CONNECTION_NAME = "cs-411-nullpointers:us-central1:testbed"
-
- 
-def create_connection_pool():
-    connector = Connector()
-
-    def getconn():
-        conn = connector.connect(
-            INSTANCE_CONNECTION_NAME,
-            "pymysql",
-            user=DB_USER,
-            password=DB_PASS,
-            db=DB_NAME
-        )
-        return conn
-
-    pool = sqlalchemy.create_engine(
-        "mysql+pymysql://",
-        creator=getconn,
-    )
-    return pool
+
+REVIEWS_PER_PAGE = int(os.environ.get('REVIEWS_PER_PAGE', 20))
+
+
+@app.template_global()
+def fragment(scope, *parts, caller):
+    # {% call fragment(version_scope, ...) %} caches the rendered block under
+    # the scope's data version, so a write retires it without an invalidation
+    key = versions.fragment_key(scope, *parts)
+    if key is None:
+        return caller()
+    html = get_cache().get(key)
+    if html is None:
+        html = caller()
+        get_cache().set(key, html)
+    return Markup(html)
+
+def current_catalog():
+    # professor and course metadata from memory; see catalog.py. When a
+    # refresh is due it reads this request's engine, which may be a replica.
+    return catalog.current(replicas.read_engine())
+
+
+def catalog_changed():
+    # this process sees its own writes at once, other workers within
+    # CATALOG_REFRESH seconds
+    try:
+        catalog.refresh(get_engine())
+        catalog.prune(get_engine())
+    except Exception as e:
+        print("Error:", e)
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    pool = create_connection_pool()
-    professors = []
-
     if request.method == 'POST':
         department = request.form.get('department')
         course_number = request.form.get('course_number')
         professor_name = request.form.get('professor')
-        
-        query = "SELECT * FROM Professors WHERE 1=1"
-        
-        if department:
-            query += " AND department = %s"
-        if course_number:
-            query += " AND course_number = %s"
-        if professor_name:
-            query += " AND professor_name = %s"
-        with pool.connect() as db_conn:
-            result = db_conn.execute(text(query))
-            professors = result.fetchall()
-        
-        return redirect(url_for('index.html'), professors=professors)
+        professors = current_catalog().find(department, course_number, professor_name)
+        professor_data = [(professor.ProfessorID, professor.Name) for professor in professors]
+        return render_template('professor_ids.html', professor_data=professor_data)
     
     return render_template('index.html')
 
@@ -71,157 +90,258 @@ def add_professor():
         bio = request.form['bio']
         courses = [course.strip() for course in request.form['courses'].split(',')]
         print(name, department, courses)
-        with create_connection_pool().connect() as db_conn:
-            try:
-                    db_conn.execute(text("START TRANSACTION"))
-                    insert_professor_query = text('''
-                        INSERT INTO Professors (Name, Department, RMP_Link)
-                        VALUES (:name, :department, :rmp_link)
+        try:
+            with get_engine().begin() as db_conn:
+                insert_professor_query = text('''
+                    INSERT INTO Professors (Name, Department, RMP_Link)
+                    VALUES (:name, :department, :rmp_link)
+                ''')
+                result = db_conn.execute(insert_professor_query, {'name': name, 'department': department, 'rmp_link': 'none'})
+                professor_id = result.lastrowid
+                for course in courses:
+                    course_number, title = course.split(':')
+                    insert_course_query = text('''
+                        INSERT INTO Courses (CourseNumber, ProfessorID, Title)
+                        VALUES (:course_number, :professor_id, :title)
                     ''')
-                    result = db_conn.execute(insert_professor_query, {'name': name, 'department': department, 'rmp_link': 'none'})
-                    professor_id = result.lastrowid
-                    for course in courses:
-                        course_number, title = course.split(':')
-                        insert_course_query = text('''
-                            INSERT INTO Courses (CourseNumber, ProfessorID, Title)
-                            VALUES (:course_number, :professor_id, :title)
-                        ''')
-                        db_conn.execute(insert_course_query, {'course_number': course_number, 'professor_id': professor_id, 'title': title})
-                    db_conn.execute(text("COMMIT"))
-                    return redirect(url_for('add_professor'))
-            except Exception as e:
-                db_conn.execute(text("ROLLBACK"))
-                print("Error:", e)
-                return render_template('error.html', message="An error occurred while adding professor.")
+                    db_conn.execute(insert_course_query, {'course_number': course_number, 'professor_id': professor_id, 'title': title})
+            search_index.add_professor(professor_id, name, [course.split(':')[0] for course in courses])
+            catalog_changed()
+            # new courses show up on the popularity board with no comments yet
+            invalidate_leaderboards(LEADERBOARD_POPULAR)
+            versions.bump(versions.LEADERBOARDS)
+            replicas.wrote()
+            return redirect(url_for('add_professor'))
+        except Exception as e:
+            print("Error:", e)
+            return render_template('error.html', message="An error occurred while adding professor.")
     return render_template('add_professor.html')
 
 
 
+POPULAR_COURSES_QUERY = text('''
+    SELECT c.CourseID, c.Title, p.Name AS ProfessorName,
+        s.CommentCount AS NumberOfComments,
+        COALESCE(s.AverageRating, 0) AS AverageRating
+    FROM CourseStats s
+    JOIN Courses c ON c.CourseID = s.CourseID
+    JOIN Professors p ON c.ProfessorID = p.ProfessorID
+    ORDER BY s.CommentCount DESC, s.AverageRating DESC;
+''')
+
+
+def query_popular_courses(db_conn):
+    return db_conn.execute(POPULAR_COURSES_QUERY).fetchall()
+
+
+def load_popular_courses():
+    with replicas.read_engine().connect() as db_conn:
+        return query_popular_courses(db_conn)
+
+
 @app.route('/get_courses')
 def get_courses():
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        result = db_conn.execute(text('''
-            SELECT c.CourseID, c.Title, p.Name AS ProfessorName,
-                COUNT(DISTINCT com.CommentID) AS NumberOfComments,
-                COALESCE(AVG(r.Score), 0) AS AverageRating
-            FROM Courses c
-            LEFT JOIN Comments com ON c.CourseID = com.CourseID
-            LEFT JOIN Ratings r ON c.CourseID = r.CourseID
-            JOIN Professors p ON c.ProfessorID = p.ProfessorID
-            GROUP BY c.CourseID, c.Title, p.Name
-            ORDER BY NumberOfComments DESC, AverageRating DESC;
-        ''')).fetchall()
-        return jsonify([{"CourseID": cid, "Title": title, "ProfessorName": pname,
+    result = versions.cached(versions.LEADERBOARDS, LEADERBOARD_POPULAR, load_popular_courses)
+    return jsonify([{"CourseID": cid, "Title": title, "ProfessorName": pname,
                      "NumberOfComments": num_comments, "AverageRating": avg_rating}
                     for cid, title, pname, num_comments, avg_rating in result])
 
+def query_professor_leaderboard(db_conn):
+    return db_conn.execute(text('''
+        SELECT c.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName, p.Department, ROUND(s.AverageRating, 2) AS AverageRating,
+            ROUND(ps.AverageScore, 2) AS ProfessorAverage
+        FROM CourseStats s
+        JOIN Courses c ON c.CourseID = s.CourseID
+        JOIN Professors p ON c.ProfessorID = p.ProfessorID
+        LEFT JOIN ProfessorStats ps ON ps.ProfessorID = p.ProfessorID
+        WHERE s.RatingCount > 0
+        ORDER BY s.AverageRating DESC;
+    ''')).fetchall()
+
+def load_professor_leaderboard():
+    with replicas.read_engine().connect() as db_conn:
+        return query_professor_leaderboard(db_conn)
+
 @app.route('/professors')
 def professors():
-    pool = create_connection_pool()
-    professors = []
-    with pool.connect() as db_conn:
-        professors = db_conn.execute(text('''
-            SELECT c.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName, p.Department, ROUND(AVG(r.Score), 2) AS AverageRating
-            FROM Courses c
-            JOIN Professors p ON c.ProfessorID = p.ProfessorID
-            JOIN Ratings r ON c.CourseID = r.CourseID
-            GROUP BY c.CourseID, c.Title, p.ProfessorID, p.Name, p.Department
-            ORDER BY AverageRating DESC;
-        ''')).fetchall()
-    return render_template('professors.html', professors=professors)
+    def page():
+        professors = versions.cached(versions.LEADERBOARDS, LEADERBOARD_PROFESSORS, load_professor_leaderboard)
+        return render_template('professors.html', professors=professors, version_scope=versions.LEADERBOARDS)
+
+    return versions.conditional([versions.LEADERBOARDS], page)
+
+# professor_bio's queries are independent of each other: the sync view runs
+# them in turn on one connection, the async entry point (asgi.py) runs each on
+# its own connection at the same time. The sync view takes the courses from
+# the catalog instead; refreshing that could block the event loop.
+def query_professor(db_conn, prof_id):
+    return db_conn.execute(text('''
+        SELECT p.ProfessorID, p.Name AS ProfessorName, p.Department, ROUND(s.AverageScore, 2) AS AverageScore
+        FROM Professors p
+        LEFT JOIN ProfessorStats s ON s.ProfessorID = p.ProfessorID
+        WHERE p.ProfessorID = :prof_id;
+    '''), {'prof_id': prof_id}).fetchone()
+
+def query_professor_courses(db_conn, prof_id):
+    return db_conn.execute(text('''
+        SELECT CourseID, CourseNumber, Title
+        FROM Courses
+        WHERE ProfessorID = :prof_id
+        ORDER BY CourseID;
+    '''), {'prof_id': prof_id}).fetchall()
+
+def query_course_ratings(db_conn, prof_id):
+    return db_conn.execute(text('''
+        SELECT s.CourseID, ROUND(s.AverageRating, 2) AS AverageRating
+        FROM CourseStats s
+        JOIN Courses c ON c.CourseID = s.CourseID
+        WHERE c.ProfessorID = :prof_id AND s.RatingCount > 0;
+    '''), {'prof_id': prof_id}).fetchall()
+
+def query_reviews(db_conn, prof_id, page):
+    # One page of reviews for every course in a single statement. One
+    # extra row per course is fetched to know whether there is a next page.
+    return db_conn.execute(text('''
+        SELECT CourseID, CommentID, Content, rn
+        FROM (
+            SELECT com.CourseID, com.CommentID, com.Content,
+                ROW_NUMBER() OVER (PARTITION BY com.CourseID ORDER BY com.CommentID DESC) AS rn
+            FROM Comments com
+            JOIN Courses c ON c.CourseID = com.CourseID
+            WHERE c.ProfessorID = :prof_id
+        ) ranked
+        WHERE rn > :offset AND rn <= :offset + :limit + 1
+        ORDER BY CourseID, rn;
+    '''), {
+        'prof_id': prof_id,
+        'offset': (page - 1) * REVIEWS_PER_PAGE,
+        'limit': REVIEWS_PER_PAGE,
+    }).fetchall()
+
+def professor_bio_data(page, professor_info, courses, ratings, reviews):
+    ratings_by_course = {course_id: average for course_id, average in ratings if average is not None}
+    reviews_by_course = {course.CourseID: [] for course in courses}
+    more_reviews = set()
+    for course_id, comment_id, content, rn in reviews:
+        if rn > page * REVIEWS_PER_PAGE:
+            more_reviews.add(course_id)
+        elif course_id in reviews_by_course:
+            reviews_by_course[course_id].append((comment_id, content))
+
+    return {'professor': professor_info, 'courses': courses, 'reviews_by_course': reviews_by_course,
+            'ratings_by_course': ratings_by_course, 'more_reviews': more_reviews}
+
+def load_professor_bio(prof_id, page):
+    professor = current_catalog().professor(prof_id)
+    courses = professor.Courses if professor is not None else ()
+    with replicas.read_engine().connect() as db_conn:
+        return professor_bio_data(page, query_professor(db_conn, prof_id), courses,
+                                  query_course_ratings(db_conn, prof_id), query_reviews(db_conn, prof_id, page))
+
 @app.route('/professor/<int:prof_id>', methods=['GET'])
 def professor_bio(prof_id):
-    try:
-        pool = create_connection_pool()
-        with pool.connect() as db_conn:
-            db_conn.execute(text("START TRANSACTION"))
-            professor_info = db_conn.execute(text('''
-                SELECT ProfessorID, Name AS ProfessorName, Department
-                FROM Professors
-                WHERE ProfessorID = :prof_id;
-            '''), {'prof_id': prof_id}).fetchone()
-
-            courses = db_conn.execute(text('''
-                SELECT CourseID, CourseNumber, Title
-                FROM Courses
-                WHERE ProfessorID = :prof_id;
-            '''), {'prof_id': prof_id}).fetchall()
-
-            reviews_by_course = {}
-            for course in courses:
-                reviews = db_conn.execute(text('''
-                    SELECT CommentID, Content
-                    FROM Comments 
-                    WHERE CourseID = :course_id;
-                '''), {'course_id': course[0]}).fetchall()
-                reviews_by_course[course[0]] = reviews
-
-            ratings = db_conn.execute(text('''
-                SELECT CourseID, AVG(Score) AS AverageRating
-                FROM Ratings
-                WHERE CourseID IN (SELECT CourseID FROM Courses WHERE ProfessorID = :prof_id)
-                GROUP BY CourseID;
-            '''), {'prof_id': prof_id}).fetchall()
-            ratings_by_course = {rating[0]: rating[1] for rating in ratings}
-
-            # Commit the transaction
-            db_conn.execute(text("COMMIT"))
-
-        # Render the template with the fetched data
-        return render_template('professor_bio.html', professor=professor_info, courses=courses, reviews_by_course=reviews_by_course, ratings_by_course=ratings_by_course)
-    except Exception as e:
-        db_conn.execute(text("ROLLBACK"))
-        print("Error:", e)
-        return render_template('error.html', message="An error occurred while fetching professor information.")
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    def render():
+        try:
+            data = versions.cached(versions.professor_scope(prof_id), professor_key(prof_id, 'bio', page),
+                                   lambda: load_professor_bio(prof_id, page))
+            # Render the template with the fetched data
+            return render_template('professor_bio.html', page=page, version_scope=versions.professor_scope(prof_id),
+                                   **data)
+        except Exception as e:
+            print("Error:", e)
+            # not 200, so it is never given an ETag and revalidated into a 304
+            return render_template('error.html', message="An error occurred while fetching professor information."), 500
+
+    return versions.conditional([versions.professor_scope(prof_id)], render)
+
+
+REVIEW_MESSAGES = {
+    writebehind.APPLIED: 'Rating and comment added successfully!',
+    writebehind.QUEUED: 'Rating and comment received.',
+    writebehind.DUPLICATE: 'User has already rated this course.',
+}
+
+
+def writes_applied(writes):
+    # called with what reached the database: inline, or once per flushed
+    # batch when writes are queued
+    if not writes:
+        return
+    professor_ids = {write['professor_id'] for write in writes if write['professor_id'] is not None}
+    for professor_id in professor_ids:
+        invalidate_professor(professor_id)
+    invalidate_leaderboards(LEADERBOARD_PROFESSORS, LEADERBOARD_POPULAR, LEADERBOARD_INSIGHTFUL)
+    versions.bump(*[versions.professor_scope(professor_id) for professor_id in sorted(professor_ids)],
+                  versions.LEADERBOARDS)
+    if comment_index.ready and any(write['kind'] == writebehind.REVIEW for write in writes):
+        try:
+            comment_index.refresh(get_engine())
+        except Exception as e:
+            print("Error:", e)
+
+
+def form_course_id():
+    return request.form.get('course_id', type=int)
+
+
+def course_professor(course_id):
+    # the professor whose pages a write to the course changes, from the
+    # course itself and never from the form
+    course = current_catalog().course(course_id) if course_id is not None else None
+    if course is not None:
+        return course.ProfessorID
+    if course_id is None:
+        return None
+    # added by another worker since this one last refreshed the catalog
+    with get_engine().connect() as db_conn:
+        return db_conn.execute(text('SELECT ProfessorID FROM Courses WHERE CourseID = :course_id'),
+                               {'course_id': course_id}).scalar()
 
 
 @app.route('/add_review', methods=['POST'])
+@ratelimit.limit_writes(form_course_id)
 def add_review():
     if request.method == 'POST':
         score = request.form.get('score', type=float)
         would_take_again = request.form.get('would_take_again', type=bool)
         comment = request.form.get('comment')
         course_id = request.form.get('course_id', type=int)
-        professor_id = request.form.get('professor_id')
-
-        pool = create_connection_pool()
-
-        with pool.connect() as db_conn:
+        professor_id = course_professor(course_id)
+
+        if not writebehind.valid_score(score):
+            return render_template('error.html', message="A review needs a score from 1 to 5."), 400
+        if professor_id is None:
+            return render_template('error.html', message="There is no such course."), 400
+        # same rules the AddCourseRatingAndComment procedure applied
+        if not comment or len(comment) <= writebehind.MIN_COMMENT_LENGTH:
+            print('Comment must be at least 10 characters long.')
+        else:
             try:
-                result_proxy = db_conn.execute(text('''
-                    CALL AddCourseRatingAndComment(:p_UserID, :p_CourseID, :p_Score, :p_WouldTakeAgain, :p_Comment)
-                '''), {
-                    'p_UserID': user_id, 
-                    'p_CourseID': course_id, 
-                    'p_Score': score, 
-                    'p_WouldTakeAgain': would_take_again, 
-                    'p_Comment': comment
-                })
-                
-                result = result_proxy.fetchall()
-                if result:
-                    print(result[0][0])  
-
+                result = writebehind.submit(writebehind.review(identity.current_user_id(), course_id, score,
+                                                               would_take_again, comment, professor_id))
+                print(REVIEW_MESSAGES[result])
             except Exception as e:
-                db_conn.rollback() 
                 print(str(e))
-
-            finally:
-                db_conn.close()
+            replicas.wrote()
 
         return redirect(url_for('professor_bio', prof_id=professor_id))
 
     
 @app.route('/delete_review/<int:prof_id>/<int:id>', methods=['GET'])
+@ratelimit.limit_writes()
 def delete_review(prof_id, id):
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        db_conn.execute(text("START TRANSACTION"))
+    pool = get_engine()
+    with pool.begin() as db_conn:
         db_conn.execute(text('''
             DELETE FROM Comments WHERE CommentID = :comment_id
         '''), {'comment_id': id})
-        db_conn.execute(text("COMMIT"))
+    comment_index.remove(id)
+    invalidate_professor(prof_id)
+    invalidate_leaderboards(LEADERBOARD_POPULAR, LEADERBOARD_INSIGHTFUL)
+    versions.bump(versions.professor_scope(prof_id), versions.LEADERBOARDS)
+    replicas.wrote()
     return redirect(url_for('professor_bio', prof_id=prof_id))
 
 @app.route('/search', methods=['POST'])
@@ -229,28 +349,13 @@ def search():
     courseNumber = request.form.get('courseNumber')
     professor = request.form.get('professor')
 
-    query = '''
-        SELECT DISTINCT p.ProfessorID, p.Name as ProfessorName
-        FROM Professors p
-        JOIN Courses c ON p.ProfessorID = c.ProfessorID
-    '''
-    if professor and courseNumber:
-        query += '''
-            WHERE p.Name LIKE '%{}%' 
-            AND c.CourseNumber LIKE '%{}%'
-        '''.format(professor, courseNumber)
-    elif professor:
-        query += '''
-            WHERE p.Name LIKE '%{}%'
-        '''.format(professor)
-    elif courseNumber:
-        query += '''
-            WHERE c.CourseNumber LIKE '%{}%'
-        '''.format(courseNumber)
-
-    with create_connection_pool().connect() as db_conn:
-        result = db_conn.execute(text(query))
-        professors = result.fetchall()
+    if search_index.stale:
+        search_index.build_in_background(get_engine())
+    if search_index.ready:
+        professors = search_index.search(professor, courseNumber)
+    else:
+        with replicas.read_engine().connect() as db_conn:
+            professors = sql_search(db_conn, professor, courseNumber)
 
     if len(professors) > 1:
         professor_ids = [row[0] for row in professors]
@@ -263,262 +368,111 @@ def search():
     else:
         return render_template('no_results.html')
 
+@app.route('/search_comments', methods=['GET'])
+def search_comments_page():
+    query = request.args.get('q', '').strip()
+    comment_index.maintain(get_engine())
+    hits = search_comments(replicas.read_engine(), query) if query else []
+    return render_template('comment_search.html', query=query, hits=hits)
+
 @app.route('/add_rating', methods=['POST'])
+@ratelimit.limit_writes(form_course_id)
 def add_rating():
     if request.method == 'POST':
-        create_trigger()
-        pool = create_connection_pool()
-        rating = request.form.get('rating')
-        course_id = request.form.get('course_id')
-        professor_id = request.form.get('professor_id')
-        user_id = 0 
+        rating = request.form.get('rating', type=float)
+        course_id = request.form.get('course_id', type=int)
+        professor_id = course_professor(course_id)
         print(rating, course_id, professor_id)
-        with pool.connect() as db_conn:
-            query = '''
-            INSERT INTO Ratings (Score, CourseID, UserID)
-            VALUES ('{}', '{}', '{}');
-            '''.format(rating, course_id, user_id)
-            db_conn.execute(text(query))
-            db_conn.commit()
+        if not writebehind.valid_score(rating):
+            return render_template('error.html', message="A rating has to be a number from 1 to 5."), 400
+        if professor_id is None:
+            return render_template('error.html', message="There is no such course."), 400
+        writebehind.submit(writebehind.rating(course_id, rating, professor_id, user_id=identity.current_user_id()))
+        replicas.wrote()
         
         return redirect(url_for('professor_bio', prof_id=professor_id))
     
 
-def create_trigger():
-    pool = create_connection_pool()
-
-    with pool.connect() as db_conn:
-        db_conn.execute(text('''DROP TRIGGER IF EXISTS InsertAverageRating'''))
-        db_conn.execute(text('''
-            CREATE TRIGGER InsertAverageRating
-            AFTER INSERT ON Ratings
-            FOR EACH ROW
-            BEGIN
-                DECLARE avg_rating DECIMAL(5, 2);
-                DECLARE course_id INT;
-                SET course_id = NEW.CourseID;
-                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
-                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
-            END;
-        '''))
-        db_conn.execute(text('''DROP TRIGGER IF EXISTS DeleteAverageRating'''))
-        db_conn.execute(text('''
-            CREATE TRIGGER DeleteAverageRating
-            AFTER DELETE ON Ratings
-            FOR EACH ROW
-            BEGIN
-                DECLARE avg_rating DECIMAL(5, 2);
-                DECLARE course_id INT;
-                SET course_id = OLD.CourseID;
-                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
-                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
-            END;
-        '''))
-        db_conn.execute(text('''DROP TRIGGER IF EXISTS UpdateAverageRating'''))
-        db_conn.execute(text('''
-            CREATE TRIGGER UpdateAverageRating
-            AFTER UPDATE ON Ratings
-            FOR EACH ROW
-            BEGIN
-                DECLARE avg_rating DECIMAL(5, 2);
-                DECLARE course_id INT;
-                SET course_id = NEW.CourseID;
-                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
-                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
-            END;
-        '''))
-
-def create_transaction():
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        db_conn.execute(text('''DROP PROCEDURE IF EXISTS AddCourseRatingAndComment;'''))
-        db_conn.execute(text('''
-        CREATE PROCEDURE AddCourseRatingAndComment(
-            IN p_UserID INT,
-            IN p_CourseID INT,
-            IN p_Score DECIMAL(5, 2),
-            IN p_WouldTakeAgain BOOLEAN,
-            IN p_Comment TEXT)
-        BEGIN
-            DECLARE v_alreadyRated INT;
-            SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;
-
-            START TRANSACTION;
-            SELECT COUNT(*) INTO v_alreadyRated
-            FROM Ratings
-            JOIN Comments ON Ratings.UserID = Comments.UserID AND Ratings.CourseID = Comments.CourseID 
-            WHERE Ratings.UserID = p_UserID AND Ratings.CourseID = p_CourseID;
-
-            IF v_alreadyRated = 0 THEN
-                IF CHAR_LENGTH(p_Comment) > 10 THEN
-                    INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID)
-                    VALUES (p_Score, p_WouldTakeAgain, p_CourseID, p_UserID);
-
-                    INSERT INTO Comments (Content, CourseID, UserID)
-                    VALUES (p_Comment, p_CourseID, p_UserID);
-
-                    UPDATE Courses
-                    SET AverageRating = (
-                        SELECT AVG(Score) as AverageScore
-                        FROM Ratings
-                        WHERE CourseID = p_CourseID
-                        GROUP BY CourseID
-                    )
-                    WHERE CourseID = p_CourseID;
-
-                    COMMIT;
-
-                    SELECT 'Rating and comment added successfully!' AS Result;
-                ELSE
-                    ROLLBACK;
-                    SELECT 'Comment must be at least 10 characters long.' AS ErrorMessage;
-                END IF;
-            ELSE
-                ROLLBACK;
-                SELECT 'User has already rated this course.' AS ErrorMessage;
-            END IF;
-        END
-        '''))
-                             
-def create_stored_procedure_avgscore():
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        db_conn.execute(text('''DROP PROCEDURE IF EXISTS GetProfessorAverageScore;'''))
-        db_conn.execute(text("""
-            CREATE PROCEDURE GetProfessorAverageScore(IN prof_id INT)
-            BEGIN
-                SELECT 
-                    Pr.Name AS ProfessorName,
-                    Pr.Department,
-                    AVG(OverallCourseScore) AS AvgProfessorScore
-                FROM 
-                    (
-                        SELECT 
-                            C.ProfessorID,
-                            AVG(R.Score) AS OverallCourseScore
-                        FROM Courses C
-                        JOIN Ratings R ON C.CourseID = R.CourseID
-                        WHERE C.ProfessorID = prof_id
-                        GROUP BY C.CourseID
-                    ) AS CourseScores
-                JOIN Professors Pr ON CourseScores.ProfessorID = Pr.ProfessorID
-                WHERE Pr.ProfessorID = prof_id
-                GROUP BY Pr.ProfessorID;
-            END;
-            """))
-        
 @app.route('/professor_detail/<int:professor_id>', methods=['GET'])
 def professor_detail(professor_id):
-    create_stored_procedure_avgscore()
-    pool = create_connection_pool()
-    with pool.connect() as conn:
-        result = conn.execute(text("CALL GetProfessorAverageScore(:prof_id)"), {'prof_id': professor_id})
-        professor_info = result.fetchone()
-    return render_template('professor_details.html', professor=professor_info)
-        
-def create_stored_procedure_popular_courses():
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        db_conn.execute(text('''DROP PROCEDURE IF EXISTS GetInsightfulDepartments;'''))
-        db_conn.execute(text("""
-        CREATE PROCEDURE GetInsightfulDepartments()
-        BEGIN
-            CREATE TEMPORARY TABLE HighRatings AS
-                SELECT p.Department, AVG(r.Score) AS AverageRating
-                FROM Professors p
-                JOIN Courses c ON p.ProfessorID = c.ProfessorID
-                JOIN Ratings r ON c.CourseID = r.CourseID
-                GROUP BY p.Department
-                HAVING COUNT(r.RatingID) > 5
-                ORDER BY AverageRating DESC;
-            
-            CREATE TEMPORARY TABLE MostComments AS
-                SELECT p.Department, COUNT(com.CommentID) AS TotalComments
+    def load():
+        with replicas.read_engine().connect() as conn:
+            return conn.execute(text('''
+                SELECT p.Name AS ProfessorName, p.Department, s.AverageScore AS AvgProfessorScore
                 FROM Professors p
-                JOIN Courses c ON p.ProfessorID = c.ProfessorID
-                JOIN Comments com ON c.CourseID = com.CourseID
-                GROUP BY p.Department
-                ORDER BY TotalComments DESC;
-            
-            SELECT 
-                hr.Department,
-                hr.AverageRating,
-                mc.TotalComments
-            FROM HighRatings hr
-            JOIN MostComments mc ON hr.Department = mc.Department
-            ORDER BY hr.AverageRating DESC, mc.TotalComments DESC;
-                             
-            DROP TABLE HighRatings;
-            DROP TABLE MostComments;
-                                     END;"""))
-        
-def create_procedure_highly_recommended():
-    pool = create_connection_pool()
-    with pool.connect() as db_conn:
-        db_conn.execute(text('''DROP PROCEDURE IF EXISTS GetPopularCourses;'''))
-        db_conn.execute(text("""
-            CREATE PROCEDURE GetPopularCourses()
-            BEGIN
-                SELECT 
-                    c.CourseID, 
-                    c.Title, 
-                    p.Name AS ProfessorName,
-                    COUNT(DISTINCT com.CommentID) AS NumberOfComments,
-                    COALESCE(AVG(r.Score), 0) AS AverageRating
-                FROM Courses c
-                LEFT JOIN Comments com ON c.CourseID = com.CourseID
-                LEFT JOIN Ratings r ON c.CourseID = r.CourseID
-                JOIN Professors p ON c.ProfessorID = p.ProfessorID
-                GROUP BY c.CourseID, c.Title, p.Name
-                ORDER BY NumberOfComments DESC, AverageRating DESC;
-            END 
-            """))
+                JOIN ProfessorStats s ON s.ProfessorID = p.ProfessorID
+                WHERE p.ProfessorID = :prof_id;
+            '''), {'prof_id': professor_id}).fetchone()
+
+    def page():
+        professor_info = versions.cached(versions.professor_scope(professor_id), professor_key(professor_id, 'detail'),
+                                         load)
+        return render_template('professor_details.html', professor=professor_info)
+
+    return versions.conditional([versions.professor_scope(professor_id)], page)
         
 @app.route('/popular_courses', methods=['GET'])
 def popular_courses():
-    create_stored_procedure_popular_courses()
-    pool = create_connection_pool()
-    with pool.connect() as conn:
-        result = conn.execute(text("CALL GetPopularCourses()"))
-        courses = result.fetchall()
-    return render_template('popular_courses.html', courses=courses)
+    def page():
+        courses = versions.cached(versions.LEADERBOARDS, LEADERBOARD_POPULAR, load_popular_courses)
+        return render_template('popular_courses.html', courses=courses, version_scope=versions.LEADERBOARDS)
+
+    return versions.conditional([versions.LEADERBOARDS], page)
+
+def query_insightful_departments(db_conn):
+    return db_conn.execute(text('''
+        SELECT Department, ROUND(AverageRating, 2) AS AverageRating, CommentCount AS TotalComments
+        FROM DepartmentStats
+        WHERE RatingCount > 5 AND CommentCount > 0
+        ORDER BY DepartmentStats.AverageRating DESC, CommentCount DESC
+    ''')).fetchall()
+
+def load_insightful_departments():
+    with replicas.read_engine().connect() as db_conn:
+        return query_insightful_departments(db_conn)
 
 @app.route('/insightful_courses', methods=['GET'])
 def insightful_courses():
-    create_stored_procedure_popular_courses()
-    pool = create_connection_pool()
-    with pool.connect() as conn:
-        result = conn.execute(text("CALL GetInsightfulDepartments()"))
-        courses = result.fetchall()
-    return render_template('insightful_courses.html', courses=courses)
+    def page():
+        courses = versions.cached(versions.LEADERBOARDS, LEADERBOARD_INSIGHTFUL, load_insightful_departments)
+        return render_template('insightful_courses.html', courses=courses, version_scope=versions.LEADERBOARDS)
 
+    return versions.conditional([versions.LEADERBOARDS], page)
 
-def get_last_user_id():
-    try:
-        with open('last_user_id.txt', 'r') as file:
-            last_user_id = int(file.read())
-    except FileNotFoundError:
-        last_user_id = 1
-    return last_user_id
 
-def update_last_user_id(user_id):
-    with open('last_user_id.txt', 'w') as file:
-        file.write(str(user_id))
+def warmup():
+    # gunicorn.conf.py runs this once in the master before it forks, so every
+    # worker starts with the index built and the leaderboards cached
+    for problem in schema.verify():
+        print("Schema check failed:", problem)
+
+    catalog.load(get_engine())
+    search_index.build(get_engine())
+    comment_index.build(get_engine())
+    versions.cached(versions.LEADERBOARDS, LEADERBOARD_PROFESSORS, load_professor_leaderboard)
+    versions.cached(versions.LEADERBOARDS, LEADERBOARD_POPULAR, load_popular_courses)
+    versions.cached(versions.LEADERBOARDS, LEADERBOARD_INSIGHTFUL, load_insightful_departments)
+    readiness.warm = True
+
 
 @app.before_first_request
 def initialize():
-    global user_id
-    user_id = get_last_user_id()
+    # without a preloading server the first request does the warmup, with
+    # the index built in the background as before
+    if not readiness.warm:
+        for problem in schema.verify():
+            print("Schema check failed:", problem)
+        search_index.build_in_background(get_engine())
+        comment_index.build_in_background(get_engine())
+        readiness.warm = True
 
-    update_last_user_id(user_id + 1)         
+    # threads do not survive a fork, so each worker starts its own
+    writebehind.start(on_flush=writes_applied)
 
 
 @app.route('/edit_professor/<int:professor_id>', methods=['GET'])
 def edit_professor(professor_id):
-    pool = create_connection_pool()
-    with pool.connect() as conn:
-        result = conn.execute(text("SELECT Name, Department FROM Professors WHERE ProfessorID = :id"), {'id': professor_id})
-        professor = result.fetchone()
+    professor = current_catalog().professor(professor_id)
     return render_template('edit_professor.html', professor=professor, professor_id=professor_id)
 
 @app.route('/update_professor/<int:professor_id>', methods=['POST'])
@@ -526,17 +480,112 @@ def update_professor(professor_id):
     name = request.form['name']
     department = request.form['department']
     bio = request.form['bio']
-    pool = create_connection_pool()
-    with pool.connect() as conn:
-        conn.execute(text("START TRANSACTION"))
+    pool = get_engine()
+    with pool.begin() as conn:
         conn.execute(text("UPDATE Professors SET Name = :name, Department = :dept WHERE ProfessorID = :id"), {'name': name, 'dept': department, 'id': professor_id})
-        conn.execute(text("COMMIT"))
+    search_index.update_professor(professor_id, name)
+    catalog_changed()
+    invalidate_professor(professor_id)
+    invalidate_leaderboards(LEADERBOARD_PROFESSORS, LEADERBOARD_POPULAR, LEADERBOARD_INSIGHTFUL)
+    versions.bump(versions.professor_scope(professor_id), versions.LEADERBOARDS)
+    replicas.wrote()
     return redirect(url_for('professor_bio', prof_id=professor_id))
 
 
+def catalog_imported(result):
+    catalog_changed()
+    search_index.build_in_background(get_engine())
+    for professor_id in result.updated_professors:
+        invalidate_professor(professor_id)
+    invalidate_leaderboards(LEADERBOARD_POPULAR)
+    versions.bump(versions.LEADERBOARDS, *[versions.professor_scope(professor_id)
+                                           for professor_id in sorted(result.updated_professors)])
+
+
+@app.route('/import_catalog', methods=['GET', 'POST'])
+def import_catalog():
+    if request.method == 'POST':
+        upload = request.files.get('catalog')
+        if upload is None or not upload.filename:
+            return render_template('import_catalog.html', message="Choose a file to import.")
+        format = request.form.get('format') or importer.detect_format(upload.filename)
+        chunk_size = request.form.get('chunk_size', importer.IMPORT_CHUNK_SIZE, type=int)
+        try:
+            result = importer.import_catalog(importer.text_stream(upload.stream), format, chunk_size=chunk_size,
+                                             progress=print)
+        except Exception as e:
+            print("Error:", e)
+            return render_template('error.html', message="An error occurred while importing the catalog.")
+        catalog_imported(result)
+        replicas.wrote()
+        return render_template('import_catalog.html', result=result)
+    return render_template('import_catalog.html')
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply the schema migrations that have not been applied yet."""
+    schema.install(log=click.echo)
+
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(sorted(importer.READERS)), default=None,
+              help='Input format; defaults to the file extension.')
+@click.option('--chunk-size', default=importer.IMPORT_CHUNK_SIZE, show_default=True,
+              help='Rows written per transaction.')
+def import_catalog_command(path, format, chunk_size):
+    """Import professors and courses from a CSV, JSON or JSON Lines file."""
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        result = importer.import_catalog(stream, format or importer.detect_format(path), chunk_size=chunk_size,
+                                         progress=click.echo)
+    catalog_imported(result)
+    click.echo('{rows} rows: {professors} new professors, {courses} courses, {duplicates} duplicates, '
+               '{rejected} rejected in {seconds:.2f} s ({courses_per_second:.0f} courses/s)'.format(**result.as_dict()))
+    for error in result.errors:
+        click.echo(error, err=True)
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the course, professor and department stats from every rating and comment."""
+    started = time.perf_counter()
+    rebuilt = stats.rebuild()
+    invalidate_leaderboards(LEADERBOARD_PROFESSORS, LEADERBOARD_POPULAR, LEADERBOARD_INSIGHTFUL)
+    versions.bump(versions.LEADERBOARDS)
+    click.echo('Rebuilt stats for {courses} courses, {professors} professors and {departments} departments '
+               'in {seconds:.2f} s'.format(seconds=time.perf_counter() - started, **rebuilt))
+
+
+@app.cli.command('check-stats')
+def check_stats_command():
+    """Compare the course, professor and department stats with a full recompute; exits 1 if they differ."""
+    problems = stats.check()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo('CourseStats, ProfessorStats and DepartmentStats match a full recompute')
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    cache = get_cache()
+    return jsonify(dict(cache.stats.as_dict(), entries=len(cache), backend=type(cache).__name__))
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    cache = get_cache()
+    stats = {'cache': dict(cache.stats.as_dict(), entries=len(cache))}
+    if writebehind.WRITE_BEHIND:
+        queue = writebehind.get_queue()
+        stats['write_behind'] = dict(queue.stats.as_dict(), pending=queue.pending())
+    if catalog.ready:
+        stats['catalog'] = catalog.stats()
+    return metrics.render(stats), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 if __name__ == '__main__':
-    create_transaction()
-    create_procedure_highly_recommended()
-    create_stored_procedure_popular_courses()
-    create_trigger()
+    schema.install()
     app.run(debug=True)
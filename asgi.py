@@ -0,0 +1,240 @@
+import asyncio
+import json
+import re
+import time
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, render_template
+from werkzeug.http import parse_etags, quote_etag
+
+import app as application
+import db
+import metrics
+import replicas
+import versions
+from cache import LEADERBOARD_POPULAR, LEADERBOARD_PROFESSORS, get_cache, professor_key
+from db import dispose_async_engine, get_async_engine, get_async_replica_engines
+
+# Async serving mode: `uvicorn asgi:app`. The database-bound read routes are
+# served here on an asyncio driver, so a request waiting on the database does
+# not hold a thread. They run the same query functions as the Flask views
+# through AsyncConnection.run_sync. Every other route goes to the Flask app,
+# which runs in asgiref's thread pool exactly as it does under a WSGI server.
+#
+# Reads are routed as replicas.py routes them: a request sticks to one
+# replica, or to the primary for a client that wrote within
+# READ_YOUR_WRITES_SECONDS (the same session cookie), and its data versions
+# come from the engine it reads.
+flask_app = application.app
+wsgi = WsgiToAsgi(flask_app)
+
+# the engine, and the versions read from it, of the request being served
+_reading = ContextVar('reading', default=None)
+
+
+def reading_own_writes(scope):
+    # replicas.reading_own_writes, with the session from this request's cookie
+    if not db.REPLICA_DATABASE_URLS:
+        return False
+    headers = dict(scope.get('headers') or [])
+    cookie = headers.get(b'cookie', b'').decode('latin-1')
+    with flask_app.test_request_context(scope['path'], headers={'Cookie': cookie} if cookie else {}):
+        return replicas.reading_own_writes()
+
+
+def start_reading(scope):
+    engines = get_async_replica_engines()
+    own_writes = reading_own_writes(scope)
+    engine = replicas.choose(engines) if engines and not own_writes else get_async_engine()
+    _reading.set({'engine': engine, 'own_writes': own_writes, 'versions': {}})
+
+
+def read_engine():
+    reading = _reading.get()
+    return reading['engine'] if reading else get_async_engine()
+
+
+async def run_query(query, *args):
+    async with read_engine().connect() as conn:
+        return await conn.run_sync(query, *args)
+
+
+async def cached(key, version, loader):
+    # versions.cached: the key is under the data version read before loading
+    key = '{}:v{}'.format(key, version[0])
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = await loader()
+        if value is not None:
+            cache.set(key, value)
+    return value
+
+
+async def engine_versions(*scopes):
+    # versions.read_engine_versions
+    reading = _reading.get()
+    known = reading['versions'] if reading else {}
+    missing = [scope for scope in scopes if scope not in known]
+    if missing:
+        known.update(zip(missing, await run_query(versions.current, *missing)))
+    return [known[scope] for scope in scopes]
+
+
+async def data_versions(*scopes):
+    # versions.cached_current, with the database read on the async driver
+    reading = _reading.get()
+    found = [None] * len(scopes) if reading and reading['own_writes'] else versions.lookup(*scopes)
+    missing = [scope for scope, version in zip(scopes, found) if version is None]
+    if missing:
+        fresh = dict(zip(missing, await engine_versions(*missing)))
+        versions.remember(missing, [fresh[scope] for scope in missing])
+        found = [fresh[scope] if version is None else version for scope, version in zip(scopes, found)]
+    return found
+
+
+async def read_versions(*scopes):
+    # versions.read
+    if read_engine() is get_async_engine():
+        return await data_versions(*scopes)
+    return await engine_versions(*scopes)
+
+
+def render(scope, template, found=None, **context):
+    # templates call url_for, which needs a request context; found holds the
+    # data versions the page's fragments are cached under
+    with flask_app.test_request_context(scope['path'], base_url=base_url(scope)):
+        g.data_versions = found or {}
+        return render_template(template, **context)
+
+
+def base_url(scope):
+    headers = dict(scope.get('headers') or [])
+    host = headers.get(b'host', b'localhost').decode('latin-1')
+    return '{}://{}{}'.format(scope.get('scheme', 'http'), host, scope.get('root_path', ''))
+
+
+def query_int(query, name, default):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+async def professor_bio(scope, query, found, prof_id):
+    page = max(query_int(query, 'page', 1), 1)
+    prof_id = int(prof_id)
+
+    async def load():
+        professor, courses, ratings, reviews = await asyncio.gather(
+            run_query(application.query_professor, prof_id),
+            run_query(application.query_professor_courses, prof_id),
+            run_query(application.query_course_ratings, prof_id),
+            run_query(application.query_reviews, prof_id, page))
+        return application.professor_bio_data(page, professor, courses, ratings, reviews)
+
+    try:
+        data = await cached(professor_key(prof_id, 'bio', page), found[versions.professor_scope(prof_id)], load)
+        return 200, 'text/html', render(scope, 'professor_bio.html', found, page=page,
+                                        version_scope=versions.professor_scope(prof_id), **data)
+    except Exception as e:
+        print("Error:", e)
+        return 500, 'text/html', render(scope, 'error.html',
+                                        message="An error occurred while fetching professor information.")
+
+
+async def professors(scope, query, found):
+    rows = await cached(LEADERBOARD_PROFESSORS, found[versions.LEADERBOARDS],
+                        lambda: run_query(application.query_professor_leaderboard))
+    return 200, 'text/html', render(scope, 'professors.html', found, professors=rows,
+                                    version_scope=versions.LEADERBOARDS)
+
+
+async def popular_courses(scope, query, found):
+    rows = await cached(LEADERBOARD_POPULAR, found[versions.LEADERBOARDS],
+                        lambda: run_query(application.query_popular_courses))
+    return 200, 'text/html', render(scope, 'popular_courses.html', found, courses=rows,
+                                    version_scope=versions.LEADERBOARDS)
+
+
+async def get_courses(scope, query, found):
+    version, = await read_versions(versions.LEADERBOARDS)
+    rows = await cached(LEADERBOARD_POPULAR, version, lambda: run_query(application.query_popular_courses))
+    return 200, 'application/json', json.dumps([
+        {"CourseID": cid, "Title": title, "ProfessorName": pname,
+         "NumberOfComments": num_comments, "AverageRating": float(avg_rating)}
+        for cid, title, pname, num_comments, avg_rating in rows])
+
+
+# pattern, view, and the version scopes the page is validated against (the
+# same as the Flask views use)
+ROUTES = [
+    (re.compile(r'^/professor/(\d+)$'), professor_bio, lambda prof_id: [versions.professor_scope(prof_id)]),
+    (re.compile(r'^/professors$'), professors, lambda: [versions.LEADERBOARDS]),
+    (re.compile(r'^/popular_courses$'), popular_courses, lambda: [versions.LEADERBOARDS]),
+    (re.compile(r'^/get_courses$'), get_courses, None),
+]
+
+
+async def respond(scope, view, scopes_of, groups):
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    query = parse_qs(query_string)
+    if scopes_of is None:
+        status, content_type, body = await view(scope, query, None, *groups)
+        return status, content_type, body, []
+
+    scopes = scopes_of(*groups)
+    found = await data_versions(*scopes)
+    full_path = '{}{}?{}'.format(scope.get('root_path', ''), scope['path'], query_string)
+    tag = versions.etag(found, versions.RELEASE, full_path)
+    request_headers = dict(scope.get('headers') or [])
+    if_none_match = parse_etags(request_headers.get(b'if-none-match', b'').decode('latin-1') or None)
+    if versions.not_modified(tag, if_none_match):
+        status, content_type, body = 304, None, ''
+    else:
+        found = await read_versions(*scopes)
+        tag = versions.etag(found, versions.RELEASE, full_path)
+        status, content_type, body = await view(scope, query, dict(zip(scopes, found)), *groups)
+    if status not in (200, 304):
+        return status, content_type, body, []
+    headers = [(b'etag', quote_etag(tag).encode('latin-1')), (b'cache-control', b'no-cache')]
+    return status, content_type, body, headers
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # the Flask app's one-off setup runs on its first request, so send
+            # it one before the async routes start serving
+            await asyncio.to_thread(flask_app.test_client().get, '/')
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await dispose_async_engine()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        for pattern, view, scopes_of in ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                started = time.perf_counter()
+                start_reading(scope)
+                status, content_type, body, headers = await respond(scope, view, scopes_of, match.groups())
+                metrics.observe_request(view.__name__, scope['method'], status, time.perf_counter() - started)
+                body = body.encode('utf-8')
+                if content_type is not None:
+                    headers += [
+                        (b'content-type', '{}; charset=utf-8'.format(content_type).encode('latin-1')),
+                        (b'content-length', str(len(body)).encode('latin-1')),
+                    ]
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+                return
+    return await wsgi(scope, receive, send)
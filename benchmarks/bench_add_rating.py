@@ -0,0 +1,48 @@
+import argparse
+import random
+
+from sqlalchemy import text
+
+from harness import load_app, run_concurrently, sqlite_url
+import datagen
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent /add_rating throughput with and without per-request trigger DDL')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    import schema
+
+    course_count = datagen.seed(engine, professors=200, ratings=2000, comments=0)
+    trigger_ddl = [statements for version, name, statements in schema.MIGRATIONS if version == 2][0][engine.dialect.name]
+    view = app.view_functions['add_rating']
+
+    def recreate_triggers_then_rate():
+        # what add_rating used to do before the migration subsystem
+        with engine.connect() as conn:
+            for statement in trigger_ddl:
+                conn.execute(text(statement))
+            conn.commit()
+        return view()
+
+    for label, handler in (('before (DDL per request)', recreate_triggers_then_rate), ('after', view)):
+        app.view_functions['add_rating'] = handler
+        clients = [app.test_client() for _ in range(args.clients)]
+
+        def worker(index):
+            course_id = random.randint(1, course_count)
+            response = clients[index].post('/add_rating', data={'rating': '4.0', 'course_id': course_id, 'professor_id': 1})
+            if response.status_code != 302:
+                raise RuntimeError(response.status_code)
+
+        throughput, errors = run_concurrently(worker, args.clients, args.duration)
+        print('{:<26} {:8.1f} req/s  ({} errors)'.format(label, throughput, errors))
+    app.view_functions['add_rating'] = view
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import contextlib
+import gc
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# The catalog snapshot against the queries it replaces: load time, memory
+# (measured, and as reported on /metrics) next to the same rows kept as
+# plain dicts, lookup latency, the cost of a refresh, and the snapshot
+# matching the tables after professors and courses are changed behind its
+# back.
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def timed(fn, args):
+    samples = []
+    for arg in args:
+        started = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def snapshot_rows(catalog):
+    return sorted((professor.ProfessorID, professor.Name, professor.Department,
+                   tuple((course.CourseID, course.CourseNumber, course.Title) for course in professor.Courses))
+                  for professor in catalog.professors.values())
+
+
+def table_rows(conn):
+    courses = {}
+    for course_id, number, title, professor_id in conn.execute(text('''
+        SELECT CourseID, CourseNumber, Title, ProfessorID FROM Courses ORDER BY CourseID
+    ''')):
+        courses.setdefault(professor_id, []).append((course_id, number, title))
+    return sorted((professor_id, name, department, tuple(courses.get(professor_id, ())))
+                  for professor_id, name, department in conn.execute(text('''
+                      SELECT ProfessorID, Name, Department FROM Professors
+                  ''')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog snapshot: memory, lookups and refreshes')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--professors', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    os.environ.setdefault('SECRET_KEY', 'bench-catalog')
+    app, engine = load_app(args.url or sqlite_url())
+    from catalog import Catalog
+
+    datagen.seed(engine, professors=args.professors, ratings=0, comments=0)
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    # the same rows as plain dicts, the obvious way to keep them
+    gc.collect()
+    before = rss_mb()
+    with engine.connect() as conn:
+        plain = {row.ProfessorID: dict(row._mapping, Courses=[])
+                 for row in conn.execute(text('SELECT ProfessorID, Name, Department FROM Professors'))}
+        for row in conn.execute(text('SELECT CourseID, CourseNumber, Title, ProfessorID FROM Courses')):
+            plain[row.ProfessorID]['Courses'].append(dict(row._mapping))
+    plain_mb = rss_mb() - before
+    del plain
+    gc.collect()
+
+    before = rss_mb()
+    catalog = Catalog()
+    started = time.perf_counter()
+    catalog.load(engine)
+    loaded = time.perf_counter() - started
+    catalog_mb = rss_mb() - before
+    stats = catalog.stats()
+    print('loaded {professors} professors, {courses} courses, {departments} departments'.format(**stats),
+          'in {:.2f} s'.format(loaded))
+    print('memory: catalog {:.1f} MB (reported {:.1f} MB), plain dicts {:.1f} MB'.format(
+        catalog_mb, stats['bytes'] / 2 ** 20, plain_mb))
+
+    rng = random.Random(1)
+    ids = [rng.randint(1, args.professors) for _ in range(args.lookups)]
+    departments = [rng.choice(datagen.DEPARTMENTS) for _ in range(200)]
+    with engine.connect() as conn:
+        lookups = [
+            ('professor by ID', catalog.professor, lambda prof_id: conn.execute(text(
+                'SELECT Name, Department FROM Professors WHERE ProfessorID = :id'), {'id': prof_id}).fetchone(), ids),
+            ('courses of a professor', lambda prof_id: catalog.professor(prof_id).Courses,
+             lambda prof_id: conn.execute(text('''
+                 SELECT CourseID, CourseNumber, Title FROM Courses WHERE ProfessorID = :prof_id ORDER BY CourseID
+             '''), {'prof_id': prof_id}).fetchall(), ids),
+            ('department', catalog.in_department, lambda department: conn.execute(text(
+                'SELECT ProfessorID, Name FROM Professors WHERE Department = :department ORDER BY ProfessorID'),
+                {'department': department}).fetchall(), departments),
+        ]
+        for name, from_catalog, from_database, keys in lookups:
+            catalog_p50, catalog_p99 = timed(from_catalog, keys)
+            sql_p50, sql_p99 = timed(from_database, keys[:2000])
+            print('{:24} catalog p50 {:8.2f} us  p99 {:8.2f} us   SQL p50 {:8.1f} us  p99 {:8.1f} us'.format(
+                name, catalog_p50, catalog_p99, sql_p50, sql_p99))
+
+    # changes made straight to the tables, as another worker or an import would
+    started = time.perf_counter()
+    catalog.refresh(engine)
+    print('refresh with nothing changed: {:.2f} ms'.format((time.perf_counter() - started) * 1000))
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE Professors SET Name = 'Renamed Professor', Department = 'NEW' WHERE ProfessorID = 1"))
+        conn.execute(text("UPDATE Courses SET ProfessorID = 3 WHERE CourseID = (SELECT MIN(CourseID) FROM Courses WHERE ProfessorID = 2)"))
+        conn.execute(text("DELETE FROM Courses WHERE CourseID = (SELECT MAX(CourseID) FROM Courses WHERE ProfessorID = 4)"))
+        conn.execute(text("INSERT INTO Courses (CourseNumber, ProfessorID, Title) VALUES ('NEW101', 5, 'New Course')"))
+        conn.execute(text("INSERT INTO Professors (Name, Department, RMP_Link) VALUES ('New Professor', 'NEW', 'none')"))
+        conn.execute(text('DELETE FROM Professors WHERE ProfessorID = 6'))
+        # the rating triggers update Courses too; those are not catalog changes
+        logged = conn.execute(text('SELECT COUNT(*) FROM CatalogChanges')).scalar()
+        conn.execute(text('INSERT INTO Ratings (Score, CourseID, UserID) VALUES (4, 7, 1)'))
+        expect(conn.execute(text('SELECT COUNT(*) FROM CatalogChanges')).scalar() == logged,
+               'a rating logged a catalog change')
+    started = time.perf_counter()
+    catalog.refresh(engine)
+    print('refresh after 6 changes: {:.2f} ms ({} full loads, {} incremental)'.format(
+        (time.perf_counter() - started) * 1000, catalog.full_loads, catalog.incremental_refreshes))
+    expect(catalog.professor(1).Name == 'Renamed Professor', 'rename not picked up')
+    expect([p.Name for p in catalog.in_department('NEW')] == ['Renamed Professor', 'New Professor'],
+           'department index not updated')
+    expect(catalog.professor(6) is None, 'deleted professor still in the catalog')
+    with engine.connect() as conn:
+        expect(snapshot_rows(catalog) == table_rows(conn), 'catalog does not match the tables')
+    expect(sorted(catalog.courses) == sorted(course.CourseID for professor in catalog.professors.values()
+                                             for course in professor.Courses), 'course index does not match')
+
+    # a change that commits far below the newest one, as an import chunk
+    # does on MySQL: its ID is left free while 300 later changes are seen,
+    # then taken by a rename committed after them
+    import catalog as catalog_module
+    stale = Catalog()
+    stale.load(engine)
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE Professors SET Name = Name || ' ' WHERE ProfessorID BETWEEN 10 AND 309"))
+        late = conn.execute(text('SELECT MAX(ChangeID) FROM CatalogChanges')).scalar() - 250
+        conn.execute(text('DELETE FROM CatalogChanges WHERE ChangeID = :id'), {'id': late})
+    catalog.refresh(engine)
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE Professors SET Name = 'Late Professor' WHERE ProfessorID = 9"))
+        conn.execute(text('UPDATE CatalogChanges SET ChangeID = :id WHERE ChangeID = (SELECT MAX(ChangeID) FROM CatalogChanges)'),
+                     {'id': late})
+    loads = catalog.full_loads
+    catalog.refresh(engine)
+    print('refresh after a change below the lookback: {} gaps, {} full loads'.format(
+        catalog.gaps, catalog.full_loads - loads))
+    expect(catalog.professor(9).Name == 'Late Professor', 'a change below the lookback was missed')
+    with engine.connect() as conn:
+        expect(snapshot_rows(catalog) == table_rows(conn), 'catalog does not match the tables after the late change')
+
+    # pruned changes: the ones a worker had not read yet make it reload
+    catalog_module.CATALOG_CHANGE_RETENTION = 100
+    catalog.prune(engine)
+    with engine.connect() as conn:
+        left = conn.execute(text('SELECT COUNT(*) FROM CatalogChanges')).scalar()
+    print('changes left after pruning: {}'.format(left))
+    expect(left == 100, 'pruning left {} changes'.format(left))
+    stale.refresh(engine)
+    expect(stale.gaps == 1 and stale.professor(9).Name == 'Late Professor',
+           'a worker behind the pruned changes did not reload')
+    catalog.refresh(engine)
+    expect(catalog.gaps == 1, 'pruning made an up-to-date worker reload')
+
+    # through the app: a write in this process is visible at once
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = app.test_client()
+        client.get('/edit_professor/1')
+        client.post('/update_professor/8', data={'name': 'Edited Professor', 'department': 'CS', 'bio': ''})
+        page = client.get('/edit_professor/8').get_data(as_text=True)
+        found = client.post('/', data={'department': 'CS', 'professor': 'Edited Professor'}).get_data(as_text=True)
+    expect('value="Edited Professor"' in page, 'edit_professor did not see the update')
+    expect('Edited Professor' in found, 'department search did not see the update')
+    repeat = 2000
+    started = time.perf_counter()
+    for index in range(repeat):
+        client.get('/edit_professor/{}'.format(ids[index]))
+    print('/edit_professor: {:.0f} us per request'.format((time.perf_counter() - started) / repeat * 1e6))
+    metrics = client.get('/metrics').get_data(as_text=True)
+    expect('illiniprof_catalog_bytes' in metrics, 'catalog size missing from /metrics')
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
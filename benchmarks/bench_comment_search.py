@@ -0,0 +1,202 @@
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# Review search over a synthetic corpus: the index build, its size, BM25
+# query latency for rare, common and multi-term queries against the LIKE
+# fallback, the cost of indexing a write, and a review added and deleted
+# through the routes showing up in and leaving the results, and the index
+# reconciled with writes its refreshes do not see.
+#
+# datagen's comments draw from 18 words, so every term would be in a third
+# of the corpus; these draw from a Zipf-distributed vocabulary instead.
+SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'ha', 'je', 'ki', 'lo', 'mu', 'na', 'pe', 'qui', 'ro', 'su',
+             'ta', 've', 'wi', 'xo', 'yu', 'za', 'bre', 'cla', 'dro', 'fli', 'gra', 'plo', 'stu']
+
+
+def vocabulary(size):
+    words = list(datagen.WORDS)
+    for length in (2, 3, 4):
+        for parts in itertools.product(SYLLABLES, repeat=length):
+            if len(words) == size:
+                return words
+            words.append(''.join(parts))
+    return words
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def seed_comments(engine, words, count, courses, rng, batch_size=20000):
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    for start in range(0, count, batch_size):
+        rows = []
+        for i in range(min(batch_size, count - start)):
+            content = ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(8, 40)))
+            rows.append({'content': content.capitalize() + '.', 'course_id': rng.randint(1, courses),
+                         'user_id': start + i})
+        with engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO Comments (Content, CourseID, UserID) VALUES (:content, :course_id, :user_id)
+            '''), rows)
+
+
+def timed(fn, queries):
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(query)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[max(int(len(samples) * 0.95) - 1, 0)]
+
+
+def exhaustive(index, terms, limit):
+    # every term scored against every comment, no pruning; summed in the
+    # same order, so the scores match to the last bit
+    postings = sorted((index.postings[term] for term in set(terms) if term in index.postings),
+                      key=lambda posting: -index._idf(posting))
+    scores = {}
+    average = index.total_length / index.documents
+    for posting in postings:
+        index._score(scores, index._idf(posting), posting, average, False)
+    return sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Review search: BM25 inverted index vs LIKE scans')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--like-queries', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    os.environ.setdefault('SECRET_KEY', 'bench-comment-search')
+    app, engine = load_app(args.url or sqlite_url())
+    from search import CommentIndex, comment_index, sql_comment_search, tokenize
+
+    rng = random.Random(1)
+    courses = datagen.seed(engine, professors=1000, ratings=0, comments=0)
+    words = vocabulary(args.vocabulary)
+    started = time.perf_counter()
+    seed_comments(engine, words, args.comments, courses, rng)
+    print('seeded {} comments over {} words in {:.1f} s'.format(args.comments, len(words),
+                                                               time.perf_counter() - started))
+
+    before = rss_mb()
+    index = CommentIndex()
+    started = time.perf_counter()
+    index.build(engine)
+    built = time.perf_counter() - started
+    postings = sum(part.itemsize * len(part) for posting in index.postings.values() for part in posting)
+    print('index built over {} comments, {} terms in {:.1f} s'.format(index.documents, len(index.postings), built))
+    print('postings {:.1f} MB, lengths and live {:.1f} MB, process grew {:.1f} MB'.format(
+        postings / 2 ** 20, (len(index.lengths) * index.lengths.itemsize + len(index.live)) / 2 ** 20,
+        rss_mb() - before))
+
+    by_frequency = sorted(index.postings, key=lambda term: -len(index.postings[term][0]))
+    groups = {
+        'common (top 50)': [[term] for term in by_frequency[:50]],
+        'medium (200-2000)': [[term] for term in by_frequency[200:2000]],
+        'rare (5000+)': [[term] for term in by_frequency[5000:]],
+        'two terms': [[rng.choice(by_frequency[:2000]), rng.choice(by_frequency[200:])] for _ in range(500)],
+        'three terms': [[rng.choice(by_frequency[:100]), rng.choice(by_frequency[100:2000]),
+                         rng.choice(by_frequency[2000:])] for _ in range(500)],
+    }
+    failures = []
+    for name, candidates in groups.items():
+        queries = [' '.join(terms) for terms in rng.sample(candidates, min(args.queries, len(candidates)))]
+        # a fresh index each time: the results cache would answer repeats
+        index._results = {}
+        median, p95 = timed(lambda query: index.search(query), queries)
+        index._results = {}
+        with engine.connect() as conn:
+            like_median, _ = timed(lambda query: sql_comment_search(conn, query), queries[:args.like_queries])
+        mismatched = [query for query in queries[:20]
+                      if index.search(query) != exhaustive(index, tokenize(query), 20)]
+        index._results = {}
+        if mismatched:
+            failures.append('{}: pruned results differ for {}'.format(name, mismatched[:3]))
+        print('{:18} BM25 median {:7.2f} ms  p95 {:7.2f} ms   LIKE median {:8.1f} ms'.format(
+            name, median, p95, like_median))
+
+    repeat = 2000
+    first = index.last_id + 1
+    started = time.perf_counter()
+    for i in range(repeat):
+        index.add(first + i, ' '.join(rng.choices(words[:5000], k=20)))
+    print('add: {:.1f} us per comment'.format((time.perf_counter() - started) / repeat * 1e6))
+    started = time.perf_counter()
+    for i in range(repeat):
+        index.remove(index.last_id - i)
+    print('remove: {:.1f} us per comment'.format((time.perf_counter() - started) / repeat * 1e6))
+
+    # the app's own index, kept current by the write routes
+    del index
+    with contextlib.redirect_stdout(io.StringIO()):
+        comment_index.build(engine)
+        client = app.test_client()
+        client.post('/add_review', data={'score': 5, 'course_id': 1, 'professor_id': 1,
+                                         'comment': 'Zyzzyva lectures were quixotic but fair.'})
+        found = client.get('/api/v1/comments/search?q=zyzzyva+quixotic').get_json()['data']
+        page = client.get('/search_comments?q=quixotic').get_data(as_text=True)
+    if [hit['Snippet'] for hit in found] != ['<mark>Zyzzyva</mark> lectures were <mark>quixotic</mark> but fair.']:
+        failures.append('new review not found: {}'.format(found))
+    elif '<mark>quixotic</mark>' not in page:
+        failures.append('the search page does not show the new review')
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.get('/delete_review/1/{}'.format(found[0]['CommentID']))
+            found = client.get('/api/v1/comments/search?q=zyzzyva').get_json()['data']
+        if found:
+            failures.append('deleted review still found: {}'.format(found))
+
+    # what a refresh cannot see: a comment that commits further below the
+    # newest than the lookback (a write-behind batch), and one deleted by
+    # another worker; a reconcile picks up both
+    top = comment_index.last_id
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO Comments (CommentID, Content, CourseID, UserID) VALUES (:id, :content, 1, 1)'),
+                     {'id': top + 500, 'content': 'Obstreperous labs, every week.'})
+    comment_index.refresh(engine)
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO Comments (CommentID, Content, CourseID, UserID) VALUES (:id, :content, 1, 1)'),
+                     {'id': top + 1, 'content': 'Perspicacious seminar notes.'})
+        conn.execute(text('DELETE FROM Comments WHERE CommentID = :id'), {'id': top + 500})
+    comment_index.refresh(engine)
+    deleted = comment_index.deleted
+    started = time.perf_counter()
+    comment_index.reconcile(engine)
+    print('reconcile: {:.0f} ms'.format((time.perf_counter() - started) * 1000))
+    if [comment_id for comment_id, _ in comment_index.search('perspicacious')] != [top + 1]:
+        failures.append('a comment below the refresh lookback was not picked up')
+    if comment_index.search('obstreperous') or comment_index.deleted != deleted + 1:
+        failures.append("another worker's delete was not dropped")
+
+    if client.get('/api/v1/comments/search').status_code != 400:
+        failures.append('a search without q is not a 400')
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import csv
+import io
+import json
+import random
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+
+def catalog_rows(courses, courses_per_professor, seed=0):
+    rng = random.Random(seed)
+    professors = max(courses // courses_per_professor, 1)
+    for i in range(courses):
+        professor = i % professors
+        department = datagen.DEPARTMENTS[professor % len(datagen.DEPARTMENTS)]
+        yield {'name': '{} {} {}'.format(datagen.FIRST_NAMES[professor % 12], datagen.LAST_NAMES[professor // 12 % 12],
+                                         professor),
+               'department': department,
+               'course_number': '{}{}'.format(department, 100 + i // professors),
+               'title': 'Course {} {}'.format(i, rng.choice(datagen.WORDS))}
+
+
+def as_csv(rows):
+    stream = io.StringIO()
+    writer = csv.DictWriter(stream, fieldnames=['name', 'department', 'course_number', 'title'])
+    writer.writeheader()
+    writer.writerows(rows)
+    stream.seek(0)
+    return stream
+
+
+def as_json(rows):
+    return io.StringIO(json.dumps(list(rows)))
+
+
+def one_by_one(engine, rows):
+    # what add_professor does: one statement per professor and per course
+    started = time.perf_counter()
+    professors = {}
+    with engine.begin() as conn:
+        for row in rows:
+            key = (row['name'], row['department'])
+            if key not in professors:
+                professors[key] = conn.execute(text('''
+                    INSERT INTO Professors (Name, Department, RMP_Link) VALUES (:name, :department, 'none')
+                '''), {'name': row['name'], 'department': row['department']}).lastrowid
+            conn.execute(text('''
+                INSERT INTO Courses (CourseNumber, ProfessorID, Title) VALUES (:course_number, :professor_id, :title)
+            '''), {'course_number': row['course_number'], 'professor_id': professors[key], 'title': row['title']})
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog import throughput')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--courses', type=int, default=200000)
+    parser.add_argument('--courses-per-professor', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    import importer
+
+    baseline_rows = list(catalog_rows(min(args.courses, 20000), args.courses_per_professor, seed=1))
+    baseline = one_by_one(engine, baseline_rows)
+    print('one statement per row      {:8.0f} courses/s'.format(len(baseline_rows) / baseline))
+
+    for format, build in [('csv', as_csv), ('json', as_json)]:
+        stream = build(catalog_rows(args.courses, args.courses_per_professor, seed=2 if format == 'csv' else 3))
+        result = importer.import_catalog(stream, format, chunk_size=args.chunk_size)
+        print('bulk import ({:4})         {:8.0f} courses/s   {} courses, {} professors, {} batches'.format(
+            format, result.courses_per_second, result.courses, result.professors, result.batches))
+
+    again = importer.import_catalog(as_csv(catalog_rows(args.courses, args.courses_per_professor, seed=2)), 'csv',
+                                    chunk_size=args.chunk_size)
+    print('re-import of the same file: {} new professors, {} courses, {} duplicates skipped'.format(
+        again.professors, again.courses, again.duplicates))
+
+
+if __name__ == '__main__':
+    main()
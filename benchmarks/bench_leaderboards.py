@@ -0,0 +1,94 @@
+import argparse
+import statistics
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# The per-request aggregates the leaderboards ran before CourseStats existed
+JOIN_AGGREGATE_QUERIES = {
+    'popular courses': '''
+        SELECT c.CourseID, c.Title, p.Name AS ProfessorName,
+            COUNT(DISTINCT com.CommentID) AS NumberOfComments,
+            COALESCE(AVG(r.Score), 0) AS AverageRating
+        FROM Courses c
+        LEFT JOIN Comments com ON c.CourseID = com.CourseID
+        LEFT JOIN Ratings r ON c.CourseID = r.CourseID
+        JOIN Professors p ON c.ProfessorID = p.ProfessorID
+        GROUP BY c.CourseID, c.Title, p.Name
+        ORDER BY NumberOfComments DESC, AverageRating DESC
+    ''',
+    'professors': '''
+        SELECT c.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName, p.Department, ROUND(AVG(r.Score), 2) AS AverageRating
+        FROM Courses c
+        JOIN Professors p ON c.ProfessorID = p.ProfessorID
+        JOIN Ratings r ON c.CourseID = r.CourseID
+        GROUP BY c.CourseID, c.Title, p.ProfessorID, p.Name, p.Department
+        ORDER BY AverageRating DESC
+    ''',
+}
+
+STATS_QUERIES = {
+    'popular courses': '''
+        SELECT c.CourseID, c.Title, p.Name AS ProfessorName,
+            s.CommentCount AS NumberOfComments,
+            COALESCE(s.AverageRating, 0) AS AverageRating
+        FROM CourseStats s
+        JOIN Courses c ON c.CourseID = s.CourseID
+        JOIN Professors p ON c.ProfessorID = p.ProfessorID
+        ORDER BY s.CommentCount DESC, s.AverageRating DESC
+    ''',
+    'professors': '''
+        SELECT c.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName, p.Department, ROUND(s.AverageRating, 2) AS AverageRating
+        FROM CourseStats s
+        JOIN Courses c ON c.CourseID = s.CourseID
+        JOIN Professors p ON c.ProfessorID = p.ProfessorID
+        WHERE s.RatingCount > 0
+        ORDER BY s.AverageRating DESC
+    ''',
+}
+
+
+def same_rows(expected, actual):
+    # compare per CourseID; averages only up to float summation noise
+    expected = {row[0]: row for row in expected}
+    actual = {row[0]: row for row in actual}
+    return expected.keys() == actual.keys() and all(
+        expected[key][3] == actual[key][3] and abs(float(expected[key][-1]) - float(actual[key][-1])) < 0.006
+        for key in expected)
+
+
+def time_query(engine, query, repeat):
+    samples = []
+    with engine.connect() as conn:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            rows = conn.execute(text(query)).fetchall()
+            samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Leaderboard latency: join aggregates vs CourseStats')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--professors', type=int, default=2000)
+    parser.add_argument('--ratings', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    datagen.seed(engine, professors=args.professors, ratings=args.ratings, comments=args.comments)
+
+    for name in JOIN_AGGREGATE_QUERIES:
+        before, expected = time_query(engine, JOIN_AGGREGATE_QUERIES[name], args.repeat)
+        after, actual = time_query(engine, STATS_QUERIES[name], args.repeat)
+        counts_match = same_rows(expected, actual)
+        print('{:<16} join aggregate {:9.2f} ms   CourseStats {:8.2f} ms   {:6.1f}x   rows match: {}'.format(
+            name, before, after, before / after, counts_match))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import random
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# The per-professor average as GetProfessorAverageScore computed it (the
+# procedure body; SQLite has no procedures) against the ProfessorStats read
+# professor_detail does now, and the per-course averages professor_bio
+# computed with AVG against CourseStats. Few professors with many ratings
+# each is the case the old queries scale worst with.
+PROCEDURE_QUERY = text('''
+    SELECT Pr.Name AS ProfessorName, Pr.Department, AVG(OverallCourseScore) AS AvgProfessorScore
+    FROM (
+        SELECT C.ProfessorID, AVG(R.Score) AS OverallCourseScore
+        FROM Courses C
+        JOIN Ratings R ON C.CourseID = R.CourseID
+        WHERE C.ProfessorID = :prof_id
+        GROUP BY C.CourseID
+    ) AS CourseScores
+    JOIN Professors Pr ON CourseScores.ProfessorID = Pr.ProfessorID
+    WHERE Pr.ProfessorID = :prof_id
+    GROUP BY Pr.ProfessorID
+''')
+
+STATS_QUERY = text('''
+    SELECT p.Name AS ProfessorName, p.Department, s.AverageScore AS AvgProfessorScore
+    FROM Professors p
+    JOIN ProfessorStats s ON s.ProfessorID = p.ProfessorID
+    WHERE p.ProfessorID = :prof_id
+''')
+
+COURSE_AVG_QUERY = text('''
+    SELECT r.CourseID, AVG(r.Score) AS AverageRating
+    FROM Ratings r
+    JOIN Courses c ON c.CourseID = r.CourseID
+    WHERE c.ProfessorID = :prof_id
+    GROUP BY r.CourseID
+''')
+
+
+def per_call(engine, query, professors, repeat):
+    rng = random.Random(0)
+    with engine.connect() as conn:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(query, {'prof_id': rng.randint(1, professors)}).fetchall()
+        return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Professor averages: nested GROUP BY vs maintained aggregates')
+    parser.add_argument('--ratings', default='10000,100000,1000000', help='comma-separated total rating counts')
+    parser.add_argument('--professors', type=int, default=50)
+    parser.add_argument('--courses-per-professor', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    url = sqlite_url()
+    _, engine = load_app(url)
+    import app as app_module
+    import stats
+
+    print('{:>9} {:>12} {:>14} {:>14} {:>14} {:>14} {:>12}'.format(
+        'ratings', 'per prof', 'procedure ms', 'stats ms', 'course AVG ms', 'CourseStats ms', 'insert ms'))
+    seeded = 0
+    for ratings in [int(value) for value in args.ratings.split(',')]:
+        if not seeded:
+            datagen.seed(engine, professors=args.professors, courses_per_professor=args.courses_per_professor,
+                         ratings=ratings, comments=0)
+        else:
+            with engine.begin() as conn:
+                conn.execute(text('''
+                    INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID)
+                    VALUES (:score, 1, :course_id, :user_id)
+                '''), [{'score': random.randint(10, 50) / 10,
+                        'course_id': random.randint(1, args.professors * args.courses_per_professor),
+                        'user_id': seeded + i} for i in range(ratings - seeded)])
+        seeded = ratings
+
+        # what a single rating costs now that it updates three aggregates
+        with engine.begin() as conn:
+            started = time.perf_counter()
+            for i in range(200):
+                conn.execute(text('INSERT INTO Ratings (Score, CourseID, UserID) VALUES (4, :course_id, 0)'),
+                             {'course_id': i % (args.professors * args.courses_per_professor) + 1})
+            insert_ms = (time.perf_counter() - started) / 200 * 1000
+        seeded += 200
+
+        def course_stats(conn, prof_id):
+            return app_module.query_course_ratings(conn, prof_id)
+
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            rng = random.Random(0)
+            for _ in range(args.repeat):
+                course_stats(conn, rng.randint(1, args.professors))
+            course_stats_ms = (time.perf_counter() - started) / args.repeat * 1000
+
+        print('{:9} {:12} {:14.3f} {:14.3f} {:14.3f} {:14.3f} {:12.3f}'.format(
+            seeded, seeded // args.professors,
+            per_call(engine, PROCEDURE_QUERY, args.professors, args.repeat),
+            per_call(engine, STATS_QUERY, args.professors, args.repeat),
+            per_call(engine, COURSE_AVG_QUERY, args.professors, args.repeat),
+            course_stats_ms, insert_ms))
+
+    problems = stats.check(engine)
+    print('stats check: {} problems'.format(len(problems)))
+    for problem in problems[:10]:
+        print('  ' + problem)
+
+
+if __name__ == '__main__':
+    main()
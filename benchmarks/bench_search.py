@@ -0,0 +1,84 @@
+import argparse
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+
+def old_like_query(professor, course_number):
+    # the string-formatted query /search used to build on every request
+    query = '''
+        SELECT DISTINCT p.ProfessorID, p.Name as ProfessorName
+        FROM Professors p
+        JOIN Courses c ON p.ProfessorID = c.ProfessorID
+    '''
+    if professor and course_number:
+        query += "WHERE p.Name LIKE '%{}%' AND c.CourseNumber LIKE '%{}%'".format(professor, course_number)
+    elif professor:
+        query += "WHERE p.Name LIKE '%{}%'".format(professor)
+    elif course_number:
+        query += "WHERE c.CourseNumber LIKE '%{}%'".format(course_number)
+    return query
+
+
+def timed(fn, queries):
+    samples = []
+    results = []
+    for professor, course_number in queries:
+        started = time.perf_counter()
+        results.append(fn(professor, course_number))
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Professor search: n-gram index vs LIKE scans')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--professors', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    from search import SearchIndex, sql_search
+
+    datagen.seed(engine, professors=args.professors, ratings=0, comments=0)
+    index = SearchIndex()
+    started = time.perf_counter()
+    index.build(engine)
+    print('index built over {} professors in {:.2f} s'.format(len(index.names), time.perf_counter() - started))
+
+    rng = random.Random(1)
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(datagen.FIRST_NAMES + datagen.LAST_NAMES)
+        start = rng.randint(0, len(name) - 2)
+        fragment = name[start:start + rng.randint(2, 5)]
+        course = rng.choice(datagen.DEPARTMENTS) + str(rng.randint(1, 4))
+        queries.append(rng.choice([(fragment, None), (None, course), (fragment, course)]))
+
+    with engine.connect() as conn:
+        like_ms, like_p99, like_results = timed(lambda p, c: conn.execute(text(old_like_query(p, c))).fetchall(), queries)
+        bound_ms, bound_p99, _ = timed(lambda p, c: sql_search(conn, p, c), queries)
+    # the first pass fills the per-query caches (name order of a course's
+    # professors and of word-prefix matches) that a write clears
+    cold_ms, cold_p99, limited = timed(lambda p, c: index.search(p, c), queries)
+    index_ms, index_p99, _ = timed(lambda p, c: index.search(p, c), queries)
+    _, _, index_results = timed(lambda p, c: index.search(p, c, limit=None), queries)
+
+    same = all({row[0] for row in a} == {row[0] for row in b} for a, b in zip(like_results, index_results))
+    ranked = all(a == b[:len(a)] for a, b in zip(limited, index_results))
+    print('LIKE (old, unbounded)   median {:8.3f} ms   p99 {:8.3f} ms'.format(like_ms, like_p99))
+    print('bound SQL fallback      median {:8.3f} ms   p99 {:8.3f} ms'.format(bound_ms, bound_p99))
+    print('n-gram index, cold      median {:8.3f} ms   p99 {:8.3f} ms'.format(cold_ms, cold_p99))
+    print('n-gram index (top 100)  median {:8.3f} ms   p99 {:8.3f} ms'.format(index_ms, index_p99))
+    print('index returns the same professors as LIKE: {}'.format(same))
+    print('top 100 is the head of the full ranking: {}'.format(ranked))
+
+
+if __name__ == '__main__':
+    main()
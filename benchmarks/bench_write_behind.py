@@ -0,0 +1,75 @@
+import argparse
+import random
+
+from sqlalchemy import text
+
+from harness import load_app, run_concurrently, sqlite_url
+import datagen
+
+
+def check(engine):
+    with engine.connect() as conn:
+        drift = conn.execute(text('''
+            SELECT COUNT(*) FROM CourseStats s
+            WHERE s.RatingCount != (SELECT COUNT(r.Score) FROM Ratings r WHERE r.CourseID = s.CourseID)
+               OR ABS(COALESCE(s.AverageRating, 0) - COALESCE((SELECT AVG(r.Score) FROM Ratings r WHERE r.CourseID = s.CourseID), 0)) > 1e-9
+        ''')).scalar()
+        duplicates = conn.execute(text('''
+            SELECT COUNT(*) FROM (
+                SELECT c.UserID, c.CourseID FROM Comments c WHERE c.UserID >= 1000000
+                GROUP BY c.UserID, c.CourseID HAVING COUNT(*) > 1
+            ) dup
+        ''')).scalar()
+    return drift, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rating and review submissions: inline vs write-behind')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--hot-courses', type=int, default=5)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    import app as app_module
+    import writebehind
+
+    datagen.seed(engine, professors=50, ratings=20000, comments=5000)
+    client = app.test_client()
+    client.get('/')
+
+    for mode in ('inline', 'write-behind'):
+        writebehind.WRITE_BEHIND = mode == 'write-behind'
+        if writebehind.WRITE_BEHIND:
+            writebehind.start(on_flush=app_module.writes_applied)
+        rng = random.Random(mode)
+        clients = [app.test_client() for _ in range(args.clients)]
+        counter = [0]
+
+        def worker(index):
+            course_id = rng.randint(1, args.hot_courses)
+            counter[0] += 1
+            if counter[0] % 2:
+                clients[index].post('/add_rating', data={'rating': rng.randint(1, 5), 'course_id': course_id,
+                                                         'professor_id': 1})
+            else:
+                # a small pool of reviewers so many submissions are repeats
+                with clients[index].session_transaction() as session:
+                    session['user_id'] = 1000000 + rng.randint(0, 200)
+                clients[index].post('/add_review', data={'score': rng.randint(1, 5), 'course_id': course_id,
+                                                         'professor_id': 1, 'comment': datagen.comment_text(rng) + ' ok'})
+
+        throughput, errors = run_concurrently(worker, args.clients, args.duration)
+        if writebehind.WRITE_BEHIND:
+            queue = writebehind.get_queue()
+            while queue.pending():
+                queue.flush()
+        drift, duplicates = check(engine)
+        print('{:13} {:8.0f} submissions/s  {} errors  stats drift: {} courses  duplicate reviews: {}'.format(
+            mode, throughput, errors, drift, duplicates))
+    print('queue:', writebehind.get_queue().stats.as_dict())
+
+
+if __name__ == '__main__':
+    main()
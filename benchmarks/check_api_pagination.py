@@ -0,0 +1,88 @@
+import argparse
+import sys
+
+from sqlalchemy import event, text
+
+from harness import load_app, sqlite_url
+import datagen
+
+
+def walk(client, path, limit):
+    rows = []
+    pages = 0
+    cursor = None
+    while True:
+        url = '{}?limit={}'.format(path, limit) + ('&after=' + cursor if cursor else '')
+        body = client.get(url).get_json()
+        rows.extend(body['data'])
+        pages += 1
+        cursor = body['next']
+        if cursor is None:
+            return rows, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Walk the JSON API page by page and check it against one query')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--limit', type=int, default=37)
+    args = parser.parse_args()
+
+    app, engine = load_app(args.url or sqlite_url())
+    datagen.seed(engine, professors=200, ratings=3000, comments=3000)
+    client = app.test_client()
+    client.get('/')
+    ok = True
+
+    with engine.connect() as conn:
+        expected_courses = [row[0] for row in conn.execute(text('''
+            SELECT CourseID FROM CourseStats
+            ORDER BY CommentCount DESC, COALESCE(AverageRating, -1) DESC, CourseID DESC
+        '''))]
+        expected_rated = [row[0] for row in conn.execute(text('''
+            SELECT CourseID FROM CourseStats WHERE RatingCount > 0 ORDER BY AverageRating DESC, CourseID DESC
+        '''))]
+        prof_id = conn.execute(text('SELECT ProfessorID FROM Courses ORDER BY CourseID LIMIT 1')).scalar()
+        expected_comments = [row[0] for row in conn.execute(text('''
+            SELECT com.CommentID FROM Comments com JOIN Courses c ON c.CourseID = com.CourseID
+            WHERE c.ProfessorID = :prof_id ORDER BY com.CommentID DESC
+        '''), {'prof_id': prof_id})]
+
+    for path, key, expected in [('/api/v1/courses', 'CourseID', expected_courses),
+                                ('/api/professors', 'CourseID', expected_rated),
+                                ('/api/v1/professors/{}/comments'.format(prof_id), 'CommentID', expected_comments)]:
+        rows, pages = walk(client, path, args.limit)
+        same = [row[key] for row in rows] == expected
+        ok = ok and same
+        print('{:40} {:6} rows in {:4} pages, matches a single ordered query: {}'.format(path, len(rows), pages, same))
+
+    first = client.get('/api/v1/courses?limit=10')
+    repeat = client.get('/api/v1/courses?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    course_id = first.get_json()['data'][0]['CourseID']
+    client.post('/add_rating', data={'rating': 5, 'course_id': course_id, 'professor_id': 1})
+    changed = client.get('/api/v1/courses?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    print('repeat poll: {}, after a write: {}'.format(repeat.status_code, changed.status_code))
+    ok = ok and repeat.status_code == 304 and changed.status_code == 200
+
+    # the rows are read while the body streams, after the request's hooks;
+    # its statement count still has to include them
+    def counted():
+        for line in client.get('/metrics').get_data(as_text=True).splitlines():
+            if line.startswith('illiniprof_request_sql_statements_sum{endpoint="api.courses"}'):
+                return float(line.split()[-1])
+        return 0
+
+    before = counted()
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    response = client.get('/api/v1/courses?limit=10&after=' + first.get_json()['next'])
+    response.get_data()
+    # a WSGI server closes the response once it has sent it
+    response.close()
+    issued = len(statements)
+    print('streamed page: {} statements issued, {:.0f} counted'.format(issued, counted() - before))
+    ok = ok and issued > 0 and counted() - before == issued
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+from sqlalchemy import event, text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# Template pages answer a revalidation with 304 and no database or template
+# work, change their ETag after a write, and serve unchanged fragments from
+# the cache. Checked against the Flask app and the async entry point.
+PAGES = ['/professors', '/popular_courses', '/insightful_courses', '/professor/1', '/professor_detail/1']
+ASYNC_PAGES = ['/professors', '/popular_courses', '/professor/1']
+
+
+def asgi_get(application, path, headers=()):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'',
+             'scheme': 'http', 'server': ('localhost', 80),
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(application(scope, receive, send))
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode('latin-1'): value.decode('latin-1') for name, value in start['headers']}, body
+
+
+def main():
+    os.environ['CACHE_BACKEND'] = 'memory'
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    app, engine = load_app(sqlite_url())
+    datagen.seed(engine, **datagen.SCALES['small'])
+    client = app.test_client()
+    client.get('/')
+    import asgi
+
+    statements = [0]
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.__setitem__(0, statements[0] + 1))
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    def get(path, headers=()):
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(path, headers=list(headers))
+        return response.status_code, response.headers, response.get_data()
+
+    def post(path, data):
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.post(path, data=data)
+
+    # seeded rows bypass the routes, so no version has been bumped yet
+    post('/add_rating', {'rating': 4, 'course_id': 1, 'professor_id': 1})
+
+    for name, request, pages in (('sync', get, PAGES), ('async', lambda *a: asgi_get(asgi.app, *a), ASYNC_PAGES)):
+        for path in pages:
+            status, headers, body = request(path)
+            expect(status == 200 and headers.get('etag'), '{} {}: no ETag on 200 ({})'.format(name, path, status))
+            # whole-second dates cannot tell two writes in one second apart
+            expect('last-modified' not in {header.lower() for header in headers.keys()},
+                   '{} {}: Last-Modified sent'.format(name, path))
+            tag = headers.get('etag')
+
+            # let the cached versions expire, so the 304 below is the cold case
+            time.sleep(float(os.environ.get('VERSION_TTL', 1)))
+            before = statements[0]
+            status, _, body = request(path, [('If-None-Match', tag)])
+            expect(status == 304 and not body, '{} {}: If-None-Match gave {}'.format(name, path, status))
+            expect(statements[0] - before <= 1, '{} {}: 304 ran {} statements'.format(
+                name, path, statements[0] - before))
+            before = statements[0]
+            status, _, _ = request(path, [('If-None-Match', tag)])
+            expect(status == 304, '{} {}: warm If-None-Match gave {}'.format(name, path, status))
+            expect(statements[0] == before, '{} {}: warm 304 ran {} statements'.format(
+                name, path, statements[0] - before))
+
+            post('/add_rating', {'rating': 4, 'course_id': 1, 'professor_id': 1})
+            status, headers, _ = request(path, [('If-None-Match', tag)])
+            expect(status == 200 and headers.get('etag') != tag,
+                   '{} {}: still {} with the same ETag after a rating'.format(name, path, status))
+        print('{}: {} pages checked'.format(name, len(pages)))
+
+    status, headers, _ = get('/professor/999999')
+    expect(status != 304 and 'etag' not in headers, 'missing professor was given an ETag')
+
+    # the professor a write changes comes from the course, not the form
+    with engine.connect() as conn:
+        course_id, owner = conn.execute(text('''
+            SELECT CourseID, ProfessorID FROM Courses WHERE ProfessorID NOT IN (1, 2) ORDER BY CourseID LIMIT 1
+        ''')).one()
+    # a user reviews a course once, so only the rating goes in without one
+    for path, data in (('/add_rating', {'rating': 4, 'professor_id': 2}), ('/add_rating', {'rating': 4}),
+                       ('/add_review', {'score': 4, 'comment': 'a review with the wrong professor', 'professor_id': 2})):
+        page = '/professor/{}'.format(owner)
+        tag = get(page)[1]['etag']
+        post(path, dict(data, course_id=course_id))
+        status, headers, _ = get(page, [('If-None-Match', tag)])
+        expect(status == 200 and headers.get('etag') != tag, '{} with professor_id {} left professor {} at {}'.format(
+            path, data.get('professor_id'), owner, status))
+
+    # a fragment is rendered once per data version, and a write to one
+    # professor does not retire another professor's fragments
+    from cache import get_cache
+    cache = get_cache()
+
+    def fragments(prof_id):
+        prefix = 'professor:{}:fragment:'.format(prof_id)
+        return sorted(key for key in list(cache._entries) if key.startswith(prefix))
+
+    get('/professor/1')
+    get('/professor/2')
+    first, second = fragments(1), fragments(2)
+    expect(first and second, 'professor_bio fragments were not cached')
+    post('/add_review', {'score': 4, 'course_id': 1, 'professor_id': 1, 'comment': 'a long enough review'})
+    get('/professor/1')
+    get('/professor/2')
+    expect(fragments(2) == second, 'a review for professor 1 retired professor 2 fragments')
+    expect(set(fragments(1)) - set(first), 'a review did not retire the professor fragments')
+
+    repeat = 200
+    for path in PAGES:
+        get(path)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            get(path)
+        rendered = (time.perf_counter() - started) / repeat * 1000
+        tag = get(path)[1]['etag']
+        started = time.perf_counter()
+        for _ in range(repeat):
+            get(path, [('If-None-Match', tag)])
+        revalidated = (time.perf_counter() - started) / repeat * 1000
+        print('{:22} 200 {:7.3f} ms   304 {:7.3f} ms'.format(path, rendered, revalidated))
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import contextlib
+import io
+import os
+import sys
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+# A catalog import that adds a course to a professor who is already there
+# changes that professor's pages: a fresh request shows the course and a
+# revalidation with the ETag from before the import gets the new page.
+PAGES = ['/professor/1']
+
+
+def main():
+    os.environ['CACHE_BACKEND'] = 'memory'
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    app, engine = load_app(sqlite_url())
+    datagen.seed(engine, **datagen.SCALES['small'])
+    client = app.test_client()
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    def get(path, headers=()):
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(path, headers=list(headers))
+        return response.status_code, response.headers, response.get_data(as_text=True)
+
+    before = {}
+    for path in PAGES:
+        get(path)
+        status, headers, body = get(path)
+        expect(status == 200 and headers.get('ETag'), '{} has no ETag'.format(path))
+        expect('NEW999' not in body, '{} already shows the course'.format(path))
+        before[path] = headers.get('ETag')
+
+    with engine.connect() as conn:
+        name, department = conn.execute(text('SELECT Name, Department FROM Professors WHERE ProfessorID = 1')).one()
+    upload = 'name,department,course_number,title\n"{}","{}",NEW999,Imported Course\n'.format(name, department)
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = client.post('/import_catalog', data={'catalog': (io.BytesIO(upload.encode()), 'catalog.csv')},
+                               content_type='multipart/form-data')
+    expect(response.status_code == 200 and b'An error occurred' not in response.data, 'the import failed')
+    with engine.connect() as conn:
+        added = conn.execute(text("SELECT COUNT(*) FROM Courses WHERE ProfessorID = 1 AND CourseNumber = 'NEW999'")).scalar()
+    expect(added == 1, 'the course was not imported for professor 1')
+
+    for path in PAGES:
+        status, headers, body = get(path)
+        expect('NEW999' in body, '{} does not show the imported course'.format(path))
+        expect(headers.get('ETag') != before[path], '{} kept its ETag after the import'.format(path))
+        status, _, _ = get(path, [('If-None-Match', before[path])])
+        expect(status == 200, '{} answered the ETag from before the import with {}'.format(path, status))
+        print('{}: ETag {} -> {}'.format(path, before[path], headers.get('ETag')))
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import os
+import sys
+
+from sqlalchemy import event, text
+
+from harness import load_app, sqlite_url
+
+
+def main():
+    # professor_bio should issue the same number of statements no matter how
+    # many courses the professor teaches
+    # the catalog checks for changes on every request, so it picks up the
+    # rows inserted below straight away
+    os.environ['CATALOG_REFRESH'] = '0'
+    app, engine = load_app(sqlite_url())
+    app.testing = True
+    client = app.test_client()
+    # the first requests run the app's one-off initialization queries and
+    # load the catalog
+    client.get('/')
+    client.get('/edit_professor/1')
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    counts = {}
+    for professor_id, course_count in enumerate((1, 10, 50), start=1):
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO Professors (ProfessorID, Name, Department) VALUES (:id, 'Prof', 'CS')"), {'id': professor_id})
+            for i in range(course_count):
+                course_id = conn.execute(text('''
+                    INSERT INTO Courses (CourseNumber, ProfessorID, Title) VALUES (:number, :id, 'Title')
+                '''), {'number': 'CS{}'.format(i), 'id': professor_id}).lastrowid
+                conn.execute(text('''
+                    INSERT INTO Comments (Content, CourseID, UserID) VALUES ('a long enough review', :course_id, 1)
+                '''), [{'course_id': course_id}] * 3)
+                conn.execute(text('INSERT INTO Ratings (Score, CourseID, UserID) VALUES (4, :course_id, 1)'), {'course_id': course_id})
+
+        del statements[:]
+        response = client.get('/professor/{}'.format(professor_id))
+        assert response.status_code == 200 and b'An error occurred' not in response.data
+        counts[course_count] = len(statements)
+        print('{:3} courses: {} statements'.format(course_count, counts[course_count]))
+
+    if len(set(counts.values())) != 1:
+        print('statement count grows with the number of courses')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+from harness import load_app, sqlite_url
+import datagen
+
+# The client and course buckets turn a burst into 429s with Retry-After, a
+# write turned away by one bucket spends no token from the other, clients
+# behind the proxy are told apart by the hop it added to X-Forwarded-For,
+# the shared backend holds one limit across processes, admission control
+# sheds concurrent writes with 503 without spending their tokens, and the
+# rejections are counted on /metrics.
+
+
+def take_shared(path, count):
+    import ratelimit
+    buckets = ratelimit.SharedBuckets(path)
+    return sum(buckets.take('client:shared', 0.0001, 50)[0] for _ in range(count))
+
+
+def main():
+    os.environ.update({'CLIENT_WRITE_RATE': '1', 'CLIENT_WRITE_BURST': '5', 'COURSE_WRITE_RATE': '0.01',
+                       'COURSE_WRITE_BURST': '8', 'WRITE_CONCURRENCY': '1', 'SECRET_KEY': 'check-rate-limits',
+                       'SLOW_QUERY_MS': '60000', 'PROXY_HOPS': '1'})
+    app, engine = load_app(sqlite_url())
+    datagen.seed(engine, **datagen.SCALES['small'])
+    import ratelimit
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    def rate(client, course_id, address, forwarded_for=None):
+        headers = {'X-Forwarded-For': forwarded_for} if forwarded_for else {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            return client.post('/add_rating', data={'rating': 4, 'course_id': course_id, 'professor_id': 1},
+                               environ_base={'REMOTE_ADDR': address}, headers=headers)
+
+    client = app.test_client()
+    statuses = [rate(client, index + 1, '10.0.0.1').status_code for index in range(7)]
+    print('one client, 7 ratings:', statuses)
+    expect(statuses == [302] * 5 + [429] * 2, 'client burst of 5 not enforced')
+    expect(rate(client, 1, '10.0.0.1').headers.get('Retry-After') == '1', 'no Retry-After on 429')
+    time.sleep(1.05)
+    expect(rate(client, 1, '10.0.0.1').status_code == 302, 'client bucket did not refill')
+
+    statuses = [rate(client, 100, '10.0.1.{}'.format(index)).status_code for index in range(10)]
+    print('ten clients, one course:', statuses)
+    expect(statuses == [302] * 8 + [429] * 2, 'course burst of 8 not enforced')
+    statuses = [rate(client, 100, '10.0.1.20').status_code for _ in range(5)]
+    statuses += [rate(client, 101, '10.0.1.20').status_code for _ in range(5)]
+    print('a full course, then another course:', statuses)
+    expect(statuses == [429] * 5 + [302] * 5, 'a course 429 spent the client bucket')
+
+    # every request comes from the proxy; the client is the address it added,
+    # whatever the client put to the left of it
+    statuses = [rate(client, 300 + index, '10.9.9.9', '10.0.6.{}'.format(index)).status_code for index in range(10)]
+    print('ten clients behind one proxy:', statuses)
+    expect(statuses == [302] * 10, 'clients behind the proxy share a bucket')
+    statuses = [rate(client, 400 + index, '10.9.9.9', '10.0.6.{}, 10.0.7.1'.format(index)).status_code
+                for index in range(7)]
+    expect(statuses == [302] * 5 + [429] * 2, 'a forged X-Forwarded-For entry got its own bucket: {}'.format(statuses))
+    statuses = [client.get('/delete_review/1/999999', environ_base={'REMOTE_ADDR': '10.0.2.1'}).status_code
+                for _ in range(6)]
+    expect(statuses == [302] * 5 + [429], 'delete_review is not limited: {}'.format(statuses))
+
+    # 4 processes spending one shared bucket of 50
+    path = os.path.join(tempfile.mkdtemp(prefix='illiniprof-limits-'), 'rate_limits.db')
+    ratelimit.SharedBuckets(path)
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        allowed = sum(pool.starmap(take_shared, [(path, 40)] * 4))
+    print('shared bucket of 50, 160 takes from 4 processes: {} allowed'.format(allowed))
+    expect(allowed == 50, 'shared backend allowed {} of a burst of 50'.format(allowed))
+
+    # with every write slowed down, a second concurrent write is shed
+    def slow(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('INSERT'):
+            time.sleep(0.2)
+
+    event.listen(engine, 'before_cursor_execute', slow)
+    results = []
+
+    def submit(index):
+        results.append(rate(app.test_client(), 200 + index, '10.0.3.{}'.format(index)).status_code)
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    event.remove(engine, 'before_cursor_execute', slow)
+    print('4 concurrent writes, WRITE_CONCURRENCY=1:', sorted(results))
+    expect(results.count(302) >= 1 and results.count(503) >= 1, 'concurrent writes were not shed')
+
+    # a shed write spends no token: the client still has its whole burst
+    ratelimit._writes.acquire()
+    statuses = [rate(client, 500, '10.0.4.1').status_code for _ in range(7)]
+    ratelimit._writes.release()
+    statuses += [rate(client, 500, '10.0.4.1').status_code for _ in range(6)]
+    print('7 shed writes, then 6 more:', statuses)
+    expect(statuses == [503] * 7 + [302] * 5 + [429], 'shed writes spent tokens: {}'.format(statuses))
+
+    text = client.get('/metrics').get_data(as_text=True)
+    for line in ('illiniprof_rate_limited_total{endpoint="add_rating",limit="client"}',
+                 'illiniprof_rate_limited_total{endpoint="add_rating",limit="course"}',
+                 'illiniprof_shed_total{endpoint="add_rating",reason="concurrency"}'):
+        expect(line in text, 'missing from /metrics: ' + line)
+
+    repeat = 20000
+    for name, buckets in (('memory', ratelimit.MemoryBuckets()), ('shared', ratelimit.SharedBuckets(path))):
+        started = time.perf_counter()
+        for index in range(repeat):
+            buckets.take('client:{}'.format(index % 1000), 1, 10)
+        print('{:6} take: {:.1f} us'.format(name, (time.perf_counter() - started) / repeat * 1e6))
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
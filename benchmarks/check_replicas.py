@@ -0,0 +1,178 @@
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event, text
+
+from check_conditional_get import asgi_get
+from harness import load_app, sqlite_url
+import datagen
+
+# Two SQLite copies of a seeded primary stand in for replicas that stopped
+# replicating: reads from anonymous clients are spread over them, writes
+# only reach the primary, and the client that wrote sees its write until
+# READ_YOUR_WRITES_SECONDS have passed. Once the replicas catch up, nothing
+# cached from them while they were behind is served.
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix='illiniprof-replicas-')
+    primary = os.path.join(directory, 'primary.db')
+    copies = [os.path.join(directory, 'replica{}.db'.format(i)) for i in (1, 2)]
+    os.environ['REPLICA_DATABASE_URLS'] = ','.join(sqlite_url(path) for path in copies)
+    os.environ['READ_YOUR_WRITES_SECONDS'] = '1'
+    os.environ['CACHE_BACKEND'] = 'memory'
+    os.environ['SECRET_KEY'] = 'check-replicas'
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    app, engine = load_app(sqlite_url(primary))
+    datagen.seed(engine, **datagen.SCALES['small'])
+    with engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    engine.dispose()
+    for path in copies:
+        shutil.copy(primary, path)
+
+    import db
+    replicas = db.get_replica_engines()
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE Professors SET Name = 'Primary Name' WHERE ProfessorID = 1"))
+    for replica in replicas:
+        with replica.begin() as conn:
+            conn.execute(text("UPDATE Professors SET Name = 'Replica Name' WHERE ProfessorID = 1"))
+
+    statements = {}
+    for name, target in [('primary', engine)] + [('replica{}'.format(i), r) for i, r in enumerate(replicas, 1)]:
+        statements[name] = []
+        event.listen(target, 'before_cursor_execute',
+                     lambda *args, name=name: statements[name].append(args[2].lstrip().split(None, 1)[0].upper()))
+
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    def counts():
+        return {name: len(seen) for name, seen in statements.items()}
+
+    def request(client, method, path, data=None):
+        before = counts()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.open(path, method=method, data=data)
+        after = counts()
+        return response, {name: after[name] - before[name] for name in after}
+
+    import asgi
+    from db import get_async_engine, get_async_replica_engines
+    async_statements = {}
+    for name, target in [('primary', get_async_engine())] + [
+            ('replica{}'.format(i), r) for i, r in enumerate(get_async_replica_engines(), 1)]:
+        async_statements[name] = [0]
+        event.listen(target.sync_engine, 'before_cursor_execute',
+                     lambda *args, seen=async_statements[name]: seen.__setitem__(0, seen[0] + 1))
+
+    def async_counts():
+        return {name: seen[0] for name, seen in async_statements.items()}
+
+    reader, writer = app.test_client(), app.test_client()
+    reader.get('/')
+    # the search indexes build from the primary in the background; let them
+    # finish before counting which engine each request used
+    from search import comment_index, search_index
+    while comment_index._building or search_index._building:
+        time.sleep(0.05)
+    pages = ['/professors', '/popular_courses', '/insightful_courses', '/professor_detail/1',
+             '/api/v1/courses?limit=10']
+    for index in range(20):
+        _, used = request(reader, 'GET', '/professor/{}'.format(index % 5 + 2))
+        expect(used['primary'] == 0, 'an anonymous read used the primary: {}'.format(used))
+    for path in pages:
+        _, used = request(reader, 'GET', path)
+        expect(used['primary'] == 0, '{} used the primary: {}'.format(path, used))
+    spread = {name: len([s for s in statements[name] if s == 'SELECT']) for name in ('replica1', 'replica2')}
+    print('reads per replica:', spread)
+    expect(min(spread.values()) > 0, 'reads were not spread over both replicas')
+
+    response, _ = request(reader, 'GET', '/professor/1')
+    expect(b'Replica Name' in response.data, 'anonymous read of professor 1 was not served by a replica')
+
+    comment = 'a review only the primary has'
+    _, used = request(writer, 'POST', '/add_review', {'score': 5, 'course_id': 1, 'professor_id': 1,
+                                                       'comment': comment})
+    replica_writes = [s for name in ('replica1', 'replica2') for s in statements[name] if s in WRITES]
+    expect(not replica_writes, 'writes reached a replica: {}'.format(replica_writes))
+
+    # another client refills the caches from a replica first; the writer
+    # still sees its review, read from the primary
+    response, _ = request(reader, 'GET', '/professor/1')
+    expect(comment.encode() not in response.data, 'a replica had the review; the copies are not independent')
+    response, used = request(writer, 'GET', '/professor/1')
+    expect(comment.encode() in response.data and b'Primary Name' in response.data,
+           'the writer did not see its own review')
+    expect(used['replica1'] == used['replica2'] == 0, 'the writer read from a replica: {}'.format(used))
+    _, used = request(writer, 'GET', '/professors')
+    expect(used['replica1'] == used['replica2'] == 0, 'the writer read a leaderboard from a replica')
+
+    # the async entry point routes the same way: the writer's session cookie
+    # sends it to the primary, a client without one to the replicas
+    cookie = 'session=' + writer.get_cookie('session').value
+    before = async_counts()
+    status, _, body = asgi_get(asgi.app, '/professor/1', [('Cookie', cookie)])
+    used = {name: async_counts()[name] - before[name] for name in before}
+    expect(status == 200 and comment.encode() in body, 'async: the writer did not see its own review')
+    expect(used['replica1'] == used['replica2'] == 0, 'async: the writer read from a replica: {}'.format(used))
+    before = async_counts()
+    status, _, body = asgi_get(asgi.app, '/professor/1')
+    used = {name: async_counts()[name] - before[name] for name in before}
+    expect(status == 200 and b'Replica Name' in body, 'async: an anonymous read was not served by a replica')
+    expect(used['primary'] == 0, 'async: an anonymous read used the primary: {}'.format(used))
+
+    time.sleep(1.1)
+    _, used = request(writer, 'GET', '/professor/2')
+    expect(used['primary'] == 0, 'the writer kept reading the primary after the window: {}'.format(used))
+
+    # another write that only a lagging replica is asked about: the reader
+    # caches the page from it, and once the replicas catch up (the reviews
+    # and the version bumps reach them) that copy is not served again
+    second = 'a second review only the primary has'
+    request(app.test_client(), 'POST', '/add_review', {'score': 3, 'course_id': 1, 'professor_id': 1,
+                                                       'comment': second})
+    response, _ = request(reader, 'GET', '/professor/1')
+    expect(second.encode() not in response.data, 'a replica had the second review')
+    with engine.connect() as conn:
+        reviews = conn.execute(text('''
+            SELECT r.Score, r.UserID, com.Content FROM Ratings r
+            JOIN Comments com ON com.UserID = r.UserID AND com.CourseID = r.CourseID
+            WHERE com.Content IN (:first, :second)
+        '''), {'first': comment, 'second': second}).fetchall()
+        data_versions = conn.execute(text('SELECT Scope, Version, UpdatedAt FROM DataVersions')).fetchall()
+    for replica in replicas:
+        with replica.begin() as conn:
+            for review in reviews:
+                conn.execute(text('INSERT INTO Ratings (Score, CourseID, UserID) VALUES (:score, 1, :user_id)'),
+                             {'score': review.Score, 'user_id': review.UserID})
+                conn.execute(text('INSERT INTO Comments (Content, CourseID, UserID) VALUES (:content, 1, :user_id)'),
+                             {'content': review.Content, 'user_id': review.UserID})
+            conn.execute(text('DELETE FROM DataVersions'))
+            for row in data_versions:
+                conn.execute(text('INSERT INTO DataVersions (Scope, Version, UpdatedAt) VALUES (:scope, :version, :at)'),
+                             {'scope': row.Scope, 'version': row.Version, 'at': row.UpdatedAt})
+    time.sleep(1.1)
+    for client in (reader, app.test_client()):
+        response, _ = request(client, 'GET', '/professor/1')
+        expect(second.encode() in response.data, 'a caught-up replica served the page without the review')
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
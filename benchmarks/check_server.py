@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from harness import ROOT, load_app, sqlite_url
+from load_test import free_port
+import datagen
+
+# Runs gunicorn.conf.py against a seeded SQLite file: workers come up warm,
+# the probes answer, SIGHUP replaces the workers without failing requests,
+# and SIGTERM fails /readyz while requests in flight still complete.
+
+
+def get(port, path, timeout=10):
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(port, path), timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except OSError:
+        return None, b''
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if get(port, '/readyz', timeout=1)[0] == 200:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start, reload and drain the production server')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--scale', choices=sorted(datagen.SCALES), default='small')
+    args = parser.parse_args()
+
+    url = sqlite_url()
+    _, engine = load_app(url)
+    datagen.seed(engine, **datagen.SCALES[args.scale])
+    engine.dispose()
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=url, PORT=str(port), WEB_CONCURRENCY=str(args.workers),
+               THREADS=str(args.threads), DRAIN_SECONDS='2', GRACEFUL_TIMEOUT='10', SECRET_KEY='check-server',
+               SLOW_QUERY_MS='60000')
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                               '--chdir', ROOT, 'app:app'], env=env, cwd=os.path.dirname(url[len('sqlite:///'):]),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    failures = []
+    try:
+        if not wait_ready(port):
+            failures.append('never became ready')
+            return
+        print('ready in {:.2f} s'.format(time.perf_counter() - started))
+        status, body = get(port, '/readyz')
+        print('/readyz', status, json.loads(body))
+        print('/healthz', get(port, '/healthz')[0])
+
+        # the first page each worker serves should not pay for the warmup
+        latencies = []
+        for path in ['/professors', '/popular_courses', '/insightful_courses'] * args.workers:
+            request_started = time.perf_counter()
+            if get(port, path)[0] != 200:
+                failures.append('{} failed'.format(path))
+            latencies.append((time.perf_counter() - request_started) * 1000)
+        print('first leaderboard requests: max {:.1f} ms'.format(max(latencies)))
+
+        # requests keep flowing while the workers are replaced
+        results = []
+        stop = threading.Event()
+
+        def client():
+            while not stop.is_set():
+                results.append(get(port, '/professors')[0])
+
+        clients = [threading.Thread(target=client) for _ in range(4)]
+        for thread in clients:
+            thread.start()
+        time.sleep(1)
+        server.send_signal(signal.SIGHUP)
+        time.sleep(4)
+        stop.set()
+        for thread in clients:
+            thread.join()
+        failed = len([status for status in results if status != 200])
+        print('SIGHUP under load: {} requests, {} failed'.format(len(results), failed))
+        if failed:
+            failures.append('{} requests failed during the reload'.format(failed))
+
+        # a slow request still completes after SIGTERM, and /readyz fails
+        # while the workers drain
+        slow = []
+        slow_thread = threading.Thread(target=lambda: slow.append(get(port, '/professors')[0]))
+        server.send_signal(signal.SIGTERM)
+        slow_thread.start()
+        time.sleep(0.5)
+        draining = get(port, '/readyz')[0]
+        slow_thread.join()
+        print('after SIGTERM: /readyz {}, request {}'.format(draining, slow))
+        if draining != 503:
+            failures.append('/readyz answered {} while draining'.format(draining))
+        if slow != [200]:
+            failures.append('request during the drain failed: {}'.format(slow))
+        server.wait(timeout=30)
+        print('exited with {}'.format(server.returncode))
+    finally:
+        if server.poll() is None:
+            server.kill()
+        stderr = server.stderr.read().decode('utf-8', 'replace')
+        if failures:
+            print(stderr[-3000:])
+            for failure in failures:
+                print(failure)
+            sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
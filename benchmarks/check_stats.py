@@ -0,0 +1,104 @@
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+import datagen
+
+
+def random_writes(engine, rng, count):
+    # every kind of write the stats triggers have to follow
+    with engine.begin() as conn:
+        professors = conn.execute(text('SELECT MAX(ProfessorID) FROM Professors')).scalar()
+        courses = conn.execute(text('SELECT MAX(CourseID) FROM Courses')).scalar()
+        for _ in range(count):
+            action = rng.random()
+            course_id = rng.randint(1, courses)
+            if action < 0.35:
+                conn.execute(text('INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID) VALUES (:score, 1, :course_id, 1)'),
+                             {'score': rng.choice([1, 2.5, 3, 4, 5, None]), 'course_id': course_id})
+            elif action < 0.6:
+                conn.execute(text("INSERT INTO Comments (Content, CourseID, UserID) VALUES ('a long enough review', :course_id, 1)"),
+                             {'course_id': course_id})
+            elif action < 0.7:
+                conn.execute(text('DELETE FROM Comments WHERE CommentID = (SELECT MIN(CommentID) FROM Comments WHERE CourseID = :course_id)'),
+                             {'course_id': course_id})
+            elif action < 0.8:
+                conn.execute(text('DELETE FROM Ratings WHERE RatingID = (SELECT MAX(RatingID) FROM Ratings WHERE CourseID = :course_id)'),
+                             {'course_id': course_id})
+            elif action < 0.88:
+                conn.execute(text('''
+                    UPDATE Ratings SET Score = :score, CourseID = :new_course
+                    WHERE RatingID = (SELECT MIN(RatingID) FROM Ratings WHERE CourseID = :course_id)
+                '''), {'score': rng.choice([1, 2, 3, 4, 5, None]), 'new_course': rng.randint(1, courses), 'course_id': course_id})
+            elif action < 0.94:
+                conn.execute(text('UPDATE Professors SET Department = :department WHERE ProfessorID = :id'),
+                             {'department': rng.choice(datagen.DEPARTMENTS + ['NEW', None]), 'id': rng.randint(1, professors)})
+            elif action < 0.98:
+                conn.execute(text('UPDATE Courses SET ProfessorID = :professor_id WHERE CourseID = :course_id'),
+                             {'professor_id': rng.randint(1, professors), 'course_id': course_id})
+            else:
+                course_id = conn.execute(text('''
+                    INSERT INTO Courses (CourseNumber, ProfessorID, Title) VALUES ('TMP 100', :id, 'Temporary')
+                '''), {'id': rng.randint(1, professors)}).lastrowid
+                conn.execute(text('INSERT INTO Ratings (Score, CourseID, UserID) VALUES (3, :course_id, 1)'), {'course_id': course_id})
+                conn.execute(text('DELETE FROM Ratings WHERE CourseID = :course_id'), {'course_id': course_id})
+                conn.execute(text('DELETE FROM Courses WHERE CourseID = :course_id'), {'course_id': course_id})
+
+
+def timed(function, repeat=20):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    # the trigger-maintained course, professor and department stats must
+    # match a full recompute after any mix of writes, and rebuild() must
+    # repair them when they do not
+    os.environ.setdefault('SLOW_QUERY_MS', '5000')
+    app, engine = load_app(sqlite_url())
+    app.testing = True
+    import app as app_module
+    import stats
+
+    datagen.seed(engine, professors=2000, ratings=200000, comments=100000)
+    problems = stats.check(engine)
+    print('after seeding: {} problems'.format(len(problems)))
+
+    random_writes(engine, random.Random(1), 5000)
+    problems = stats.check(engine)
+    print('after 5000 random writes: {} problems'.format(len(problems)))
+    for problem in problems[:10]:
+        print('  ' + problem)
+    failed = bool(problems)
+
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE DepartmentStats SET CommentCount = CommentCount + 7 WHERE Department = 'CS'"))
+        conn.execute(text('UPDATE ProfessorStats SET AverageScore = 1 WHERE ProfessorID = 3'))
+        conn.execute(text('UPDATE CourseStats SET RatingCount = RatingCount + 1 WHERE CourseID = 5'))
+    drift = stats.check(engine)
+    print('after corrupting three rows: {}'.format(drift))
+    failed = failed or len(drift) < 3
+    stats.rebuild(engine)
+    problems = stats.check(engine)
+    print('after rebuild: {} problems'.format(len(problems)))
+    failed = failed or bool(problems)
+
+    def recompute():
+        with engine.connect() as conn:
+            conn.execute(text(stats.RECOMPUTE_DEPARTMENTS)).fetchall()
+
+    print('full recompute per request: {:8.2f} ms'.format(timed(recompute)))
+    print('DepartmentStats read:       {:8.2f} ms'.format(timed(app_module.load_insightful_departments)))
+    response = app.test_client().get('/insightful_courses')
+    failed = failed or response.status_code != 200 or b'An error occurred' in response.data
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+from sqlalchemy import text
+
+from harness import load_app, sqlite_url
+
+# Each client keeps one user ID across requests, a tampered cookie is not
+# trusted, and processes allocating at once never hand out the same ID.
+
+
+def allocate(count):
+    import identity
+    return [identity.users.allocate() for _ in range(count)]
+
+
+def reviewer_ids(engine):
+    with engine.connect() as conn:
+        return [row.UserID for row in conn.execute(text('SELECT UserID FROM Comments ORDER BY CommentID'))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Session user IDs and the block ID allocator')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--ids', type=int, default=2000, help='IDs allocated by each process')
+    args = parser.parse_args()
+
+    os.environ.setdefault('SECRET_KEY', 'check-user-ids')
+    os.environ.setdefault('SLOW_QUERY_MS', '60000')
+    app, engine = load_app(sqlite_url())
+    import identity
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO Professors (ProfessorID, Name, Department) VALUES (1, 'Prof', 'CS')"))
+        conn.execute(text("INSERT INTO Courses (CourseID, CourseNumber, ProfessorID) VALUES (1, 'CS1', 1)"))
+        conn.execute(text("INSERT INTO Courses (CourseID, CourseNumber, ProfessorID) VALUES (2, 'CS2', 1)"))
+    failures = []
+
+    def review(client, course_id):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return client.post('/add_review', data={'score': 4, 'course_id': course_id, 'professor_id': 1,
+                                                    'comment': 'a long enough review'})
+
+    first, second = app.test_client(), app.test_client()
+    review(first, 1)
+    review(first, 2)
+    review(second, 1)
+    ids = reviewer_ids(engine)
+    if ids[0] != ids[1] or ids[0] == ids[2]:
+        failures.append('session IDs: {}'.format(ids))
+    # the same user reviewing the same course again is the duplicate the
+    # review check rejects
+    review(first, 1)
+    if len(reviewer_ids(engine)) != 3:
+        failures.append('a repeat review from the same session was stored')
+
+    forged = app.test_client()
+    forged.set_cookie('session', first.get_cookie('session').value[:-2] + 'xx')
+    review(forged, 2)
+    if reviewer_ids(engine)[-1] == ids[0]:
+        failures.append('a tampered cookie kept its user ID')
+
+    # the same allocator in many processes at once, forked after the parent
+    # already reserved a block
+    identity.users.allocate()
+    started = time.perf_counter()
+    with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+        allocated = [value for values in pool.map(allocate, [args.ids] * args.processes) for value in values]
+    elapsed = time.perf_counter() - started
+    allocated += allocate(args.ids)
+    duplicates = len(allocated) - len(set(allocated))
+    if duplicates:
+        failures.append('{} duplicate IDs across processes'.format(duplicates))
+    print('{} processes: {} IDs, {} duplicates, {:.0f} IDs/s'.format(
+        args.processes, len(allocated), duplicates, args.processes * args.ids / elapsed))
+
+    repeat = 100000
+    started = time.perf_counter()
+    allocate(repeat)
+    print('one process: {:.2f} us per ID with blocks of {}'.format(
+        (time.perf_counter() - started) / repeat * 1e6, identity.USER_ID_BLOCK))
+
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
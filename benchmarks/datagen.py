@@ -0,0 +1,101 @@
+import random
+
+from sqlalchemy import text
+
+DEPARTMENTS = ['CS', 'ECE', 'MATH', 'STAT', 'PHYS', 'CHEM', 'ECON', 'ENG', 'HIST', 'PSYC']
+FIRST_NAMES = ['Ana', 'Ben', 'Chen', 'Dana', 'Eli', 'Fatima', 'Gus', 'Hana', 'Ivan', 'Jia', 'Kofi', 'Lena']
+LAST_NAMES = ['Abdel', 'Brown', 'Cohen', 'Diaz', 'Evans', 'Fischer', 'Gupta', 'Huang', 'Ito', 'Jones', 'Kim', 'Lopez']
+WORDS = ['curve', 'attendance', 'homework', 'exams', 'lectures', 'fair', 'hard', 'easy', 'helpful',
+         'project', 'office', 'hours', 'grading', 'quiz', 'boring', 'engaging', 'clear', 'tough']
+
+
+def professor_name(rng, i):
+    return '{} {} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i)
+
+
+def comment_text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 16)))
+
+
+def seed(engine, professors=100, courses_per_professor=3, ratings=1000, comments=500, seed=0, batch_size=5000):
+    rng = random.Random(seed)
+    with engine.begin() as conn:
+        conn.execute(text('''
+            INSERT INTO Professors (ProfessorID, Name, Department, RMP_Link)
+            VALUES (:id, :name, :department, 'none')
+        '''), [{'id': i, 'name': professor_name(rng, i), 'department': rng.choice(DEPARTMENTS)}
+               for i in range(1, professors + 1)])
+
+        course_rows = []
+        for professor_id in range(1, professors + 1):
+            for _ in range(courses_per_professor):
+                course_id = len(course_rows) + 1
+                course_rows.append({'id': course_id, 'number': '{}{}'.format(rng.choice(DEPARTMENTS), 100 + course_id % 500),
+                                    'professor_id': professor_id, 'title': 'Course {}'.format(course_id)})
+        conn.execute(text('''
+            INSERT INTO Courses (CourseID, CourseNumber, ProfessorID, Title)
+            VALUES (:id, :number, :professor_id, :title)
+        '''), course_rows)
+
+    course_count = len(course_rows)
+    for start in range(0, ratings, batch_size):
+        with engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID)
+                VALUES (:score, :again, :course_id, :user_id)
+            '''), [{'score': rng.randint(10, 50) / 10, 'again': rng.random() < 0.5,
+                    'course_id': rng.randint(1, course_count), 'user_id': start + i}
+                   for i in range(min(batch_size, ratings - start))])
+    for start in range(0, comments, batch_size):
+        with engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO Comments (Content, CourseID, UserID)
+                VALUES (:content, :course_id, :user_id)
+            '''), [{'content': comment_text(rng), 'course_id': rng.randint(1, course_count), 'user_id': start + i}
+                   for i in range(min(batch_size, comments - start))])
+    return course_count
+
+
+SCALES = {
+    'small': {'professors': 200, 'courses_per_professor': 3, 'ratings': 5000, 'comments': 5000},
+    'medium': {'professors': 2000, 'courses_per_professor': 3, 'ratings': 100000, 'comments': 100000},
+    'large': {'professors': 20000, 'courses_per_professor': 4, 'ratings': 1000000, 'comments': 1000000},
+}
+
+
+def main():
+    import argparse
+    import os
+    import sys
+
+    from harness import ROOT, load_app
+
+    parser = argparse.ArgumentParser(description='Load a synthetic, seeded dataset into a local database')
+    parser.add_argument('--url', default='sqlite:///' + os.path.join(ROOT, 'instance', 'benchmark.db'),
+                        help='database URL; run the app against it with DATABASE_URL')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--professors', type=int)
+    parser.add_argument('--courses-per-professor', type=int)
+    parser.add_argument('--ratings', type=int)
+    parser.add_argument('--comments', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.url.startswith('sqlite:///'):
+        os.makedirs(os.path.dirname(os.path.abspath(args.url[len('sqlite:///'):])), exist_ok=True)
+    _, engine = load_app(args.url)
+    with engine.connect() as conn:
+        if conn.execute(text('SELECT COUNT(*) FROM Professors')).scalar():
+            sys.exit('{} already has data; seed an empty database'.format(args.url))
+
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    courses = seed(engine, seed=args.seed, **scale)
+    print('seeded {} professors, {} courses, {} ratings, {} comments into {}'.format(
+        scale['professors'], courses, scale['ratings'], scale['comments'], args.url))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+def sqlite_url(path=None):
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='illiniprof-bench-'), 'bench.db')
+    return 'sqlite:///' + os.path.abspath(path)
+
+
+def load_app(url):
+    # db.py reads DATABASE_URL at import time, so this has to run before the
+    # app is imported; the app also keeps its caches under instance/ in the cwd
+    os.environ['DATABASE_URL'] = url
+    # the benchmarks write from one address far faster than any client
+    # would; lift the write limits unless a run sets them
+    for name in ('CLIENT_WRITE_RATE', 'CLIENT_WRITE_BURST', 'COURSE_WRITE_RATE', 'COURSE_WRITE_BURST',
+                 'WRITE_CONCURRENCY'):
+        os.environ.setdefault(name, '1000000')
+    if url.startswith('sqlite:///'):
+        os.chdir(os.path.dirname(os.path.abspath(url[len('sqlite:///'):])))
+    else:
+        os.chdir(tempfile.mkdtemp(prefix='illiniprof-bench-'))
+    import app
+    import db
+    import schema
+
+    engine = db.get_engine()
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+    schema.install(engine, log=lambda message: None)
+    return app.app, engine
+
+
+def run_concurrently(worker, clients, duration):
+    counts = [0] * clients
+    errors = [0] * clients
+    deadline = time.perf_counter() + duration
+
+    def run(index):
+        while time.perf_counter() < deadline:
+            try:
+                worker(index)
+                counts[index] += 1
+            except Exception:
+                errors[index] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    # the routes print their inputs; keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    return sum(counts) / elapsed, sum(errors)
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from sqlalchemy import event
+
+from harness import load_app, sqlite_url
+import datagen
+
+# Compares the sync (thread per request) and async (asgi.py under uvicorn)
+# serving modes on professor_bio. Each server runs in its own process with
+# the cache off, and every SQL statement can be given an artificial delay to
+# stand in for the network round trip to a real database server.
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    # a fixed number of request threads, like a threaded WSGI worker
+    request_queue_size = 1024
+    threads = 16
+
+    def server_activate(self):
+        super().server_activate()
+        self.pool = ThreadPoolExecutor(self.threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.handle_in_thread, request, client_address)
+
+    def handle_in_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def add_latency(engine, seconds, async_driver=False):
+    def pause(statement):
+        time.sleep(seconds)
+
+    def connect(dbapi_connection, connection_record):
+        if async_driver:
+            # runs on the aiosqlite connection's own thread, not the event loop
+            dbapi_connection.run_async(lambda conn: conn.set_trace_callback(pause))
+        else:
+            dbapi_connection.set_trace_callback(pause)
+
+    event.listen(engine, 'connect', connect)
+    engine.dispose()
+
+
+def serve(args):
+    os.environ['CACHE_BACKEND'] = 'none'
+    app, engine = load_app(args.url)
+    import db
+
+    latency = args.db_latency_ms / 1000.0
+    if args.serve == 'sync':
+        if latency:
+            add_latency(engine, latency)
+        PooledWSGIServer.threads = args.threads
+        server = make_server('127.0.0.1', args.port, app, server_class=PooledWSGIServer, handler_class=QuietHandler)
+        app.test_client().get('/')
+        server.serve_forever()
+    else:
+        import uvicorn
+        import asgi
+
+        if latency:
+            add_latency(db.get_async_engine().sync_engine, latency, async_driver=True)
+        uvicorn.run(asgi.app, host='127.0.0.1', port=args.port, log_level='warning', backlog=1024)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+async def drive(port, clients, duration, professors):
+    import aiohttp
+
+    latencies = []
+    errors = [0]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    # a new connection per request for both servers; wsgiref does not keep alive
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+    timeout = aiohttp.ClientTimeout(total=60)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def client(index):
+            rng = random.Random(index)
+            while loop.time() < deadline:
+                url = 'http://127.0.0.1:{}/professor/{}'.format(port, rng.randint(1, professors))
+                started = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        body = await response.read()
+                        if response.status != 200 or b'An error occurred' in body:
+                            errors[0] += 1
+                            continue
+                except Exception:
+                    errors[0] += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(index) for index in range(clients)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] if latencies else float('nan')
+    return len(latencies) / elapsed, percentile(0.5), percentile(0.99), errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='professor_bio throughput: sync vs async serving')
+    parser.add_argument('--url', default=None, help='database URL (defaults to a fresh SQLite file)')
+    parser.add_argument('--clients', default='1,50,500', help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--professors', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16, help='request threads of the sync server')
+    parser.add_argument('--db-latency-ms', type=float, default=2.0, help='added to every SQL statement')
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--serve', choices=['sync', 'async'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    url = args.url or sqlite_url()
+    _, engine = load_app(url)
+    datagen.seed(engine, professors=args.professors, ratings=args.professors * 20, comments=args.professors * 20)
+    engine.dispose()
+
+    print('{:6} {:>8} {:>10} {:>10} {:>10} {:>7}'.format('mode', 'clients', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for mode in args.modes.split(','):
+        port = free_port()
+        env = dict(os.environ, DB_POOL_SIZE=os.environ.get('DB_POOL_SIZE', '20'),
+                   DB_MAX_OVERFLOW=os.environ.get('DB_MAX_OVERFLOW', '30'))
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port),
+                                   '--url', url, '--threads', str(args.threads),
+                                   '--db-latency-ms', str(args.db_latency_ms)], env=env)
+        try:
+            wait_for(port)
+            for clients in [int(value) for value in args.clients.split(',')]:
+                throughput, p50, p99, errors = asyncio.run(drive(port, clients, args.duration, args.professors))
+                print('{:6} {:8} {:10.1f} {:10.1f} {:10.1f} {:7}'.format(mode, clients, throughput, p50, p99, errors))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
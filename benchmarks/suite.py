@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from sqlalchemy import event
+
+from harness import ROOT, load_app, sqlite_url
+import datagen
+
+# Drives every route through the Flask test client against a seeded database
+# and writes one JSON file per run, so two commits can be compared with
+# --compare. Reads run before writes so they all see the same data.
+
+
+def reviewer(client, index):
+    # the reviewing user is the one in the client's session cookie
+    with client.session_transaction() as session:
+        session['user_id'] = 1000000 + index
+
+
+def routes(client, scale, rng):
+    professors = scale['professors']
+    courses = scale['professors'] * scale['courses_per_professor']
+
+    def search():
+        name = rng.choice(datagen.FIRST_NAMES + datagen.LAST_NAMES)
+        start = rng.randint(0, len(name) - 2)
+        form = rng.choice([{'professor': name[start:start + 3]},
+                           {'courseNumber': rng.choice(datagen.DEPARTMENTS) + str(rng.randint(1, 4))},
+                           {'professor': name[start:start + 3], 'courseNumber': rng.choice(datagen.DEPARTMENTS)}])
+        return 'POST', '/search', form
+
+    def add_review(index):
+        reviewer(client, index)
+        return 'POST', '/add_review', {'score': rng.randint(1, 5), 'would_take_again': 'on',
+                                       'course_id': rng.randint(1, courses), 'professor_id': 1,
+                                       'comment': datagen.comment_text(rng) + ' overall'}
+
+    return [
+        ('index', lambda index: ('GET', '/', None)),
+        ('professors', lambda index: ('GET', '/professors', None)),
+        ('professor_bio', lambda index: ('GET', '/professor/{}'.format(rng.randint(1, professors)), None)),
+        ('professor_detail', lambda index: ('GET', '/professor_detail/{}'.format(rng.randint(1, professors)), None)),
+        ('search', lambda index: search()),
+        ('get_courses', lambda index: ('GET', '/get_courses', None)),
+        ('popular_courses', lambda index: ('GET', '/popular_courses', None)),
+        ('insightful_courses', lambda index: ('GET', '/insightful_courses', None)),
+        ('api_courses', lambda index: ('GET', '/api/v1/courses?limit=100', None)),
+        ('add_rating', lambda index: ('POST', '/add_rating', {'rating': rng.randint(1, 5),
+                                                               'course_id': rng.randint(1, courses),
+                                                               'professor_id': 1})),
+        ('add_review', add_review),
+    ]
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+
+
+def run_route(client, make_request, requests, warmup, statements):
+    latencies = []
+    queries = []
+    errors = 0
+    started = time.perf_counter()
+    for index in range(warmup + requests):
+        method, path, data = make_request(index)
+        before = statements[0]
+        request_started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.open(path, method=method, data=data)
+            body = response.get_data()
+        elapsed = time.perf_counter() - request_started
+        if index < warmup:
+            started = time.perf_counter()
+            continue
+        if response.status_code >= 400 or b'An error occurred' in body:
+            errors += 1
+        latencies.append(elapsed * 1000)
+        queries.append(statements[0] - before)
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / total if total else None,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+        'queries_per_request': sum(queries) / len(queries),
+        'max_queries': max(queries),
+    }
+
+
+def git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    print('\ncompared with {} ({})'.format(baseline.get('commit'), baseline.get('timestamp')))
+    regressions = []
+    for name, current in results['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        change = (current['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+        print('{:20} p50 {:8.2f} -> {:8.2f} ms ({:+6.1f}%)   queries {:5.1f} -> {:5.1f}'.format(
+            name, before['p50_ms'], current['p50_ms'], change, before['queries_per_request'],
+            current['queries_per_request']))
+        if change > max_regression or current['queries_per_request'] > before['queries_per_request']:
+            regressions.append(name)
+    if regressions:
+        print('regressed: {}'.format(', '.join(regressions)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every route against a seeded database')
+    parser.add_argument('--url', default=None, help='an already seeded database (see datagen.py); '
+                                                    'defaults to a fresh SQLite file seeded at --scale')
+    parser.add_argument('--scale', choices=sorted(datagen.SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--cache', default='none', help='CACHE_BACKEND for the run (none measures the database)')
+    parser.add_argument('--routes', default=None, help='comma-separated subset of routes')
+    parser.add_argument('--output', default=None, help='defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='a previous results file')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='allowed p50 slowdown in percent')
+    args = parser.parse_args()
+
+    os.environ['CACHE_BACKEND'] = args.cache
+    scale = datagen.SCALES[args.scale]
+    url = args.url or sqlite_url()
+    app, engine = load_app(url)
+    from search import search_index
+
+    if not args.url:
+        datagen.seed(engine, seed=args.seed, **scale)
+    client = app.test_client()
+    client.get('/')
+    deadline = time.monotonic() + 60
+    while not search_index.ready and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+
+    selected = set(args.routes.split(',')) if args.routes else None
+    results = {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': engine.dialect.name,
+        'scale': dict(scale, name=args.scale if not args.url else 'external'),
+        'config': {'requests': args.requests, 'warmup': args.warmup, 'cache': args.cache, 'seed': args.seed},
+        'routes': {},
+    }
+
+    print('{:20} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}'.format(
+        'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'queries', 'errors'))
+    for name, make_request in routes(client, scale, random.Random(args.seed)):
+        if selected and name not in selected:
+            continue
+        result = run_route(client, make_request, args.requests, args.warmup, statements)
+        results['routes'][name] = result
+        print('{:20} {throughput:9.1f} {p50_ms:9.2f} {p95_ms:9.2f} {p99_ms:9.2f} {max_ms:9.2f} '
+              '{queries_per_request:8.1f} {errors:7}'.format(name, **result))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', '{}{}.json'.format(
+        (results['commit'] or 'unknown')[:12], '-dirty' if results['dirty'] else ''))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('\nresults written to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# memory: per-process LRU. shared: one SQLite file that every worker process on
+# the host reads and invalidates, so a write in one worker is seen by all.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 300))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+CACHE_PATH = os.environ.get('CACHE_PATH', os.path.join('instance', 'cache.db'))
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class MemoryCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.stats.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            self.stats.sets += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.stats.invalidations += 1
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+                self.stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        pass
+
+
+class SharedCache:
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache (accessed_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None and row[1] > now:
+            conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            self.stats.hits += 1
+            return pickle.loads(row[0])
+        if row is not None:
+            conn.execute('DELETE FROM cache WHERE key = ? AND expires_at <= ?', (key, now))
+        self.stats.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        conn = self._connect()
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires_at, now))
+        self.stats.sets += 1
+        evicted = conn.execute('''
+            DELETE FROM cache WHERE key IN (
+                SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,)).rowcount
+        self.stats.evictions += max(evicted, 0)
+
+    def delete(self, *keys):
+        conn = self._connect()
+        for key in keys:
+            self.stats.invalidations += conn.execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount
+
+    def delete_prefix(self, prefix):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        self.stats.invalidations += self._connect().execute(
+            "DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'", (escaped + '%',)).rowcount
+
+    def clear(self):
+        self._connect().execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def close(self):
+        # this thread's connection; a forked process must open its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class NullCache(MemoryCache):
+    def set(self, key, value, ttl=None):
+        pass
+
+
+BACKENDS = {
+    'memory': MemoryCache,
+    'shared': SharedCache,
+    'none': NullCache,
+}
+
+_cache = None
+_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = BACKENDS[CACHE_BACKEND]()
+    return _cache
+
+
+def cached(key, loader, ttl=None):
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = loader()
+        if value is not None:
+            cache.set(key, value, ttl)
+    return value
+
+
+# Cache keys. Everything that belongs to one professor shares a prefix so the
+# write routes can drop a professor's pages in one call.
+def professor_key(prof_id, *parts):
+    return ':'.join(['professor', str(prof_id)] + [str(part) for part in parts])
+
+
+LEADERBOARD_PROFESSORS = 'leaderboard:professors'
+LEADERBOARD_POPULAR = 'leaderboard:popular'
+LEADERBOARD_INSIGHTFUL = 'leaderboard:insightful'
+
+
+def invalidate_professor(prof_id):
+    get_cache().delete_prefix(professor_key(prof_id) + ':')
+
+
+def invalidate_leaderboards(*keys):
+    # every version of each board (see versions.cached)
+    cache = get_cache()
+    for key in keys:
+        cache.delete_prefix(key + ':')
@@ -0,0 +1,290 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from array import array
+
+from sqlalchemy import bindparam, text
+
+# An in-process copy of the Professors and Courses metadata (names,
+# departments, course numbers and titles), so pages that only need those
+# do not query for them. It is loaded in one pass at startup and kept
+# current from CatalogChanges, which triggers append a ProfessorID to on
+# every insert, update and delete of a professor or course: at most every
+# CATALOG_REFRESH seconds a lookup reads the changes past the last one
+# seen and reloads just those professors. A write in this process refreshes
+# it at once; other workers see the write within CATALOG_REFRESH. Old
+# changes are pruned from the write path.
+#
+# Rows are __slots__ objects that are replaced, never changed, so a row
+# handed out (or cached with a page) stays consistent.
+CATALOG_REFRESH = float(os.environ.get('CATALOG_REFRESH', 1))
+# more professors changed than this (an import) and it reloads everything
+CATALOG_MAX_CHANGES = int(os.environ.get('CATALOG_MAX_CHANGES', 5000))
+CATALOG_FETCH_SIZE = 10000
+# ChangeIDs this far below the newest one seen are read again on a refresh:
+# IDs are handed out when a write runs but seen once it commits, so a
+# lower one can show up after a higher one
+CATALOG_CHANGE_LOOKBACK = 200
+# A write can commit further below than that (an import chunk holds its IDs
+# until the whole chunk commits), so every refresh also counts the changes
+# this far below the newest one seen; more than it has seen and it reloads
+# everything
+CATALOG_GAP_WINDOW = int(os.environ.get('CATALOG_GAP_WINDOW', 20000))
+# changes this far below the newest one are deleted, at most once an hour;
+# a worker that has not seen them by then reloads everything
+CATALOG_CHANGE_RETENTION = int(os.environ.get('CATALOG_CHANGE_RETENTION', 100000))
+
+
+class Professor:
+    __slots__ = ('ProfessorID', 'Name', 'Department', 'Courses')
+
+    def __init__(self, professor_id, name, department, courses=()):
+        self.ProfessorID = professor_id
+        self.Name = name
+        self.Department = department
+        self.Courses = courses
+
+
+class Course:
+    __slots__ = ('CourseID', 'CourseNumber', 'Title', 'ProfessorID')
+
+    def __init__(self, course_id, course_number, title, professor_id):
+        self.CourseID = course_id
+        self.CourseNumber = course_number
+        self.Title = title
+        self.ProfessorID = professor_id
+
+
+def intern(value):
+    # departments and course numbers repeat across thousands of rows
+    return sys.intern(value) if value is not None else None
+
+
+def load_rows(conn, professor_ids=None):
+    # Professor objects for every professor, or for professor_ids
+    where = 'WHERE ProfessorID IN :ids' if professor_ids is not None else ''
+    params = {'ids': list(professor_ids)} if professor_ids is not None else {}
+
+    def query(sql):
+        statement = text(sql.format(where=where))
+        if professor_ids is not None:
+            statement = statement.bindparams(bindparam('ids', expanding=True))
+        return conn.execution_options(stream_results=True, yield_per=CATALOG_FETCH_SIZE).execute(statement, params)
+
+    courses = {}
+    for course_id, course_number, title, professor_id in query('''
+        SELECT CourseID, CourseNumber, Title, ProfessorID FROM Courses {where} ORDER BY CourseID
+    '''):
+        courses.setdefault(professor_id, []).append(Course(course_id, intern(course_number), title, professor_id))
+    return [Professor(professor_id, name, intern(department), tuple(courses.get(professor_id, ())))
+            for professor_id, name, department in query('''
+                SELECT ProfessorID, Name, Department FROM Professors {where} ORDER BY ProfessorID
+            ''')]
+
+
+class Catalog:
+    def __init__(self):
+        self.professors = {}
+        self.courses = {}
+        # department -> ProfessorIDs in ascending order
+        self.departments = {}
+        self.last_change = 0
+        # the ChangeIDs seen within CATALOG_GAP_WINDOW of last_change
+        self.recent_changes = set()
+        self.loaded_at = None
+        self.checked_at = None
+        self.full_loads = 0
+        self.incremental_refreshes = 0
+        self.gaps = 0
+        self._pruned_at = 0
+        self._footprint = None
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.loaded_at is not None
+
+    def professor(self, professor_id):
+        return self.professors.get(professor_id)
+
+    def course(self, course_id):
+        return self.courses.get(course_id)
+
+    def in_department(self, department):
+        professors = self.professors
+        return [professors[professor_id] for professor_id in self.departments.get(department, ())]
+
+    def find(self, department=None, course_number=None, name=None):
+        # exact matches on every field given, in ProfessorID order
+        # list() copies the values in one step, so a refresh cannot change
+        # the dict while it is walked
+        found = self.in_department(department) if department else list(self.professors.values())
+        if name:
+            found = [professor for professor in found if professor.Name == name]
+        if course_number:
+            found = [professor for professor in found
+                     if any(course.CourseNumber == course_number for course in professor.Courses)]
+        return list(found)
+
+    def load(self, engine):
+        with engine.connect() as conn:
+            # changes logged while the rows are read are applied again by
+            # the next refresh, which is harmless
+            last_change = conn.execute(text('SELECT COALESCE(MAX(ChangeID), 0) FROM CatalogChanges')).scalar()
+            recent_changes = self._changes_after(conn, last_change - CATALOG_GAP_WINDOW)
+            rows = load_rows(conn)
+
+        professors = {}
+        courses = {}
+        departments = {}
+        for professor in rows:
+            professors[professor.ProfessorID] = professor
+            for course in professor.Courses:
+                courses[course.CourseID] = course
+            departments.setdefault(professor.Department, array('I')).append(professor.ProfessorID)
+
+        with self._lock:
+            self.professors, self.courses, self.departments = professors, courses, departments
+            self.last_change = last_change
+            self.recent_changes = {change_id for change_id, _ in recent_changes}
+            self.loaded_at = self.checked_at = time.monotonic()
+            self.full_loads += 1
+            self._footprint = None
+
+    def _replace(self, professor_ids, rows):
+        # Changed in place, a professor at a time: a lookup gets the old row
+        # or the new one, each with its own courses. Courses are added
+        # before the professor and removed after, so a course lookup never
+        # misses one that exists on both sides.
+        replacements = {professor.ProfessorID: professor for professor in rows}
+        with self._lock:
+            departments = {}
+            for professor_id in professor_ids:
+                old = self.professors.get(professor_id)
+                new = replacements.get(professor_id)
+                if new is not None:
+                    for course in new.Courses:
+                        self.courses[course.CourseID] = course
+                    self.professors[professor_id] = new
+                else:
+                    self.professors.pop(professor_id, None)
+                kept = {course.CourseID for course in new.Courses} if new is not None else set()
+                for course in old.Courses if old is not None else ():
+                    # a course moved to another professor is that professor's now
+                    if course.CourseID not in kept and self.courses.get(course.CourseID) is course:
+                        del self.courses[course.CourseID]
+                if old is not None and (new is None or new.Department != old.Department):
+                    ids = departments.setdefault(old.Department, array('I', self.departments.get(old.Department, ())))
+                    del ids[bisect.bisect_left(ids, professor_id)]
+                if new is not None and (old is None or new.Department != old.Department):
+                    ids = departments.setdefault(new.Department, array('I', self.departments.get(new.Department, ())))
+                    bisect.insort(ids, professor_id)
+            for department, ids in departments.items():
+                if ids:
+                    self.departments[department] = ids
+                else:
+                    self.departments.pop(department, None)
+            self.incremental_refreshes += 1
+            self._footprint = None
+
+    def _changes_after(self, conn, after):
+        return conn.execute(text('''
+            SELECT ChangeID, ProfessorID FROM CatalogChanges WHERE ChangeID > :after ORDER BY ChangeID
+        '''), {'after': max(after, 0)}).fetchall()
+
+    def refresh(self, engine):
+        with self._refreshing:
+            if not self.ready:
+                self.load(engine)
+            else:
+                self._refresh(engine)
+
+    def _refresh(self, engine):
+        with engine.connect() as conn:
+            # counted before the changes are read, so each one counted is
+            # either seen already or read below
+            logged, oldest = conn.execute(text('''
+                SELECT (SELECT COUNT(*) FROM CatalogChanges WHERE ChangeID > :after),
+                       (SELECT MIN(ChangeID) FROM CatalogChanges)
+            '''), {'after': max(self.last_change - CATALOG_GAP_WINDOW, 0)}).one()
+            changes = [(change_id, professor_id) for change_id, professor_id
+                       in self._changes_after(conn, self.last_change - CATALOG_CHANGE_LOOKBACK)
+                       if change_id not in self.recent_changes]
+            # more changes counted than seen: one committed below the
+            # lookback; or the oldest left is past the last one seen: the
+            # ones between were pruned before this worker read them
+            gap = logged > len(self.recent_changes) + len(changes) or (
+                oldest is not None and oldest > self.last_change + 1)
+            if not changes and not gap:
+                self.checked_at = time.monotonic()
+                return
+            professor_ids = {professor_id for _, professor_id in changes if professor_id is not None}
+            if gap or len(professor_ids) > CATALOG_MAX_CHANGES:
+                rows = None
+            else:
+                rows = load_rows(conn, professor_ids) if professor_ids else []
+        if rows is None:
+            if gap:
+                self.gaps += 1
+            self.load(engine)
+            return
+        self._replace(professor_ids, rows)
+        with self._lock:
+            self.last_change = max(self.last_change, changes[-1][0])
+            self.recent_changes = {change_id for change_id in self.recent_changes.union(
+                change_id for change_id, _ in changes) if change_id > self.last_change - CATALOG_GAP_WINDOW}
+        self.checked_at = time.monotonic()
+
+    def prune(self, engine):
+        # called on the write path, which has the primary
+        if time.time() - self._pruned_at > 3600:
+            self._pruned_at = time.time()
+            with engine.begin() as conn:
+                conn.execute(text('DELETE FROM CatalogChanges WHERE ChangeID <= :cutoff'),
+                             {'cutoff': self.last_change - CATALOG_CHANGE_RETENTION})
+
+    def current(self, engine):
+        # the snapshot, loaded on first use and refreshed when it is due;
+        # while one thread refreshes, the others read the previous snapshot
+        if not self.ready:
+            self.refresh(engine)
+        elif time.monotonic() - self.checked_at > CATALOG_REFRESH and not self._refreshing.locked():
+            try:
+                self.refresh(engine)
+            except Exception as e:
+                print("Error refreshing catalog:", e)
+        return self
+
+    def footprint(self):
+        # bytes held by the snapshot: the rows, their strings and the
+        # indexes; shared (interned) strings are counted once
+        if self._footprint is None:
+            seen = set()
+
+            def size(value):
+                if id(value) in seen:
+                    return 0
+                seen.add(id(value))
+                return sys.getsizeof(value)
+
+            total = sys.getsizeof(self.professors) + sys.getsizeof(self.courses) + sys.getsizeof(self.departments)
+            for professor in self.professors.values():
+                total += size(professor) + size(professor.Name) + size(professor.Department) + size(professor.Courses)
+                for course in professor.Courses:
+                    total += size(course) + size(course.CourseNumber) + size(course.Title)
+            for department, ids in self.departments.items():
+                total += size(department) + size(ids)
+            self._footprint = total
+        return self._footprint
+
+    def stats(self):
+        return {'professors': len(self.professors), 'courses': len(self.courses),
+                'departments': len(self.departments), 'bytes': self.footprint(),
+                'full_loads': self.full_loads, 'incremental_refreshes': self.incremental_refreshes,
+                'gaps': self.gaps, 'last_change': self.last_change}
+
+
+catalog = Catalog()
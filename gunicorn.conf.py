@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+import signal
+import threading
+
+# Production server: gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported and warmed up once in the master (schema check, search
+# index, leaderboard caches), then forked into WORKERS processes of THREADS
+# threads each. On SIGTERM a worker fails /readyz for DRAIN_SECONDS so the
+# load balancer stops sending it requests, then finishes what it has in
+# flight within GRACEFUL_TIMEOUT. SIGHUP replaces the workers the same way
+# without dropping requests; since the app is preloaded, new code needs a
+# new master (SIGUSR2, then SIGTERM to the old one) or a redeploy.
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8080))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+# recycle workers now and then; the jitter keeps them from restarting together
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', 5))
+
+# a connection per thread is enough unless set otherwise; this has to be in
+# the environment before db.py is imported
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+
+def when_ready(server):
+    import app
+    import cache
+    import db
+
+    app.warmup()
+    # connections do not survive a fork: each worker opens its own
+    db.dispose_engine()
+    cache.get_cache().close()
+    server.log.info('Warmed up; starting %s workers of %s threads', workers, threads)
+
+
+def post_worker_init(worker):
+    from health import readiness
+
+    def drain(signum, frame):
+        readiness.draining = True
+        timer = threading.Timer(DRAIN_SECONDS, worker.handle_exit, (signum, frame))
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, drain)
@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+
+from flask import Blueprint, jsonify
+from sqlalchemy import text
+
+from db import get_engine
+
+# /healthz answers as long as the process can serve a request at all.
+# /readyz also needs the worker to be warmed up, not draining, and the
+# database to have answered its last ping. The ping runs at most once per
+# READY_CHECK_INTERVAL seconds per process, however often the probes come.
+READY_CHECK_INTERVAL = float(os.environ.get('READY_CHECK_INTERVAL', 10))
+
+health = Blueprint('health', __name__)
+
+
+class Readiness:
+    def __init__(self, interval=READY_CHECK_INTERVAL):
+        self.interval = interval
+        self.warm = False
+        self.draining = False
+        self.database_ok = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def check_database(self):
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.interval:
+            return self.database_ok
+        # one ping at a time; other probes answer with the last result
+        if not self._lock.acquire(blocking=False):
+            return self.database_ok
+        try:
+            with get_engine().connect() as conn:
+                conn.execute(text('SELECT 1'))
+            self.database_ok = True
+        except Exception as e:
+            print("Error: readiness ping failed:", e)
+            self.database_ok = False
+        finally:
+            self.checked_at = time.monotonic()
+            self._lock.release()
+        return self.database_ok
+
+    def as_dict(self):
+        return {'warm': self.warm, 'draining': self.draining, 'database': self.database_ok}
+
+
+readiness = Readiness()
+
+
+@health.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify(status='ok')
+
+
+@health.route('/readyz', methods=['GET'])
+# App Engine sends this to a new instance before routing traffic to it
+@health.route('/_ah/warmup', methods=['GET'])
+def readyz():
+    ready = readiness.warm and not readiness.draining and readiness.check_database()
+    status = 'ready' if ready else 'unavailable'
+    return jsonify(dict(readiness.as_dict(), status=status)), 200 if ready else 503
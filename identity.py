@@ -0,0 +1,82 @@
+import os
+import threading
+from datetime import timedelta
+
+from flask import session
+from sqlalchemy import text
+
+from db import get_engine
+
+# Each visitor's user ID lives in Flask's signed session cookie, so any
+# worker on any node can read it without a lookup. New IDs are handed out
+# from blocks reserved in the IdSequences table (migration 10): a process
+# touches the database once per USER_ID_BLOCK new visitors, and two
+# processes never share a block. IDs left in a block when a process exits
+# are skipped, not reused.
+#
+# Every worker has to sign with the same SECRET_KEY; without one a random
+# key is used, and sessions last only as long as the process.
+SECRET_KEY = os.environ.get('SECRET_KEY')
+USER_ID_BLOCK = int(os.environ.get('USER_ID_BLOCK', 100))
+SESSION_DAYS = int(os.environ.get('SESSION_DAYS', 365))
+SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', '0').lower() not in ('0', 'false', 'no')
+
+
+class IdAllocator:
+    def __init__(self, name, block_size=USER_ID_BLOCK):
+        self.name = name
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def reserve(self, engine=None):
+        engine = engine or get_engine()
+        # the UPDATE locks the row until commit, so the SELECT reads this
+        # transaction's own increment
+        with engine.begin() as conn:
+            conn.execute(text('''
+                UPDATE IdSequences SET NextValue = NextValue + :size WHERE Name = :name
+            '''), {'size': self.block_size, 'name': self.name})
+            end = conn.execute(text('SELECT NextValue FROM IdSequences WHERE Name = :name'),
+                               {'name': self.name}).scalar()
+        if end is None:
+            raise RuntimeError("No IdSequences row for '{}'".format(self.name))
+        return end - self.block_size, end
+
+    def allocate(self):
+        with self._lock:
+            # a forked worker must not hand out what is left of its parent's block
+            if self._next >= self._end or self._pid != os.getpid():
+                self._next, self._end = self.reserve()
+                self._pid = os.getpid()
+            value = self._next
+            self._next += 1
+            return value
+
+
+users = IdAllocator('users')
+
+
+def current_user_id():
+    user_id = session.get('user_id')
+    if user_id is None:
+        user_id = users.allocate()
+        session['user_id'] = user_id
+        session.permanent = True
+    return user_id
+
+
+def init_app(app):
+    if SECRET_KEY:
+        app.secret_key = SECRET_KEY
+    else:
+        print("SECRET_KEY is not set; sessions will not outlive this process or be shared with other workers")
+        app.secret_key = os.urandom(32)
+    app.config.update(
+        PERMANENT_SESSION_LIFETIME=timedelta(days=SESSION_DAYS),
+        SESSION_COOKIE_HTTPONLY=True,
+        SESSION_COOKIE_SAMESITE='Lax',
+        SESSION_COOKIE_SECURE=SESSION_COOKIE_SECURE,
+    )
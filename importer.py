@@ -0,0 +1,216 @@
+import csv
+import io
+import json
+import os
+import time
+
+from sqlalchemy import bindparam, text
+
+from db import get_engine
+
+# Catalog import. Input is one row per course with the professor repeated:
+# name, department, course_number, title. Rows are read as a stream and
+# written in chunks, each chunk in its own transaction.
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+IMPORT_MAX_ERRORS = 100
+FIELDS = ('name', 'department', 'course_number', 'title')
+# column sizes from the base tables
+MAX_LENGTHS = {'name': 255, 'department': 255, 'course_number': 32, 'title': 255}
+JSON_READ_SIZE = 64 * 1024
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.professors = 0
+        self.courses = 0
+        # professors that were already there and gained a course; their
+        # pages are cached
+        self.updated_professors = set()
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = []
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def courses_per_second(self):
+        return self.courses / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return dict(vars(self), courses_per_second=self.courses_per_second)
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield {key.strip().lower(): value for key, value in row.items() if key}
+
+
+def read_json_lines(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_json_array(stream):
+    # a top-level array of objects, decoded one element at a time so the
+    # whole document never has to be in memory
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise ValueError('expected a JSON array')
+            started = True
+            position += 1
+            continue
+        if started and position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position >= len(buffer):
+                raise ValueError
+            value, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = stream.read(JSON_READ_SIZE)
+            if not chunk:
+                if buffer[position:].strip():
+                    raise ValueError('truncated JSON array')
+                return
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield value
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_json_lines,
+    'json': read_json_array,
+}
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    return {'ndjson': 'jsonl'}.get(extension, extension)
+
+
+def validate(row):
+    if not isinstance(row, dict):
+        return None, 'expected an object with {}'.format(', '.join(FIELDS))
+    cleaned = {}
+    for field in FIELDS:
+        value = row.get(field)
+        value = '' if value is None else str(value).strip()
+        if not value and field != 'title':
+            return None, 'missing {}'.format(field)
+        if len(value) > MAX_LENGTHS[field]:
+            return None, '{} is longer than {} characters'.format(field, MAX_LENGTHS[field])
+        cleaned[field] = value
+    return cleaned, None
+
+
+def chunks(rows, size, result):
+    chunk = []
+    for line, row in enumerate(rows, start=1):
+        result.rows += 1
+        cleaned, error = validate(row)
+        if error:
+            result.rejected += 1
+            if len(result.errors) < IMPORT_MAX_ERRORS:
+                result.errors.append('row {}: {}'.format(line, error))
+            continue
+        chunk.append(cleaned)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+PROFESSORS_BY_NAME = text('''
+    SELECT ProfessorID, Name, Department FROM Professors WHERE Name IN :names ORDER BY ProfessorID
+''').bindparams(bindparam('names', expanding=True))
+
+COURSES_BY_PROFESSOR = text('''
+    SELECT ProfessorID, CourseNumber, COALESCE(Title, '') FROM Courses WHERE ProfessorID IN :ids
+''').bindparams(bindparam('ids', expanding=True))
+
+
+def professor_ids(conn, keys):
+    found = {}
+    names = sorted({name for name, _ in keys})
+    for start in range(0, len(names), 500):
+        for prof_id, name, department in conn.execute(PROFESSORS_BY_NAME, {'names': names[start:start + 500]}):
+            # the lowest ID wins if the table already holds duplicates
+            found.setdefault((name, department), prof_id)
+    return {key: found[key] for key in keys if key in found}
+
+
+def existing_courses(conn, ids):
+    found = set()
+    ids = sorted(ids)
+    for start in range(0, len(ids), 500):
+        found.update(conn.execute(COURSES_BY_PROFESSOR, {'ids': ids[start:start + 500]}))
+    return found
+
+
+def import_chunk(conn, chunk, result):
+    keys = {(row['name'], row['department']) for row in chunk}
+    known = professor_ids(conn, keys)
+    new = keys - set(known)
+    existing = set(known.values())
+    if new:
+        conn.execute(text('''
+            INSERT INTO Professors (Name, Department, RMP_Link) VALUES (:name, :department, 'none')
+        '''), [{'name': name, 'department': department} for name, department in sorted(new)])
+        known.update(professor_ids(conn, new))
+        result.professors += len(new)
+
+    # professors that were already there may have some of these courses
+    seen = existing_courses(conn, existing)
+    courses = []
+    for row in chunk:
+        prof_id = known[(row['name'], row['department'])]
+        course = (prof_id, row['course_number'], row['title'])
+        if course in seen:
+            result.duplicates += 1
+            continue
+        seen.add(course)
+        if prof_id in existing:
+            result.updated_professors.add(prof_id)
+        courses.append({'course_number': row['course_number'], 'professor_id': prof_id, 'title': row['title']})
+    if courses:
+        conn.execute(text('''
+            INSERT INTO Courses (CourseNumber, ProfessorID, Title) VALUES (:course_number, :professor_id, :title)
+        '''), courses)
+    result.courses += len(courses)
+
+
+def import_catalog(stream, format, chunk_size=IMPORT_CHUNK_SIZE, engine=None, progress=None):
+    if format not in READERS:
+        raise ValueError('unsupported import format: {}'.format(format))
+    engine = engine or get_engine()
+    result = ImportResult()
+    started = time.perf_counter()
+    for chunk in chunks(READERS[format](stream), chunk_size, result):
+        batch_started = time.perf_counter()
+        courses_before = result.courses
+        with engine.begin() as conn:
+            import_chunk(conn, chunk, result)
+        result.batches += 1
+        result.seconds = time.perf_counter() - started
+        if progress:
+            elapsed = time.perf_counter() - batch_started
+            progress('batch {}: {} rows, {} courses in {:.2f} s ({:.0f} courses/s), {} total'.format(
+                result.batches, len(chunk), result.courses - courses_before, elapsed,
+                (result.courses - courses_before) / elapsed if elapsed else 0, result.courses))
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def text_stream(binary):
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
@@ -0,0 +1,281 @@
+import contextvars
+import cProfile
+import functools
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter as Tally
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import db
+
+# Request and SQL instrumentation, exported on /metrics in the Prometheus text
+# format. Numbers are per worker process, like the caches: scrape each worker
+# or label them by instance.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0').lower() not in ('0', 'false', 'no')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join('instance', 'profiles'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][position] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        found = []
+        with self._lock:
+            for labels, (buckets, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, buckets):
+                    cumulative += bucket
+                    found.append((self.name + '_bucket', labels, (('le', number(bound)),), cumulative))
+                found.append((self.name + '_bucket', labels, (('le', '+Inf'),), count))
+                found.append((self.name + '_sum', labels, (), total))
+                found.append((self.name + '_count', labels, (), count))
+        return found
+
+
+REQUEST_SECONDS = Histogram('illiniprof_request_duration_seconds', 'Request latency by route.',
+                            ('endpoint', 'method'))
+REQUESTS = Counter('illiniprof_requests_total', 'Requests by route and status.', ('endpoint', 'method', 'status'))
+REQUEST_STATEMENTS = Histogram('illiniprof_request_sql_statements', 'SQL statements issued per request.',
+                               ('endpoint',), COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('illiniprof_request_db_seconds', 'Time spent in SQL per request.', ('endpoint',))
+STATEMENTS = Counter('illiniprof_sql_statements_total', 'SQL statements executed.')
+SLOW_QUERIES = Counter('illiniprof_sql_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.')
+N_PLUS_ONE = Counter('illiniprof_n_plus_one_total', 'Requests that repeated one statement N_PLUS_ONE_THRESHOLD '
+                     'or more times.', ('endpoint',))
+POOL_WAIT_SECONDS = Histogram('illiniprof_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled '
+                              'database connection.')
+POOL_CONNECTIONS = Gauge('illiniprof_db_pool_connections', 'Pooled database connections by state.', ('state',))
+PROFILED = Counter('illiniprof_profiled_requests_total', 'Requests dumped by the sampling profiler.')
+RATE_LIMITED = Counter('illiniprof_rate_limited_total', 'Write requests rejected with 429 by a rate limit.',
+                       ('endpoint', 'limit'))
+SHED = Counter('illiniprof_shed_total', 'Write requests rejected with 503 by admission control.',
+               ('endpoint', 'reason'))
+
+METRICS = [REQUEST_SECONDS, REQUESTS, REQUEST_STATEMENTS, REQUEST_DB_SECONDS, STATEMENTS, SLOW_QUERIES, N_PLUS_ONE,
+           POOL_WAIT_SECONDS, POOL_CONNECTIONS, PROFILED, RATE_LIMITED, SHED]
+
+
+class RequestStats:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.seen = Tally()
+
+
+# set for the duration of a Flask request; statements run outside one only
+# count towards the process-wide totals
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def compact(statement, limit=500):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+    STATEMENTS.inc()
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+        stats.seen[statement] += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc()
+        print("Slow query ({:.0f} ms, {}): {}".format(elapsed * 1000, stats.endpoint if stats else '-',
+                                                     compact(statement)))
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # a statement that raised never reaches after_cursor_execute; one that
+    # failed before it had an execution context never started the clock
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started and context.execution_context is not None:
+        started.pop()
+
+
+def pool_wait(seconds):
+    POOL_WAIT_SECONDS.observe(value=seconds)
+
+
+db.pool_wait_listeners.append(pool_wait)
+
+
+def observe_request(endpoint, method, status, seconds):
+    REQUEST_SECONDS.observe(endpoint, method, value=seconds)
+    REQUESTS.inc(endpoint, method, str(status))
+
+
+def observe_stats(stats, method, status, started):
+    observe_request(stats.endpoint, method, status, time.perf_counter() - started)
+    REQUEST_STATEMENTS.observe(stats.endpoint, value=stats.statements)
+    REQUEST_DB_SECONDS.observe(stats.endpoint, value=stats.db_seconds)
+    if stats.seen:
+        statement, repeats = stats.seen.most_common(1)[0]
+        if repeats >= N_PLUS_ONE_THRESHOLD:
+            N_PLUS_ONE.inc(stats.endpoint)
+            print("Possible N+1 in {}: statement ran {} times: {}".format(stats.endpoint, repeats,
+                                                                      compact(statement, 200)))
+
+
+def start_profile():
+    if not PROFILE_REQUESTS:
+        return None
+    if request.headers.get('X-Profile') != '1' and random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is already running in this process
+        return None
+    return profile
+
+
+def dump_profile(profile, endpoint):
+    profile.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, '{}-{}.prof'.format(endpoint.replace('.', '_'), time.time_ns()))
+    profile.dump_stats(path)
+    PROFILED.inc()
+
+
+def init_app(app):
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = current_request.set(RequestStats(request.endpoint or 'unmatched'))
+        g.metrics_profile = start_profile()
+
+    @app.after_request
+    def finish_request(response):
+        stats = current_request.get()
+        if stats is None:
+            return response
+        finish = functools.partial(observe_stats, stats, request.method, response.status_code, g.metrics_started)
+        if response.is_streamed:
+            # the body is generated after this hook, and its statements are
+            # the request's too; they are counted once it has been sent
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        profile = g.pop('metrics_profile', None)
+        if profile is not None:
+            dump_profile(profile, current_request.get().endpoint)
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            current_request.reset(token)
+
+
+def pool_samples():
+    pool = db.get_engine().pool
+    if hasattr(pool, 'checkedout'):
+        POOL_CONNECTIONS.set('checked_out', value=pool.checkedout())
+        POOL_CONNECTIONS.set('idle', value=pool.checkedin())
+        POOL_CONNECTIONS.set('overflow', value=max(pool.overflow(), 0))
+
+
+def render(stats=None):
+    # stats: {subsystem: {name: value}} from the caches and queues, which
+    # keep their own counters
+    pool_samples()
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, labels, extra, value in metric.samples():
+            lines.append('{}{} {}'.format(name, label_text(metric.labels, labels, extra), number(value)))
+    for subsystem, values in sorted((stats or {}).items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = 'illiniprof_{}_{}'.format(subsystem, key)
+                lines.append('# TYPE {} untyped'.format(name))
+                lines.append('{} {}'.format(name, number(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,218 @@
+import functools
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import render_template, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import db
+import metrics
+
+# Token buckets in front of the write routes, one per client address and
+# one per course: a bucket holds up to `burst` tokens and refills at `rate`
+# per second, and a write that finds any of its buckets empty gets a 429 and
+# spends none of them. memory keeps the buckets per worker process; shared
+# keeps them in one SQLite file, so the limits hold across every worker on
+# the host.
+#
+# Behind a proxy the connection comes from the proxy, so the client address
+# is read from X-Forwarded-For: PROXY_HOPS is how many proxies in front of
+# the app append to it. Only those entries are trusted; anything to their
+# left was sent by the client.
+#
+# Admission control comes after the limits: a worker runs at most
+# WRITE_CONCURRENCY writes at once (half its pool by default, leaving the
+# rest to reads), and none while its pool has no connection left to hand
+# out, so a burst gets a 503 instead of waiting DB_POOL_TIMEOUT seconds for
+# a connection.
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH', os.path.join('instance', 'rate_limits.db'))
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+CLIENT_WRITE_RATE = float(os.environ.get('CLIENT_WRITE_RATE', 0.2))
+CLIENT_WRITE_BURST = float(os.environ.get('CLIENT_WRITE_BURST', 10))
+COURSE_WRITE_RATE = float(os.environ.get('COURSE_WRITE_RATE', 2))
+COURSE_WRITE_BURST = float(os.environ.get('COURSE_WRITE_BURST', 20))
+WRITE_CONCURRENCY = int(os.environ.get('WRITE_CONCURRENCY', max(1, db.POOL_SIZE // 2)))
+
+LIMITS = {
+    'client': (CLIENT_WRITE_RATE, CLIENT_WRITE_BURST),
+    'course': (COURSE_WRITE_RATE, COURSE_WRITE_BURST),
+}
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+def retry_after(tokens, rate):
+    return max(1, math.ceil((1 - tokens) / rate)) if rate > 0 else 60
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # (allowed, seconds until a token is back)
+        refused, retry = self.take_all([(key, rate, burst)])
+        return refused is None, retry
+
+    def take_all(self, buckets):
+        # A token from every (key, rate, burst) bucket, or from none of them:
+        # (None, None), or the position of the first empty one and the
+        # seconds until it has a token again
+        now = time.monotonic()
+        with self._lock:
+            found = [refill(*self._buckets.pop(key, (burst, now)), now, rate, burst) for key, rate, burst in buckets]
+            refused = next((position for position, tokens in enumerate(found) if tokens < 1), None)
+            for (key, _, _), tokens in zip(buckets, found):
+                self._buckets[key] = (tokens - 1 if refused is None else tokens, now)
+            # the least recently used bucket is the one most likely full again
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        if refused is None:
+            return None, None
+        return refused, retry_after(found[refused], buckets[refused][1])
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SharedBuckets:
+    def __init__(self, path=RATE_LIMIT_PATH, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.path = path
+        self.max_keys = max_keys
+        self._local = threading.local()
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self._connect().execute('CREATE INDEX IF NOT EXISTS idx_buckets_updated ON buckets (updated_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        refused, retry = self.take_all([(key, rate, burst)])
+        return refused is None, retry
+
+    def take_all(self, buckets):
+        # as MemoryBuckets.take_all
+        conn = self._connect()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so two workers cannot both
+        # spend the last token
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            found = []
+            for key, rate, burst in buckets:
+                row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+                found.append(refill(row[0], row[1], now, rate, burst) if row else burst)
+            refused = next((position for position, tokens in enumerate(found) if tokens < 1), None)
+            conn.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                             [(key, tokens - 1 if refused is None else tokens, now)
+                              for (key, _, _), tokens in zip(buckets, found)])
+            conn.execute('''
+                DELETE FROM buckets WHERE key IN (
+                    SELECT key FROM buckets ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_keys,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if refused is None:
+            return None, None
+        return refused, retry_after(found[refused], buckets[refused][1])
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM buckets').fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+BACKENDS = {
+    'memory': MemoryBuckets,
+    'shared': SharedBuckets,
+}
+
+_buckets = None
+_lock = threading.Lock()
+_writes = threading.BoundedSemaphore(WRITE_CONCURRENCY)
+
+
+def get_buckets():
+    global _buckets
+    if _buckets is None:
+        with _lock:
+            if _buckets is None:
+                _buckets = BACKENDS[RATE_LIMIT_BACKEND]()
+    return _buckets
+
+
+def init_app(app):
+    if PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+
+def pool_exhausted():
+    return db.get_engine().pool.checkedout() >= db.POOL_SIZE + db.MAX_OVERFLOW
+
+
+def rejected(message, status, retry):
+    return render_template('error.html', message=message), status, {'Retry-After': str(retry)}
+
+
+def limit_writes(course_id=None):
+    # course_id reads the course a write is for from the request, when the
+    # route has one
+    def decorator(view):
+        @functools.wraps(view)
+        def limited(*args, **kwargs):
+            keys = [('client', request.remote_addr or '-')]
+            course = course_id() if course_id else None
+            if course is not None:
+                keys.append(('course', course))
+            # shed before any token is taken, so a write turned away for
+            # load is not also charged against the client's limit
+            if pool_exhausted():
+                metrics.SHED.inc(request.endpoint, 'pool')
+                return rejected("The site is busy; try again in a moment.", 503, 1)
+            if not _writes.acquire(blocking=False):
+                metrics.SHED.inc(request.endpoint, 'concurrency')
+                return rejected("The site is busy; try again in a moment.", 503, 1)
+            refused, retry = get_buckets().take_all(
+                [('{}:{}'.format(limit, value),) + LIMITS[limit] for limit, value in keys])
+            if refused is not None:
+                _writes.release()
+                metrics.RATE_LIMITED.inc(request.endpoint, keys[refused][0])
+                return rejected("Too many submissions; try again in a little while.", 429, retry)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                _writes.release()
+        return limited
+    return decorator
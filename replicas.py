@@ -0,0 +1,56 @@
+import itertools
+import os
+import threading
+import time
+
+from flask import g, has_request_context, session
+
+import db
+
+# Picks the engine a read-only route queries. A request sticks to one
+# replica for all its reads, and the data it caches is keyed by the version
+# it read there first (versions.read), so rows from a replica that is
+# behind are never cached under a version they do not have. A client that
+# wrote within READ_YOUR_WRITES_SECONDS reads from the primary, versions
+# included, so it sees its own write even while the replicas are behind.
+# Outside a request, e.g. in CLI commands and background threads, reads go
+# to the primary.
+#
+# REPLICA_SELECTION is round_robin, or least_loaded for the replica with
+# the fewest connections checked out of this worker's pool.
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+
+_turn = itertools.count()
+_lock = threading.Lock()
+
+
+def choose(replicas):
+    with _lock:
+        start = next(_turn) % len(replicas)
+    if REPLICA_SELECTION == 'least_loaded':
+        # ties go round robin
+        rotated = replicas[start:] + replicas[:start]
+        return min(rotated, key=lambda engine: engine.pool.checkedout())
+    return replicas[start]
+
+
+def reading_own_writes():
+    # without replicas the session is left alone, so pages do not vary by cookie
+    return bool(db.REPLICA_DATABASE_URLS) and has_request_context() and session.get('primary_until', 0) > time.time()
+
+
+def read_engine():
+    if not has_request_context():
+        return db.get_engine()
+    if 'read_engine' not in g:
+        replicas = db.get_replica_engines()
+        g.read_engine = choose(replicas) if replicas and not reading_own_writes() else db.get_engine()
+    return g.read_engine
+
+
+def wrote():
+    # called by the write routes; the rest of this request reads the primary too
+    if db.REPLICA_DATABASE_URLS:
+        session['primary_until'] = time.time() + READ_YOUR_WRITES_SECONDS
+    g.read_engine = db.get_engine()
@@ -0,0 +1,1915 @@
+import contextlib
+import hashlib
+import os
+import sys
+
+from sqlalchemy import text
+
+from db import get_engine
+
+
+# every instance runs the migrations as it starts; on MySQL they take turns
+# under a named lock, and the ones that waited find them applied
+MIGRATION_LOCK = 'schema_migrations'
+MIGRATION_LOCK_TIMEOUT = int(os.environ.get('MIGRATION_LOCK_TIMEOUT', 600))
+
+
+class SchemaError(Exception):
+    pass
+
+
+# Every migration is (version, name, {dialect: [statements]}). Applied
+# migrations are immutable: to change a trigger or procedure, append a new
+# migration that drops and re-creates it.
+MIGRATIONS = [
+    (1, 'base tables', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS Professors (
+                ProfessorID INT AUTO_INCREMENT PRIMARY KEY,
+                Name VARCHAR(255) NOT NULL,
+                Department VARCHAR(255),
+                RMP_Link VARCHAR(255)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Courses (
+                CourseID INT AUTO_INCREMENT PRIMARY KEY,
+                CourseNumber VARCHAR(32) NOT NULL,
+                ProfessorID INT NOT NULL,
+                Title VARCHAR(255),
+                AverageRating DECIMAL(5, 2),
+                FOREIGN KEY (ProfessorID) REFERENCES Professors(ProfessorID)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Ratings (
+                RatingID INT AUTO_INCREMENT PRIMARY KEY,
+                Score DECIMAL(5, 2),
+                WouldTakeAgain BOOLEAN,
+                CourseID INT NOT NULL,
+                UserID INT,
+                FOREIGN KEY (CourseID) REFERENCES Courses(CourseID)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Comments (
+                CommentID INT AUTO_INCREMENT PRIMARY KEY,
+                Content TEXT,
+                CourseID INT NOT NULL,
+                UserID INT,
+                FOREIGN KEY (CourseID) REFERENCES Courses(CourseID)
+            )
+            ''',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS Professors (
+                ProfessorID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Name VARCHAR(255) NOT NULL,
+                Department VARCHAR(255),
+                RMP_Link VARCHAR(255)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Courses (
+                CourseID INTEGER PRIMARY KEY AUTOINCREMENT,
+                CourseNumber VARCHAR(32) NOT NULL,
+                ProfessorID INTEGER NOT NULL REFERENCES Professors(ProfessorID),
+                Title VARCHAR(255),
+                AverageRating DECIMAL(5, 2)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Ratings (
+                RatingID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Score DECIMAL(5, 2),
+                WouldTakeAgain BOOLEAN,
+                CourseID INTEGER NOT NULL REFERENCES Courses(CourseID),
+                UserID INTEGER
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS Comments (
+                CommentID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Content TEXT,
+                CourseID INTEGER NOT NULL REFERENCES Courses(CourseID),
+                UserID INTEGER
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_courses_professor ON Courses (ProfessorID)',
+            'CREATE INDEX IF NOT EXISTS idx_ratings_course ON Ratings (CourseID)',
+            'CREATE INDEX IF NOT EXISTS idx_comments_course ON Comments (CourseID)',
+        ],
+    }),
+    (2, 'average rating triggers', {
+        'mysql': [
+            'DROP TRIGGER IF EXISTS InsertAverageRating',
+            '''
+            CREATE TRIGGER InsertAverageRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE avg_rating DECIMAL(5, 2);
+                DECLARE course_id INT;
+                SET course_id = NEW.CourseID;
+                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
+                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DeleteAverageRating',
+            '''
+            CREATE TRIGGER DeleteAverageRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE avg_rating DECIMAL(5, 2);
+                DECLARE course_id INT;
+                SET course_id = OLD.CourseID;
+                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
+                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS UpdateAverageRating',
+            '''
+            CREATE TRIGGER UpdateAverageRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE avg_rating DECIMAL(5, 2);
+                DECLARE course_id INT;
+                SET course_id = NEW.CourseID;
+                SELECT AVG(Score) INTO avg_rating FROM Ratings WHERE CourseID = course_id;
+                UPDATE Courses SET AverageRating = avg_rating WHERE CourseID = course_id;
+            END
+            ''',
+        ],
+        'sqlite': [
+            'DROP TRIGGER IF EXISTS InsertAverageRating',
+            '''
+            CREATE TRIGGER InsertAverageRating
+            AFTER INSERT ON Ratings
+            BEGIN
+                UPDATE Courses SET AverageRating = (
+                    SELECT ROUND(AVG(Score), 2) FROM Ratings WHERE CourseID = NEW.CourseID
+                ) WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DeleteAverageRating',
+            '''
+            CREATE TRIGGER DeleteAverageRating
+            AFTER DELETE ON Ratings
+            BEGIN
+                UPDATE Courses SET AverageRating = (
+                    SELECT ROUND(AVG(Score), 2) FROM Ratings WHERE CourseID = OLD.CourseID
+                ) WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS UpdateAverageRating',
+            '''
+            CREATE TRIGGER UpdateAverageRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE Courses SET AverageRating = (
+                    SELECT ROUND(AVG(Score), 2) FROM Ratings WHERE CourseID = NEW.CourseID
+                ) WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+        ],
+    }),
+    (3, 'stored procedures', {
+        'mysql': [
+            'DROP PROCEDURE IF EXISTS AddCourseRatingAndComment',
+            '''
+            CREATE PROCEDURE AddCourseRatingAndComment(
+                IN p_UserID INT,
+                IN p_CourseID INT,
+                IN p_Score DECIMAL(5, 2),
+                IN p_WouldTakeAgain BOOLEAN,
+                IN p_Comment TEXT)
+            BEGIN
+                DECLARE v_alreadyRated INT;
+                SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;
+
+                START TRANSACTION;
+                SELECT COUNT(*) INTO v_alreadyRated
+                FROM Ratings
+                JOIN Comments ON Ratings.UserID = Comments.UserID AND Ratings.CourseID = Comments.CourseID
+                WHERE Ratings.UserID = p_UserID AND Ratings.CourseID = p_CourseID;
+
+                IF v_alreadyRated = 0 THEN
+                    IF CHAR_LENGTH(p_Comment) > 10 THEN
+                        INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID)
+                        VALUES (p_Score, p_WouldTakeAgain, p_CourseID, p_UserID);
+
+                        INSERT INTO Comments (Content, CourseID, UserID)
+                        VALUES (p_Comment, p_CourseID, p_UserID);
+
+                        UPDATE Courses
+                        SET AverageRating = (
+                            SELECT AVG(Score) as AverageScore
+                            FROM Ratings
+                            WHERE CourseID = p_CourseID
+                            GROUP BY CourseID
+                        )
+                        WHERE CourseID = p_CourseID;
+
+                        COMMIT;
+
+                        SELECT 'Rating and comment added successfully!' AS Result;
+                    ELSE
+                        ROLLBACK;
+                        SELECT 'Comment must be at least 10 characters long.' AS ErrorMessage;
+                    END IF;
+                ELSE
+                    ROLLBACK;
+                    SELECT 'User has already rated this course.' AS ErrorMessage;
+                END IF;
+            END
+            ''',
+            'DROP PROCEDURE IF EXISTS GetProfessorAverageScore',
+            '''
+            CREATE PROCEDURE GetProfessorAverageScore(IN prof_id INT)
+            BEGIN
+                SELECT
+                    Pr.Name AS ProfessorName,
+                    Pr.Department,
+                    AVG(OverallCourseScore) AS AvgProfessorScore
+                FROM
+                    (
+                        SELECT
+                            C.ProfessorID,
+                            AVG(R.Score) AS OverallCourseScore
+                        FROM Courses C
+                        JOIN Ratings R ON C.CourseID = R.CourseID
+                        WHERE C.ProfessorID = prof_id
+                        GROUP BY C.CourseID
+                    ) AS CourseScores
+                JOIN Professors Pr ON CourseScores.ProfessorID = Pr.ProfessorID
+                WHERE Pr.ProfessorID = prof_id
+                GROUP BY Pr.ProfessorID;
+            END
+            ''',
+            'DROP PROCEDURE IF EXISTS GetInsightfulDepartments',
+            '''
+            CREATE PROCEDURE GetInsightfulDepartments()
+            BEGIN
+                CREATE TEMPORARY TABLE HighRatings AS
+                    SELECT p.Department, AVG(r.Score) AS AverageRating
+                    FROM Professors p
+                    JOIN Courses c ON p.ProfessorID = c.ProfessorID
+                    JOIN Ratings r ON c.CourseID = r.CourseID
+                    GROUP BY p.Department
+                    HAVING COUNT(r.RatingID) > 5
+                    ORDER BY AverageRating DESC;
+
+                CREATE TEMPORARY TABLE MostComments AS
+                    SELECT p.Department, COUNT(com.CommentID) AS TotalComments
+                    FROM Professors p
+                    JOIN Courses c ON p.ProfessorID = c.ProfessorID
+                    JOIN Comments com ON c.CourseID = com.CourseID
+                    GROUP BY p.Department
+                    ORDER BY TotalComments DESC;
+
+                SELECT
+                    hr.Department,
+                    hr.AverageRating,
+                    mc.TotalComments
+                FROM HighRatings hr
+                JOIN MostComments mc ON hr.Department = mc.Department
+                ORDER BY hr.AverageRating DESC, mc.TotalComments DESC;
+
+                DROP TABLE HighRatings;
+                DROP TABLE MostComments;
+            END
+            ''',
+            'DROP PROCEDURE IF EXISTS GetPopularCourses',
+            '''
+            CREATE PROCEDURE GetPopularCourses()
+            BEGIN
+                SELECT
+                    c.CourseID,
+                    c.Title,
+                    p.Name AS ProfessorName,
+                    COUNT(DISTINCT com.CommentID) AS NumberOfComments,
+                    COALESCE(AVG(r.Score), 0) AS AverageRating
+                FROM Courses c
+                LEFT JOIN Comments com ON c.CourseID = com.CourseID
+                LEFT JOIN Ratings r ON c.CourseID = r.CourseID
+                JOIN Professors p ON c.ProfessorID = p.ProfessorID
+                GROUP BY c.CourseID, c.Title, p.Name
+                ORDER BY NumberOfComments DESC, AverageRating DESC;
+            END
+            ''',
+        ],
+        # sqlite has no stored procedures; the routes that CALL them only
+        # run against MySQL
+        'sqlite': [],
+    }),
+    (4, 'course leaderboard stats', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS CourseStats (
+                CourseID INT PRIMARY KEY,
+                CommentCount INT NOT NULL DEFAULT 0,
+                RatingSum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                RatingCount INT NOT NULL DEFAULT 0,
+                AverageRating DOUBLE,
+                INDEX idx_course_stats_popular (CommentCount, AverageRating),
+                INDEX idx_course_stats_rating (AverageRating)
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertCourse',
+            '''
+            CREATE TRIGGER CourseStatsInsertCourse
+            AFTER INSERT ON Courses
+            FOR EACH ROW
+                INSERT IGNORE INTO CourseStats (CourseID) VALUES (NEW.CourseID)
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteCourse',
+            '''
+            CREATE TRIGGER CourseStatsDeleteCourse
+            AFTER DELETE ON Courses
+            FOR EACH ROW
+                DELETE FROM CourseStats WHERE CourseID = OLD.CourseID
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertComment',
+            '''
+            CREATE TRIGGER CourseStatsInsertComment
+            AFTER INSERT ON Comments
+            FOR EACH ROW
+                UPDATE CourseStats SET CommentCount = CommentCount + 1 WHERE CourseID = NEW.CourseID
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteComment',
+            '''
+            CREATE TRIGGER CourseStatsDeleteComment
+            AFTER DELETE ON Comments
+            FOR EACH ROW
+                UPDATE CourseStats SET CommentCount = CommentCount - 1 WHERE CourseID = OLD.CourseID
+            ''',
+            # Backfill after the triggers exist: courses created in between
+            # already have a row kept current by the triggers.
+            '''
+            INSERT INTO CourseStats (CourseID, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT c.CourseID,
+                (SELECT COUNT(*) FROM Comments com WHERE com.CourseID = c.CourseID),
+                (SELECT COALESCE(SUM(r.Score), 0) FROM Ratings r WHERE r.CourseID = c.CourseID),
+                (SELECT COUNT(*) FROM Ratings r WHERE r.CourseID = c.CourseID),
+                (SELECT AVG(r.Score) FROM Ratings r WHERE r.CourseID = c.CourseID)
+            FROM Courses c
+            WHERE NOT EXISTS (SELECT 1 FROM CourseStats s WHERE s.CourseID = c.CourseID)
+            ''',
+            'DROP PROCEDURE IF EXISTS GetPopularCourses',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS CourseStats (
+                CourseID INTEGER PRIMARY KEY,
+                CommentCount INTEGER NOT NULL DEFAULT 0,
+                RatingSum REAL NOT NULL DEFAULT 0,
+                RatingCount INTEGER NOT NULL DEFAULT 0,
+                AverageRating REAL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_course_stats_popular ON CourseStats (CommentCount, AverageRating)',
+            'CREATE INDEX IF NOT EXISTS idx_course_stats_rating ON CourseStats (AverageRating)',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertCourse',
+            '''
+            CREATE TRIGGER CourseStatsInsertCourse
+            AFTER INSERT ON Courses
+            BEGIN
+                INSERT OR IGNORE INTO CourseStats (CourseID) VALUES (NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteCourse',
+            '''
+            CREATE TRIGGER CourseStatsDeleteCourse
+            AFTER DELETE ON Courses
+            BEGIN
+                DELETE FROM CourseStats WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertComment',
+            '''
+            CREATE TRIGGER CourseStatsInsertComment
+            AFTER INSERT ON Comments
+            BEGIN
+                UPDATE CourseStats SET CommentCount = CommentCount + 1 WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteComment',
+            '''
+            CREATE TRIGGER CourseStatsDeleteComment
+            AFTER DELETE ON Comments
+            BEGIN
+                UPDATE CourseStats SET CommentCount = CommentCount - 1 WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            '''
+            INSERT INTO CourseStats (CourseID, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT c.CourseID,
+                (SELECT COUNT(*) FROM Comments com WHERE com.CourseID = c.CourseID),
+                (SELECT COALESCE(SUM(r.Score), 0) FROM Ratings r WHERE r.CourseID = c.CourseID),
+                (SELECT COUNT(*) FROM Ratings r WHERE r.CourseID = c.CourseID),
+                (SELECT AVG(r.Score) FROM Ratings r WHERE r.CourseID = c.CourseID)
+            FROM Courses c
+            WHERE NOT EXISTS (SELECT 1 FROM CourseStats s WHERE s.CourseID = c.CourseID)
+            ''',
+        ],
+    }),
+    (5, 'data versions', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS DataVersions (
+                Scope VARCHAR(64) PRIMARY KEY,
+                Version BIGINT NOT NULL DEFAULT 0,
+                UpdatedAt DOUBLE NOT NULL
+            )
+            ''',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS DataVersions (
+                Scope VARCHAR(64) PRIMARY KEY,
+                Version INTEGER NOT NULL DEFAULT 0,
+                UpdatedAt REAL NOT NULL
+            )
+            ''',
+        ],
+    }),
+    (6, 'professor name index', {
+        'mysql': [
+            'CREATE INDEX idx_professors_name_department ON Professors (Name, Department)',
+        ],
+        'sqlite': [
+            'CREATE INDEX IF NOT EXISTS idx_professors_name_department ON Professors (Name, Department)',
+        ],
+    }),
+    # Courses.AverageRating used to be recomputed with AVG over every rating
+    # of the course on each write; it is now copied from the running sums in
+    # CourseStats by the same triggers that keep those current.
+    (7, 'incremental course averages', {
+        'mysql': [
+            'DROP TRIGGER IF EXISTS InsertAverageRating',
+            'DROP TRIGGER IF EXISTS DeleteAverageRating',
+            'DROP TRIGGER IF EXISTS UpdateAverageRating',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS WriteBehindApplied (
+                Token VARCHAR(36) PRIMARY KEY,
+                AppliedAt DOUBLE NOT NULL,
+                INDEX idx_write_behind_applied_at (AppliedAt)
+            )
+            ''',
+            'DROP PROCEDURE IF EXISTS AddCourseRatingAndComment',
+        ],
+        'sqlite': [
+            'DROP TRIGGER IF EXISTS InsertAverageRating',
+            'DROP TRIGGER IF EXISTS DeleteAverageRating',
+            'DROP TRIGGER IF EXISTS UpdateAverageRating',
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS WriteBehindApplied (
+                Token VARCHAR(36) PRIMARY KEY,
+                AppliedAt REAL NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_write_behind_applied_at ON WriteBehindApplied (AppliedAt)',
+        ],
+    }),
+    # Per-department totals for /insightful_courses, kept by triggers like
+    # CourseStats. A rating or comment belongs to the department of the
+    # course's professor; moving a professor or a course between departments
+    # moves its CourseStats totals. stats.py rebuilds and checks them.
+    (8, 'department stats', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS DepartmentStats (
+                Department VARCHAR(255) PRIMARY KEY,
+                CommentCount INT NOT NULL DEFAULT 0,
+                RatingSum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                RatingCount INT NOT NULL DEFAULT 0,
+                AverageRating DOUBLE,
+                INDEX idx_department_stats_rating (AverageRating, CommentCount)
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertProfessor',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertProfessor
+            AFTER INSERT ON Professors
+            FOR EACH ROW
+                INSERT IGNORE INTO DepartmentStats (Department) VALUES (COALESCE(NEW.Department, ''))
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateProfessor',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateProfessor
+            AFTER UPDATE ON Professors
+            FOR EACH ROW
+            BEGIN
+                DECLARE moved_sum DECIMAL(14, 2);
+                DECLARE moved_ratings INT;
+                DECLARE moved_comments INT;
+                IF COALESCE(OLD.Department, '') <> COALESCE(NEW.Department, '') THEN
+                    SELECT COALESCE(SUM(s.RatingSum), 0), COALESCE(SUM(s.RatingCount), 0),
+                           COALESCE(SUM(s.CommentCount), 0)
+                    INTO moved_sum, moved_ratings, moved_comments
+                    FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                    WHERE c.ProfessorID = NEW.ProfessorID;
+                    INSERT IGNORE INTO DepartmentStats (Department) VALUES (COALESCE(NEW.Department, ''));
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum - moved_sum, RatingCount = RatingCount - moved_ratings,
+                        CommentCount = CommentCount - moved_comments
+                    WHERE Department = COALESCE(OLD.Department, '');
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum + moved_sum, RatingCount = RatingCount + moved_ratings,
+                        CommentCount = CommentCount + moved_comments
+                    WHERE Department = COALESCE(NEW.Department, '');
+                    UPDATE DepartmentStats
+                    SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                    WHERE Department IN (COALESCE(OLD.Department, ''), COALESCE(NEW.Department, ''));
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateCourse',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateCourse
+            AFTER UPDATE ON Courses
+            FOR EACH ROW
+            BEGIN
+                DECLARE old_department VARCHAR(255);
+                DECLARE new_department VARCHAR(255);
+                DECLARE moved_sum DECIMAL(14, 2);
+                DECLARE moved_ratings INT;
+                DECLARE moved_comments INT;
+                IF OLD.ProfessorID <> NEW.ProfessorID THEN
+                    SELECT COALESCE(Department, '') INTO old_department
+                    FROM Professors WHERE ProfessorID = OLD.ProfessorID;
+                    SELECT COALESCE(Department, '') INTO new_department
+                    FROM Professors WHERE ProfessorID = NEW.ProfessorID;
+                    SELECT RatingSum, RatingCount, CommentCount INTO moved_sum, moved_ratings, moved_comments
+                    FROM CourseStats WHERE CourseID = NEW.CourseID;
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum - moved_sum, RatingCount = RatingCount - moved_ratings,
+                        CommentCount = CommentCount - moved_comments
+                    WHERE Department = old_department;
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum + moved_sum, RatingCount = RatingCount + moved_ratings,
+                        CommentCount = CommentCount + moved_comments
+                    WHERE Department = new_department;
+                    UPDATE DepartmentStats
+                    SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                    WHERE Department IN (old_department, new_department);
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteCourse',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteCourse
+            BEFORE DELETE ON Courses
+            FOR EACH ROW
+            BEGIN
+                DECLARE course_department VARCHAR(255);
+                SELECT COALESCE(Department, '') INTO course_department FROM Professors WHERE ProfessorID = OLD.ProfessorID;
+                UPDATE DepartmentStats d JOIN CourseStats s ON s.CourseID = OLD.CourseID
+                SET d.RatingSum = d.RatingSum - s.RatingSum, d.RatingCount = d.RatingCount - s.RatingCount,
+                    d.CommentCount = d.CommentCount - s.CommentCount
+                WHERE d.Department = course_department;
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department = course_department;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertRating',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE course_department VARCHAR(255);
+                SELECT COALESCE(p.Department, '') INTO course_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = NEW.CourseID;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE Department = course_department;
+                UPDATE DepartmentStats SET AverageRating = RatingSum / RatingCount WHERE Department = course_department;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteRating',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE course_department VARCHAR(255);
+                SELECT COALESCE(p.Department, '') INTO course_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = OLD.CourseID;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE Department = course_department;
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department = course_department;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateRating',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE old_department VARCHAR(255);
+                DECLARE new_department VARCHAR(255);
+                SELECT COALESCE(p.Department, '') INTO old_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = OLD.CourseID;
+                SELECT COALESCE(p.Department, '') INTO new_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = NEW.CourseID;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE Department = old_department;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE Department = new_department;
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (old_department, new_department);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertComment',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertComment
+            AFTER INSERT ON Comments
+            FOR EACH ROW
+                UPDATE DepartmentStats
+                SET CommentCount = CommentCount + 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID)
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteComment',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteComment
+            AFTER DELETE ON Comments
+            FOR EACH ROW
+                UPDATE DepartmentStats
+                SET CommentCount = CommentCount - 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID)
+            ''',
+            # backfill after the triggers exist, as for CourseStats
+            '''
+            INSERT INTO DepartmentStats (Department, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT COALESCE(p.Department, ''),
+                COALESCE(SUM(s.CommentCount), 0),
+                COALESCE(SUM(s.RatingSum), 0),
+                COALESCE(SUM(s.RatingCount), 0),
+                CASE WHEN SUM(s.RatingCount) > 0 THEN SUM(s.RatingSum) / SUM(s.RatingCount) END
+            FROM Professors p
+            LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+            LEFT JOIN CourseStats s ON s.CourseID = c.CourseID
+            WHERE NOT EXISTS (SELECT 1 FROM DepartmentStats d WHERE d.Department = COALESCE(p.Department, ''))
+            GROUP BY COALESCE(p.Department, '')
+            ''',
+            'DROP PROCEDURE IF EXISTS GetInsightfulDepartments',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS DepartmentStats (
+                Department VARCHAR(255) PRIMARY KEY,
+                CommentCount INTEGER NOT NULL DEFAULT 0,
+                RatingSum REAL NOT NULL DEFAULT 0,
+                RatingCount INTEGER NOT NULL DEFAULT 0,
+                AverageRating REAL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_department_stats_rating ON DepartmentStats (AverageRating, CommentCount)',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertProfessor',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertProfessor
+            AFTER INSERT ON Professors
+            BEGIN
+                INSERT OR IGNORE INTO DepartmentStats (Department) VALUES (COALESCE(NEW.Department, ''));
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateProfessor',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateProfessor
+            AFTER UPDATE OF Department ON Professors
+            WHEN COALESCE(OLD.Department, '') <> COALESCE(NEW.Department, '')
+            BEGIN
+                INSERT OR IGNORE INTO DepartmentStats (Department) VALUES (COALESCE(NEW.Department, ''));
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - (SELECT COALESCE(SUM(s.RatingSum), 0)
+                                             FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                             WHERE c.ProfessorID = NEW.ProfessorID),
+                    RatingCount = RatingCount - (SELECT COALESCE(SUM(s.RatingCount), 0)
+                                                 FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                                 WHERE c.ProfessorID = NEW.ProfessorID),
+                    CommentCount = CommentCount - (SELECT COALESCE(SUM(s.CommentCount), 0)
+                                                   FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                                   WHERE c.ProfessorID = NEW.ProfessorID)
+                WHERE Department = COALESCE(OLD.Department, '');
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + (SELECT COALESCE(SUM(s.RatingSum), 0)
+                                             FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                             WHERE c.ProfessorID = NEW.ProfessorID),
+                    RatingCount = RatingCount + (SELECT COALESCE(SUM(s.RatingCount), 0)
+                                                 FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                                 WHERE c.ProfessorID = NEW.ProfessorID),
+                    CommentCount = CommentCount + (SELECT COALESCE(SUM(s.CommentCount), 0)
+                                                   FROM Courses c JOIN CourseStats s ON s.CourseID = c.CourseID
+                                                   WHERE c.ProfessorID = NEW.ProfessorID)
+                WHERE Department = COALESCE(NEW.Department, '');
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (COALESCE(OLD.Department, ''), COALESCE(NEW.Department, ''));
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateCourse',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateCourse
+            AFTER UPDATE OF ProfessorID ON Courses
+            WHEN OLD.ProfessorID <> NEW.ProfessorID
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - (SELECT RatingSum FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatingCount = RatingCount - (SELECT RatingCount FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    CommentCount = CommentCount - (SELECT CommentCount FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE Department = (SELECT COALESCE(Department, '') FROM Professors WHERE ProfessorID = OLD.ProfessorID);
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + (SELECT RatingSum FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatingCount = RatingCount + (SELECT RatingCount FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    CommentCount = CommentCount + (SELECT CommentCount FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE Department = (SELECT COALESCE(Department, '') FROM Professors WHERE ProfessorID = NEW.ProfessorID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (SELECT COALESCE(Department, '') FROM Professors
+                                     WHERE ProfessorID IN (OLD.ProfessorID, NEW.ProfessorID));
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteCourse',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteCourse
+            BEFORE DELETE ON Courses
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - (SELECT RatingSum FROM CourseStats WHERE CourseID = OLD.CourseID),
+                    RatingCount = RatingCount - (SELECT RatingCount FROM CourseStats WHERE CourseID = OLD.CourseID),
+                    CommentCount = CommentCount - (SELECT CommentCount FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE Department = (SELECT COALESCE(Department, '') FROM Professors WHERE ProfessorID = OLD.ProfessorID)
+                AND EXISTS (SELECT 1 FROM CourseStats WHERE CourseID = OLD.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department = (SELECT COALESCE(Department, '') FROM Professors WHERE ProfessorID = OLD.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertRating',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertRating
+            AFTER INSERT ON Ratings
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = RatingSum / RatingCount
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteRating',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteRating
+            AFTER DELETE ON Ratings
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateRating',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (SELECT COALESCE(p.Department, '')
+                                     FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                     WHERE c.CourseID IN (OLD.CourseID, NEW.CourseID));
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertComment',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertComment
+            AFTER INSERT ON Comments
+            BEGIN
+                UPDATE DepartmentStats
+                SET CommentCount = CommentCount + 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteComment',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteComment
+            AFTER DELETE ON Comments
+            BEGIN
+                UPDATE DepartmentStats
+                SET CommentCount = CommentCount - 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+            END
+            ''',
+            '''
+            INSERT INTO DepartmentStats (Department, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT COALESCE(p.Department, ''),
+                COALESCE(SUM(s.CommentCount), 0),
+                COALESCE(SUM(s.RatingSum), 0),
+                COALESCE(SUM(s.RatingCount), 0),
+                CASE WHEN SUM(s.RatingCount) > 0 THEN SUM(s.RatingSum) / SUM(s.RatingCount) END
+            FROM Professors p
+            LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+            LEFT JOIN CourseStats s ON s.CourseID = c.CourseID
+            WHERE NOT EXISTS (SELECT 1 FROM DepartmentStats d WHERE d.Department = COALESCE(p.Department, ''))
+            GROUP BY COALESCE(p.Department, '')
+            ''',
+        ],
+    }),
+    # Per-professor rating totals and the mean of the professor's course
+    # averages, for professor_detail, professor_bio and professors. They
+    # follow CourseStats: every change to a course's sums or average is
+    # applied to its professor as a difference, so no write rescans ratings.
+    (9, 'professor stats', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS ProfessorStats (
+                ProfessorID INT PRIMARY KEY,
+                RatingSum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+                RatingCount INT NOT NULL DEFAULT 0,
+                RatedCourses INT NOT NULL DEFAULT 0,
+                CourseAverageSum DOUBLE NOT NULL DEFAULT 0,
+                AverageScore DOUBLE
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsInsertProfessor',
+            '''
+            CREATE TRIGGER ProfessorStatsInsertProfessor
+            AFTER INSERT ON Professors
+            FOR EACH ROW
+                INSERT IGNORE INTO ProfessorStats (ProfessorID) VALUES (NEW.ProfessorID)
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsDeleteProfessor',
+            '''
+            CREATE TRIGGER ProfessorStatsDeleteProfessor
+            AFTER DELETE ON Professors
+            FOR EACH ROW
+                DELETE FROM ProfessorStats WHERE ProfessorID = OLD.ProfessorID
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsUpdateCourseStats',
+            '''
+            CREATE TRIGGER ProfessorStatsUpdateCourseStats
+            AFTER UPDATE ON CourseStats
+            FOR EACH ROW
+            BEGIN
+                DECLARE rated_professor INT;
+                IF NEW.RatingSum <> OLD.RatingSum OR NEW.RatingCount <> OLD.RatingCount
+                        OR NOT (NEW.AverageRating <=> OLD.AverageRating) THEN
+                    SELECT ProfessorID INTO rated_professor FROM Courses WHERE CourseID = NEW.CourseID;
+                    UPDATE ProfessorStats
+                    SET RatingSum = RatingSum + NEW.RatingSum - OLD.RatingSum,
+                        RatingCount = RatingCount + NEW.RatingCount - OLD.RatingCount,
+                        RatedCourses = RatedCourses + (NEW.RatingCount > 0) - (OLD.RatingCount > 0),
+                        CourseAverageSum = CourseAverageSum + COALESCE(NEW.AverageRating, 0) - COALESCE(OLD.AverageRating, 0)
+                    WHERE ProfessorID = rated_professor;
+                    UPDATE ProfessorStats
+                    SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                    WHERE ProfessorID = rated_professor;
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsUpdateCourse',
+            '''
+            CREATE TRIGGER ProfessorStatsUpdateCourse
+            AFTER UPDATE ON Courses
+            FOR EACH ROW
+            BEGIN
+                DECLARE moved_sum DECIMAL(14, 2);
+                DECLARE moved_ratings INT;
+                DECLARE moved_average DOUBLE;
+                IF OLD.ProfessorID <> NEW.ProfessorID THEN
+                    SELECT RatingSum, RatingCount, AverageRating INTO moved_sum, moved_ratings, moved_average
+                    FROM CourseStats WHERE CourseID = NEW.CourseID;
+                    UPDATE ProfessorStats
+                    SET RatingSum = RatingSum - moved_sum, RatingCount = RatingCount - moved_ratings,
+                        RatedCourses = RatedCourses - (moved_ratings > 0),
+                        CourseAverageSum = CourseAverageSum - COALESCE(moved_average, 0)
+                    WHERE ProfessorID = OLD.ProfessorID;
+                    UPDATE ProfessorStats
+                    SET RatingSum = RatingSum + moved_sum, RatingCount = RatingCount + moved_ratings,
+                        RatedCourses = RatedCourses + (moved_ratings > 0),
+                        CourseAverageSum = CourseAverageSum + COALESCE(moved_average, 0)
+                    WHERE ProfessorID = NEW.ProfessorID;
+                    UPDATE ProfessorStats
+                    SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                    WHERE ProfessorID IN (OLD.ProfessorID, NEW.ProfessorID);
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsDeleteCourse',
+            '''
+            CREATE TRIGGER ProfessorStatsDeleteCourse
+            BEFORE DELETE ON Courses
+            FOR EACH ROW
+            BEGIN
+                UPDATE ProfessorStats p JOIN CourseStats s ON s.CourseID = OLD.CourseID
+                SET p.RatingSum = p.RatingSum - s.RatingSum, p.RatingCount = p.RatingCount - s.RatingCount,
+                    p.RatedCourses = p.RatedCourses - (s.RatingCount > 0),
+                    p.CourseAverageSum = p.CourseAverageSum - COALESCE(s.AverageRating, 0)
+                WHERE p.ProfessorID = OLD.ProfessorID;
+                UPDATE ProfessorStats
+                SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                WHERE ProfessorID = OLD.ProfessorID;
+            END
+            ''',
+            '''
+            INSERT INTO ProfessorStats (ProfessorID, RatingSum, RatingCount, RatedCourses, CourseAverageSum, AverageScore)
+            SELECT p.ProfessorID,
+                COALESCE(SUM(s.RatingSum), 0),
+                COALESCE(SUM(s.RatingCount), 0),
+                COALESCE(SUM(CASE WHEN s.RatingCount > 0 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(s.AverageRating), 0),
+                AVG(s.AverageRating)
+            FROM Professors p
+            LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+            LEFT JOIN CourseStats s ON s.CourseID = c.CourseID
+            WHERE NOT EXISTS (SELECT 1 FROM ProfessorStats ps WHERE ps.ProfessorID = p.ProfessorID)
+            GROUP BY p.ProfessorID
+            ''',
+            'DROP PROCEDURE IF EXISTS GetProfessorAverageScore',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS ProfessorStats (
+                ProfessorID INTEGER PRIMARY KEY,
+                RatingSum REAL NOT NULL DEFAULT 0,
+                RatingCount INTEGER NOT NULL DEFAULT 0,
+                RatedCourses INTEGER NOT NULL DEFAULT 0,
+                CourseAverageSum REAL NOT NULL DEFAULT 0,
+                AverageScore REAL
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsInsertProfessor',
+            '''
+            CREATE TRIGGER ProfessorStatsInsertProfessor
+            AFTER INSERT ON Professors
+            BEGIN
+                INSERT OR IGNORE INTO ProfessorStats (ProfessorID) VALUES (NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsDeleteProfessor',
+            '''
+            CREATE TRIGGER ProfessorStatsDeleteProfessor
+            AFTER DELETE ON Professors
+            BEGIN
+                DELETE FROM ProfessorStats WHERE ProfessorID = OLD.ProfessorID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsUpdateCourseStats',
+            '''
+            CREATE TRIGGER ProfessorStatsUpdateCourseStats
+            AFTER UPDATE OF RatingSum, RatingCount, AverageRating ON CourseStats
+            BEGIN
+                UPDATE ProfessorStats
+                SET RatingSum = RatingSum + NEW.RatingSum - OLD.RatingSum,
+                    RatingCount = RatingCount + NEW.RatingCount - OLD.RatingCount,
+                    RatedCourses = RatedCourses + (NEW.RatingCount > 0) - (OLD.RatingCount > 0),
+                    CourseAverageSum = CourseAverageSum + COALESCE(NEW.AverageRating, 0) - COALESCE(OLD.AverageRating, 0)
+                WHERE ProfessorID = (SELECT ProfessorID FROM Courses WHERE CourseID = NEW.CourseID);
+                UPDATE ProfessorStats
+                SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                WHERE ProfessorID = (SELECT ProfessorID FROM Courses WHERE CourseID = NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsUpdateCourse',
+            '''
+            CREATE TRIGGER ProfessorStatsUpdateCourse
+            AFTER UPDATE OF ProfessorID ON Courses
+            WHEN OLD.ProfessorID <> NEW.ProfessorID
+            BEGIN
+                UPDATE ProfessorStats
+                SET RatingSum = RatingSum - (SELECT RatingSum FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatingCount = RatingCount - (SELECT RatingCount FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatedCourses = RatedCourses - (SELECT RatingCount > 0 FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    CourseAverageSum = CourseAverageSum - (SELECT COALESCE(AverageRating, 0) FROM CourseStats
+                                                           WHERE CourseID = NEW.CourseID)
+                WHERE ProfessorID = OLD.ProfessorID;
+                UPDATE ProfessorStats
+                SET RatingSum = RatingSum + (SELECT RatingSum FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatingCount = RatingCount + (SELECT RatingCount FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    RatedCourses = RatedCourses + (SELECT RatingCount > 0 FROM CourseStats WHERE CourseID = NEW.CourseID),
+                    CourseAverageSum = CourseAverageSum + (SELECT COALESCE(AverageRating, 0) FROM CourseStats
+                                                           WHERE CourseID = NEW.CourseID)
+                WHERE ProfessorID = NEW.ProfessorID;
+                UPDATE ProfessorStats
+                SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                WHERE ProfessorID IN (OLD.ProfessorID, NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ProfessorStatsDeleteCourse',
+            '''
+            CREATE TRIGGER ProfessorStatsDeleteCourse
+            BEFORE DELETE ON Courses
+            BEGIN
+                UPDATE ProfessorStats
+                SET RatingSum = RatingSum - (SELECT RatingSum FROM CourseStats WHERE CourseID = OLD.CourseID),
+                    RatingCount = RatingCount - (SELECT RatingCount FROM CourseStats WHERE CourseID = OLD.CourseID),
+                    RatedCourses = RatedCourses - (SELECT RatingCount > 0 FROM CourseStats WHERE CourseID = OLD.CourseID),
+                    CourseAverageSum = CourseAverageSum - (SELECT COALESCE(AverageRating, 0) FROM CourseStats
+                                                           WHERE CourseID = OLD.CourseID)
+                WHERE ProfessorID = OLD.ProfessorID
+                AND EXISTS (SELECT 1 FROM CourseStats WHERE CourseID = OLD.CourseID);
+                UPDATE ProfessorStats
+                SET AverageScore = CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+                WHERE ProfessorID = OLD.ProfessorID;
+            END
+            ''',
+            '''
+            INSERT INTO ProfessorStats (ProfessorID, RatingSum, RatingCount, RatedCourses, CourseAverageSum, AverageScore)
+            SELECT p.ProfessorID,
+                COALESCE(SUM(s.RatingSum), 0),
+                COALESCE(SUM(s.RatingCount), 0),
+                COALESCE(SUM(CASE WHEN s.RatingCount > 0 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(s.AverageRating), 0),
+                AVG(s.AverageRating)
+            FROM Professors p
+            LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+            LEFT JOIN CourseStats s ON s.CourseID = c.CourseID
+            WHERE NOT EXISTS (SELECT 1 FROM ProfessorStats ps WHERE ps.ProfessorID = p.ProfessorID)
+            GROUP BY p.ProfessorID
+            ''',
+        ],
+    }),
+    # User IDs used to come from last_user_id.txt; identity.py now reserves
+    # blocks of them from this counter, which starts past every ID in use.
+    (10, 'id sequences', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS IdSequences (
+                Name VARCHAR(64) PRIMARY KEY,
+                NextValue BIGINT NOT NULL
+            )
+            ''',
+            '''
+            INSERT INTO IdSequences (Name, NextValue)
+            SELECT 'users', COALESCE(MAX(UserID), 0) + 1
+            FROM (SELECT UserID FROM Ratings UNION ALL SELECT UserID FROM Comments) AS used
+            ''',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS IdSequences (
+                Name VARCHAR(64) PRIMARY KEY,
+                NextValue INTEGER NOT NULL
+            )
+            ''',
+            '''
+            INSERT INTO IdSequences (Name, NextValue)
+            SELECT 'users', COALESCE(MAX(UserID), 0) + 1
+            FROM (SELECT UserID FROM Ratings UNION ALL SELECT UserID FROM Comments) AS used
+            ''',
+        ],
+    }),
+    # catalog.py keeps Professors and Courses in memory and reloads the
+    # professors listed here since the last change it saw. Only the columns
+    # it keeps count, so the rating triggers' updates to Courses.AverageRating
+    # are not logged. ProfessorID is NULL for a course without a professor.
+    (11, 'catalog changes', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS CatalogChanges (
+                ChangeID BIGINT AUTO_INCREMENT PRIMARY KEY,
+                ProfessorID INT
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesInsertProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesInsertProfessor
+            AFTER INSERT ON Professors
+            FOR EACH ROW
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID)
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesUpdateProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesUpdateProfessor
+            AFTER UPDATE ON Professors
+            FOR EACH ROW
+            BEGIN
+                IF NOT (OLD.Name <=> NEW.Name AND OLD.Department <=> NEW.Department) THEN
+                    INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID);
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesDeleteProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesDeleteProfessor
+            AFTER DELETE ON Professors
+            FOR EACH ROW
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID)
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesInsertCourse',
+            '''
+            CREATE TRIGGER CatalogChangesInsertCourse
+            AFTER INSERT ON Courses
+            FOR EACH ROW
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID)
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesUpdateCourse',
+            '''
+            CREATE TRIGGER CatalogChangesUpdateCourse
+            AFTER UPDATE ON Courses
+            FOR EACH ROW
+            BEGIN
+                IF NOT (OLD.CourseNumber <=> NEW.CourseNumber AND OLD.Title <=> NEW.Title
+                        AND OLD.ProfessorID <=> NEW.ProfessorID) THEN
+                    INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID), (NEW.ProfessorID);
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesDeleteCourse',
+            '''
+            CREATE TRIGGER CatalogChangesDeleteCourse
+            AFTER DELETE ON Courses
+            FOR EACH ROW
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID)
+            ''',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS CatalogChanges (
+                ChangeID INTEGER PRIMARY KEY AUTOINCREMENT,
+                ProfessorID INTEGER
+            )
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesInsertProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesInsertProfessor
+            AFTER INSERT ON Professors
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesUpdateProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesUpdateProfessor
+            AFTER UPDATE OF Name, Department ON Professors
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesDeleteProfessor',
+            '''
+            CREATE TRIGGER CatalogChangesDeleteProfessor
+            AFTER DELETE ON Professors
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesInsertCourse',
+            '''
+            CREATE TRIGGER CatalogChangesInsertCourse
+            AFTER INSERT ON Courses
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesUpdateCourse',
+            '''
+            CREATE TRIGGER CatalogChangesUpdateCourse
+            AFTER UPDATE OF CourseNumber, Title, ProfessorID ON Courses
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID), (NEW.ProfessorID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CatalogChangesDeleteCourse',
+            '''
+            CREATE TRIGGER CatalogChangesDeleteCourse
+            AFTER DELETE ON Courses
+            BEGIN
+                INSERT INTO CatalogChanges (ProfessorID) VALUES (OLD.ProfessorID);
+            END
+            ''',
+        ],
+    }),
+    # A rating without a score is not a rating: the CourseStats and
+    # DepartmentStats triggers counted a NULL score as a 0, where the AVG they
+    # replaced skipped it. They now add and count only scores that are set,
+    # and the totals of courses with NULL scores are recomputed; ProfessorStats
+    # follows CourseStats through its own trigger.
+    (12, 'non-null rating scores', {
+        'mysql': [
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                IF NEW.Score IS NOT NULL THEN
+                    UPDATE CourseStats
+                    SET RatingSum = RatingSum + NEW.Score, RatingCount = RatingCount + 1
+                    WHERE CourseID = NEW.CourseID;
+                    UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+                    UPDATE Courses
+                    SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                    WHERE CourseID = NEW.CourseID;
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                IF OLD.Score IS NOT NULL THEN
+                    UPDATE CourseStats
+                    SET RatingSum = RatingSum - OLD.Score, RatingCount = RatingCount - 1
+                    WHERE CourseID = OLD.CourseID;
+                    UPDATE CourseStats
+                    SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                    WHERE CourseID = OLD.CourseID;
+                    UPDATE Courses
+                    SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                    WHERE CourseID = OLD.CourseID;
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - (OLD.Score IS NOT NULL)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + (NEW.Score IS NOT NULL)
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertRating',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertRating
+            AFTER INSERT ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE course_department VARCHAR(255);
+                IF NEW.Score IS NOT NULL THEN
+                    SELECT COALESCE(p.Department, '') INTO course_department
+                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                    WHERE c.CourseID = NEW.CourseID;
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum + NEW.Score, RatingCount = RatingCount + 1
+                    WHERE Department = course_department;
+                    UPDATE DepartmentStats SET AverageRating = RatingSum / RatingCount WHERE Department = course_department;
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteRating',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE course_department VARCHAR(255);
+                IF OLD.Score IS NOT NULL THEN
+                    SELECT COALESCE(p.Department, '') INTO course_department
+                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                    WHERE c.CourseID = OLD.CourseID;
+                    UPDATE DepartmentStats
+                    SET RatingSum = RatingSum - OLD.Score, RatingCount = RatingCount - 1
+                    WHERE Department = course_department;
+                    UPDATE DepartmentStats
+                    SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                    WHERE Department = course_department;
+                END IF;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateRating',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            FOR EACH ROW
+            BEGIN
+                DECLARE old_department VARCHAR(255);
+                DECLARE new_department VARCHAR(255);
+                SELECT COALESCE(p.Department, '') INTO old_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = OLD.CourseID;
+                SELECT COALESCE(p.Department, '') INTO new_department
+                FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                WHERE c.CourseID = NEW.CourseID;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - (OLD.Score IS NOT NULL)
+                WHERE Department = old_department;
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + (NEW.Score IS NOT NULL)
+                WHERE Department = new_department;
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (old_department, new_department);
+            END
+            ''',
+            # courses with a NULL score were counted wrong; their professors
+            # follow through ProfessorStatsUpdateCourseStats
+            '''
+            UPDATE CourseStats
+            SET RatingSum = (SELECT COALESCE(SUM(r.Score), 0) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID),
+                RatingCount = (SELECT COUNT(r.Score) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID),
+                AverageRating = (SELECT AVG(r.Score) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID)
+            WHERE CourseID IN (SELECT CourseID FROM Ratings WHERE Score IS NULL)
+            ''',
+            '''
+            UPDATE Courses
+            SET AverageRating = (SELECT ROUND(s.AverageRating, 2) FROM CourseStats s WHERE s.CourseID = Courses.CourseID)
+            WHERE CourseID IN (SELECT CourseID FROM Ratings WHERE Score IS NULL)
+            ''',
+            '''
+            UPDATE DepartmentStats
+            SET RatingSum = (SELECT COALESCE(SUM(s.RatingSum), 0)
+                             FROM Professors p
+                             JOIN Courses c ON c.ProfessorID = p.ProfessorID
+                             JOIN CourseStats s ON s.CourseID = c.CourseID
+                             WHERE COALESCE(p.Department, '') = DepartmentStats.Department),
+                RatingCount = (SELECT COALESCE(SUM(s.RatingCount), 0)
+                               FROM Professors p
+                               JOIN Courses c ON c.ProfessorID = p.ProfessorID
+                               JOIN CourseStats s ON s.CourseID = c.CourseID
+                               WHERE COALESCE(p.Department, '') = DepartmentStats.Department)
+            ''',
+            '''
+            UPDATE DepartmentStats
+            SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+            ''',
+        ],
+        'sqlite': [
+            'DROP TRIGGER IF EXISTS CourseStatsInsertRating',
+            '''
+            CREATE TRIGGER CourseStatsInsertRating
+            AFTER INSERT ON Ratings
+            WHEN NEW.Score IS NOT NULL
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + NEW.Score, RatingCount = RatingCount + 1
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats SET AverageRating = RatingSum / RatingCount WHERE CourseID = NEW.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsDeleteRating',
+            '''
+            CREATE TRIGGER CourseStatsDeleteRating
+            AFTER DELETE ON Ratings
+            WHEN OLD.Score IS NOT NULL
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - OLD.Score, RatingCount = RatingCount - 1
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS CourseStatsUpdateRating',
+            '''
+            CREATE TRIGGER CourseStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE CourseStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - (OLD.Score IS NOT NULL)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE CourseStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + (NEW.Score IS NOT NULL)
+                WHERE CourseID = NEW.CourseID;
+                UPDATE CourseStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE CourseID IN (OLD.CourseID, NEW.CourseID);
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = OLD.CourseID)
+                WHERE CourseID = OLD.CourseID;
+                UPDATE Courses
+                SET AverageRating = (SELECT ROUND(AverageRating, 2) FROM CourseStats WHERE CourseID = NEW.CourseID)
+                WHERE CourseID = NEW.CourseID;
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsInsertRating',
+            '''
+            CREATE TRIGGER DepartmentStatsInsertRating
+            AFTER INSERT ON Ratings
+            WHEN NEW.Score IS NOT NULL
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + NEW.Score, RatingCount = RatingCount + 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = RatingSum / RatingCount
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsDeleteRating',
+            '''
+            CREATE TRIGGER DepartmentStatsDeleteRating
+            AFTER DELETE ON Ratings
+            WHEN OLD.Score IS NOT NULL
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - OLD.Score, RatingCount = RatingCount - 1
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS DepartmentStatsUpdateRating',
+            '''
+            CREATE TRIGGER DepartmentStatsUpdateRating
+            AFTER UPDATE ON Ratings
+            BEGIN
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum - COALESCE(OLD.Score, 0), RatingCount = RatingCount - (OLD.Score IS NOT NULL)
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = OLD.CourseID);
+                UPDATE DepartmentStats
+                SET RatingSum = RatingSum + COALESCE(NEW.Score, 0), RatingCount = RatingCount + (NEW.Score IS NOT NULL)
+                WHERE Department = (SELECT COALESCE(p.Department, '')
+                                    FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                    WHERE c.CourseID = NEW.CourseID);
+                UPDATE DepartmentStats
+                SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+                WHERE Department IN (SELECT COALESCE(p.Department, '')
+                                     FROM Courses c JOIN Professors p ON p.ProfessorID = c.ProfessorID
+                                     WHERE c.CourseID IN (OLD.CourseID, NEW.CourseID));
+            END
+            ''',
+            '''
+            UPDATE CourseStats
+            SET RatingSum = (SELECT COALESCE(SUM(r.Score), 0) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID),
+                RatingCount = (SELECT COUNT(r.Score) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID),
+                AverageRating = (SELECT AVG(r.Score) FROM Ratings r WHERE r.CourseID = CourseStats.CourseID)
+            WHERE CourseID IN (SELECT CourseID FROM Ratings WHERE Score IS NULL)
+            ''',
+            '''
+            UPDATE Courses
+            SET AverageRating = (SELECT ROUND(s.AverageRating, 2) FROM CourseStats s WHERE s.CourseID = Courses.CourseID)
+            WHERE CourseID IN (SELECT CourseID FROM Ratings WHERE Score IS NULL)
+            ''',
+            '''
+            UPDATE DepartmentStats
+            SET RatingSum = (SELECT COALESCE(SUM(s.RatingSum), 0)
+                             FROM Professors p
+                             JOIN Courses c ON c.ProfessorID = p.ProfessorID
+                             JOIN CourseStats s ON s.CourseID = c.CourseID
+                             WHERE COALESCE(p.Department, '') = DepartmentStats.Department),
+                RatingCount = (SELECT COALESCE(SUM(s.RatingCount), 0)
+                               FROM Professors p
+                               JOIN Courses c ON c.ProfessorID = p.ProfessorID
+                               JOIN CourseStats s ON s.CourseID = c.CourseID
+                               WHERE COALESCE(p.Department, '') = DepartmentStats.Department)
+            ''',
+            '''
+            UPDATE DepartmentStats
+            SET AverageRating = CASE WHEN RatingCount > 0 THEN RatingSum / RatingCount END
+            ''',
+        ],
+    }),
+    # One review per user and course, kept by the database rather than a
+    # check before the insert: writebehind.apply_writes inserts the key
+    # first, and a second review of the course fails on it. A key goes when
+    # the user has no rating or no comment left on the course.
+    (13, 'review keys', {
+        'mysql': [
+            '''
+            CREATE TABLE IF NOT EXISTS Reviews (
+                UserID INT NOT NULL,
+                CourseID INT NOT NULL,
+                PRIMARY KEY (UserID, CourseID)
+            )
+            ''',
+            '''
+            INSERT IGNORE INTO Reviews (UserID, CourseID)
+            SELECT DISTINCT r.UserID, r.CourseID
+            FROM Ratings r
+            JOIN Comments com ON com.UserID = r.UserID AND com.CourseID = r.CourseID
+            ''',
+            'DROP TRIGGER IF EXISTS ReviewsDeleteRating',
+            '''
+            CREATE TRIGGER ReviewsDeleteRating
+            AFTER DELETE ON Ratings
+            FOR EACH ROW
+                DELETE FROM Reviews
+                WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID
+                    AND NOT EXISTS (SELECT 1 FROM Ratings WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID)
+            ''',
+            'DROP TRIGGER IF EXISTS ReviewsDeleteComment',
+            '''
+            CREATE TRIGGER ReviewsDeleteComment
+            AFTER DELETE ON Comments
+            FOR EACH ROW
+                DELETE FROM Reviews
+                WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID
+                    AND NOT EXISTS (SELECT 1 FROM Comments WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID)
+            ''',
+        ],
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS Reviews (
+                UserID INTEGER NOT NULL,
+                CourseID INTEGER NOT NULL,
+                PRIMARY KEY (UserID, CourseID)
+            )
+            ''',
+            '''
+            INSERT OR IGNORE INTO Reviews (UserID, CourseID)
+            SELECT DISTINCT r.UserID, r.CourseID
+            FROM Ratings r
+            JOIN Comments com ON com.UserID = r.UserID AND com.CourseID = r.CourseID
+            ''',
+            'DROP TRIGGER IF EXISTS ReviewsDeleteRating',
+            '''
+            CREATE TRIGGER ReviewsDeleteRating
+            AFTER DELETE ON Ratings
+            BEGIN
+                DELETE FROM Reviews
+                WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID
+                    AND NOT EXISTS (SELECT 1 FROM Ratings WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID);
+            END
+            ''',
+            'DROP TRIGGER IF EXISTS ReviewsDeleteComment',
+            '''
+            CREATE TRIGGER ReviewsDeleteComment
+            AFTER DELETE ON Comments
+            BEGIN
+                DELETE FROM Reviews
+                WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID
+                    AND NOT EXISTS (SELECT 1 FROM Comments WHERE UserID = OLD.UserID AND CourseID = OLD.CourseID);
+            END
+            ''',
+        ],
+    }),
+]
+
+MIGRATIONS_TABLE = {
+    'mysql': '''
+        CREATE TABLE IF NOT EXISTS SchemaMigrations (
+            Version INT PRIMARY KEY,
+            Name VARCHAR(255) NOT NULL,
+            Checksum CHAR(64) NOT NULL,
+            AppliedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    'sqlite': '''
+        CREATE TABLE IF NOT EXISTS SchemaMigrations (
+            Version INTEGER PRIMARY KEY,
+            Name VARCHAR(255) NOT NULL,
+            Checksum CHAR(64) NOT NULL,
+            AppliedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+}
+
+
+def migration_statements(statements_by_dialect, dialect):
+    if dialect not in statements_by_dialect:
+        raise SchemaError("No migration statements for dialect '{}'".format(dialect))
+    return statements_by_dialect[dialect]
+
+
+def checksum(statements):
+    digest = hashlib.sha256()
+    for statement in statements:
+        digest.update(' '.join(statement.split()).encode('utf-8'))
+        digest.update(b';')
+    return digest.hexdigest()
+
+
+def applied_migrations(conn):
+    rows = conn.execute(text('SELECT Version, Name, Checksum FROM SchemaMigrations')).fetchall()
+    return {row.Version: row for row in rows}
+
+
+@contextlib.contextmanager
+def migration_lock(engine):
+    # GET_LOCK belongs to the connection that took it, so that one is held
+    # until the migrations are done; a SQLite file has a single writer
+    if engine.dialect.name != 'mysql':
+        yield
+        return
+    with engine.connect() as conn:
+        if conn.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                        {'name': MIGRATION_LOCK, 'timeout': MIGRATION_LOCK_TIMEOUT}).scalar() != 1:
+            raise SchemaError("Timed out waiting for another instance to finish migrating")
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MIGRATION_LOCK})
+
+
+def install(engine=None, log=print):
+    engine = engine or get_engine()
+    with migration_lock(engine):
+        migrate(engine, log)
+
+
+def migrate(engine, log):
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        conn.execute(text(MIGRATIONS_TABLE[dialect]))
+        applied = applied_migrations(conn)
+
+    for version, name, statements_by_dialect in MIGRATIONS:
+        statements = migration_statements(statements_by_dialect, dialect)
+        expected = checksum(statements)
+        if version in applied:
+            if applied[version].Checksum != expected:
+                raise SchemaError("Migration {} ({}) was changed after it was applied".format(version, name))
+            continue
+        # MySQL commits DDL implicitly, so each migration is recorded only
+        # after all of its statements went through
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(text('''
+                INSERT INTO SchemaMigrations (Version, Name, Checksum)
+                VALUES (:version, :name, :checksum)
+            '''), {'version': version, 'name': name, 'checksum': expected})
+        log("Applied migration {}: {}".format(version, name))
+
+
+def verify(engine=None):
+    engine = engine or get_engine()
+    dialect = engine.dialect.name
+    problems = []
+    try:
+        with engine.connect() as conn:
+            applied = applied_migrations(conn)
+    except Exception as e:
+        return ["Schema migrations table is not readable: {}".format(e)]
+
+    for version, name, statements_by_dialect in MIGRATIONS:
+        if version not in applied:
+            problems.append("Migration {} ({}) has not been applied".format(version, name))
+        elif applied[version].Checksum != checksum(migration_statements(statements_by_dialect, dialect)):
+            problems.append("Migration {} ({}) checksum does not match".format(version, name))
+    return problems
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'install'
+    if command == 'install':
+        install()
+    elif command == 'verify':
+        problems = verify()
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    else:
+        print("usage: python schema.py [install|verify]")
+        sys.exit(2)
@@ -0,0 +1,739 @@
+import bisect
+import heapq
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, text
+
+from catalog import catalog
+
+# The index is per process; other workers pick up writes on their next rebuild.
+SEARCH_INDEX_MAX_AGE = float(os.environ.get('SEARCH_INDEX_MAX_AGE', 300))
+SEARCH_RESULT_LIMIT = int(os.environ.get('SEARCH_RESULT_LIMIT', 100))
+GRAM_SIZE = 3
+
+# Review search is also per process. Comments past the newest indexed one
+# are read in after every write in this process and at most every
+# COMMENT_INDEX_REFRESH seconds on a search. At most every
+# COMMENT_INDEX_RECONCILE seconds a search also has the index checked
+# against every CommentID in the table, in the background: that adds the
+# comments a refresh missed (one committed further below the newest than
+# the lookback) and drops those deleted by other workers. A deleted comment
+# leaves its postings behind until the index is rebuilt, which happens
+# once they make up COMMENT_INDEX_MAX_DELETED of it.
+COMMENT_INDEX_REFRESH = float(os.environ.get('COMMENT_INDEX_REFRESH', 5))
+COMMENT_INDEX_RECONCILE = float(os.environ.get('COMMENT_INDEX_RECONCILE', 60))
+COMMENT_INDEX_MAX_DELETED = float(os.environ.get('COMMENT_INDEX_MAX_DELETED', 0.2))
+COMMENT_RESULT_LIMIT = int(os.environ.get('COMMENT_RESULT_LIMIT', 20))
+# IDs this far below the newest indexed one are checked again on a refresh,
+# for comments that committed after a comment with a higher ID
+COMMENT_REFRESH_LOOKBACK = 200
+BM25_K1 = 1.2
+BM25_B = 0.75
+# postings are split into blocks of this many comments, each with the
+# highest term frequency in it and the fewest words per occurrence
+BM25_BLOCK = 128
+SNIPPET_WORDS = 24
+STOPWORDS = frozenset('''
+    a an and are as at be but by for from had has have he her his i if in is it its me my of on or our she so
+    than that the their them then there they this to was we were what when which who will with would you your
+'''.split())
+TOKEN = re.compile(r'[^\W_]+')
+
+LIKE_ESCAPE = '!'
+
+
+def grams(value):
+    # every substring of up to GRAM_SIZE characters, so one to three character
+    # queries are a single posting lookup and longer ones intersect trigrams
+    found = set()
+    for size in range(1, GRAM_SIZE + 1):
+        for start in range(len(value) - size + 1):
+            found.add(value[start:start + size])
+    return found
+
+
+def query_grams(query):
+    if len(query) <= GRAM_SIZE:
+        return {query}
+    return {query[start:start + GRAM_SIZE] for start in range(len(query) - GRAM_SIZE + 1)}
+
+
+def post(postings, value, key):
+    for gram in grams(value):
+        postings.setdefault(gram, set()).add(key)
+
+
+def unpost(postings, value, key):
+    for gram in grams(value):
+        keys = postings.get(gram)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del postings[gram]
+
+
+def candidates(postings, query):
+    found = []
+    for gram in query_grams(query):
+        posting = postings.get(gram)
+        if not posting:
+            return []
+        found.append(posting)
+    return sorted(found, key=len)
+
+
+class SearchIndex:
+    def __init__(self):
+        self.names = {}
+        self.lower_names = {}
+        # professor -> lowercased course numbers, and the reverse
+        self.course_numbers = {}
+        self.course_professors = {}
+        # gram -> professor ids / gram -> distinct course numbers
+        self.name_postings = {}
+        self.course_postings = {}
+        # (lowercased name, id) and (lowercased word, id) in sorted order so
+        # prefix matches are a bisect plus a short walk
+        self.sorted_names = []
+        self.sorted_words = []
+        self._order = None
+        self._ordered_postings = {}
+        self._teaching_cache = {}
+        self._ordered_teaching = {}
+        self._ordered_words = {}
+        self.built_at = None
+        self._lock = threading.RLock()
+        self._building = False
+
+    @property
+    def ready(self):
+        return self.built_at is not None
+
+    @property
+    def stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > SEARCH_INDEX_MAX_AGE
+
+    def _changed(self):
+        self._order = None
+        self._ordered_postings = {}
+        self._teaching_cache = {}
+        self._ordered_teaching = {}
+        self._ordered_words = {}
+
+    def add_professor(self, prof_id, name, course_numbers=()):
+        name = name or ''
+        lower = name.lower()
+        with self._lock:
+            old = self.lower_names.get(prof_id)
+            if old is not None:
+                unpost(self.name_postings, old, prof_id)
+                self.sorted_names.remove((old, prof_id))
+                for word in set(old.split()):
+                    self.sorted_words.remove((word, prof_id))
+            self.names[prof_id] = name
+            self.lower_names[prof_id] = lower
+            post(self.name_postings, lower, prof_id)
+            bisect.insort(self.sorted_names, (lower, prof_id))
+            for word in set(lower.split()):
+                bisect.insort(self.sorted_words, (word, prof_id))
+            for course_number in course_numbers:
+                self.add_course(prof_id, course_number)
+            self._changed()
+
+    def update_professor(self, prof_id, name):
+        self.add_professor(prof_id, name)
+
+    def add_course(self, prof_id, course_number):
+        course_number = (course_number or '').lower()
+        with self._lock:
+            self.course_numbers.setdefault(prof_id, set()).add(course_number)
+            if course_number not in self.course_professors:
+                post(self.course_postings, course_number, course_number)
+            self.course_professors.setdefault(course_number, set()).add(prof_id)
+            self._changed()
+
+    def _name_order(self):
+        if self._order is None:
+            self._order = {prof_id: position for position, (_, prof_id) in enumerate(self.sorted_names)}
+        return self._order
+
+    def _in_name_order(self, ids):
+        return sorted(ids, key=self._name_order().__getitem__)
+
+    def _teaching(self, course_number):
+        # professors teaching a course whose number contains the query. Course
+        # numbers repeat across sections, so this matches against the distinct
+        # numbers and only then expands to professors. Results are kept until
+        # the next write since the same prefixes are typed over and over.
+        teaching = self._teaching_cache.get(course_number)
+        if teaching is None:
+            if len(self._teaching_cache) >= 256:
+                self._teaching_cache.clear()
+            teaching = self._teaching_cache[course_number] = self._find_teaching(course_number)
+        return teaching
+
+    def _teaching_in_order(self, course_number):
+        # the same professors in name order, kept alongside
+        ordered = self._ordered_teaching.get(course_number)
+        if ordered is None:
+            if len(self._ordered_teaching) >= 256:
+                self._ordered_teaching.clear()
+            ordered = self._ordered_teaching[course_number] = self._in_name_order(self._teaching(course_number))
+        return ordered
+
+    def _find_teaching(self, course_number):
+        postings = candidates(self.course_postings, course_number)
+        if not postings:
+            return set()
+        numbers = postings[0].intersection(*postings[1:])
+        if len(course_number) > GRAM_SIZE:
+            numbers = [number for number in numbers if course_number in number]
+        return set().union(*[self.course_professors[number] for number in numbers])
+
+    def _name_contains(self, query):
+        # in name order: walk the rarest gram's posting list (sorted once and
+        # kept until the next write) and probe the others
+        postings = candidates(self.name_postings, query)
+        if not postings:
+            return
+        rarest = min(query_grams(query), key=lambda gram: len(self.name_postings[gram]))
+        ordered = self._ordered_postings.get(rarest)
+        if ordered is None:
+            ordered = self._ordered_postings[rarest] = self._in_name_order(self.name_postings[rarest])
+        others = [posting for posting in postings if posting is not self.name_postings[rarest]]
+        for prof_id in ordered:
+            if all(prof_id in posting for posting in others) and (
+                    len(query) <= GRAM_SIZE or query in self.lower_names[prof_id]):
+                yield prof_id
+
+    def _prefix(self, entries, query):
+        position = bisect.bisect_left(entries, (query,))
+        while position < len(entries) and entries[position][0].startswith(query):
+            yield entries[position][1]
+            position += 1
+
+    def _word_prefix(self, query):
+        # a generator so the sort only happens if the name-prefix tier did
+        # not fill the page; kept until the next write like _teaching
+        ordered = self._ordered_words.get(query)
+        if ordered is None:
+            if len(self._ordered_words) >= 256:
+                self._ordered_words.clear()
+            ordered = self._ordered_words[query] = self._in_name_order(set(self._prefix(self.sorted_words, query)))
+        yield from ordered
+
+    def _search_teaching(self, query, course_number, limit):
+        # Both fields: the name grams intersected with the professors
+        # teaching the course. A page or less of them is ranked outright;
+        # more, and the tiers are walked as in search(), the last one over
+        # the course's professors in name order, which fills the page soon.
+        postings = candidates(self.name_postings, query)
+        if not postings:
+            return []
+        ids = postings[0].intersection(self._teaching(course_number), *postings[1:])
+        if len(query) > GRAM_SIZE:
+            ids = {prof_id for prof_id in ids if query in self.lower_names[prof_id]}
+        if limit and len(ids) > limit:
+            tiers = [self._prefix(self.sorted_names, query), self._word_prefix(query),
+                     self._teaching_in_order(course_number)]
+        else:
+            order = self._name_order()
+
+            def rank(prof_id):
+                lower = self.lower_names[prof_id]
+                if lower.startswith(query):
+                    tier = 0
+                elif any(word.startswith(query) for word in lower.split()):
+                    tier = 1
+                else:
+                    tier = 2
+                return tier, order[prof_id]
+
+            tiers = [sorted(ids, key=rank)]
+
+        found = []
+        seen = set()
+        for tier in tiers:
+            for prof_id in tier:
+                if prof_id not in seen and prof_id in ids:
+                    seen.add(prof_id)
+                    found.append((prof_id, self.names[prof_id]))
+                    if limit and len(found) >= limit:
+                        return found
+        return found
+
+    def search(self, professor=None, course_number=None, limit=SEARCH_RESULT_LIMIT):
+        professor = (professor or '').strip().lower()
+        course_number = (course_number or '').strip().lower()
+        with self._lock:
+            # like the SQL join, only professors that teach a course qualify
+            eligible = self._teaching(course_number) if course_number else self.course_numbers
+            if professor and course_number:
+                return self._search_teaching(professor, course_number, limit)
+            if professor:
+                # Ranked in tiers: whole name starts with the query, then a
+                # word in the name does, then the query appears anywhere. Each
+                # tier is in name order, so the walk stops once the page is full.
+                tiers = [
+                    self._prefix(self.sorted_names, professor),
+                    self._word_prefix(professor),
+                    self._name_contains(professor),
+                ]
+            elif course_number:
+                tiers = [self._teaching_in_order(course_number)]
+            else:
+                tiers = [(prof_id for _, prof_id in self.sorted_names)]
+
+            found = []
+            seen = set()
+            for tier in tiers:
+                for prof_id in tier:
+                    if prof_id not in seen and prof_id in eligible:
+                        seen.add(prof_id)
+                        found.append((prof_id, self.names[prof_id]))
+                        if limit and len(found) >= limit:
+                            return found
+            return found
+
+    def build(self, engine):
+        index = SearchIndex()
+        if catalog.ready:
+            # the same rows without another pass over both tables
+            catalog.refresh(engine)
+            professors = [(professor.ProfessorID, professor.Name) for professor in list(catalog.professors.values())]
+            courses = [(course.ProfessorID, course.CourseNumber) for course in list(catalog.courses.values())]
+        else:
+            with engine.connect() as conn:
+                professors = conn.execute(text('SELECT ProfessorID, Name FROM Professors')).fetchall()
+                courses = conn.execute(text('SELECT ProfessorID, CourseNumber FROM Courses')).fetchall()
+        for prof_id, name in professors:
+            name = name or ''
+            index.names[prof_id] = name
+            index.lower_names[prof_id] = name.lower()
+        for prof_id, course_number in courses:
+            if prof_id in index.names:
+                course_number = (course_number or '').lower()
+                index.course_numbers.setdefault(prof_id, set()).add(course_number)
+                index.course_professors.setdefault(course_number, set()).add(prof_id)
+
+        for prof_id, lower in index.lower_names.items():
+            post(index.name_postings, lower, prof_id)
+            index.sorted_words.extend((word, prof_id) for word in set(lower.split()))
+        for course_number in index.course_professors:
+            post(index.course_postings, course_number, course_number)
+        index.sorted_names = sorted((lower, prof_id) for prof_id, lower in index.lower_names.items())
+        index.sorted_words.sort()
+
+        with self._lock:
+            for attribute in ('names', 'lower_names', 'course_numbers', 'course_professors', 'name_postings',
+                              'course_postings', 'sorted_names', 'sorted_words'):
+                setattr(self, attribute, getattr(index, attribute))
+            self._changed()
+            self.built_at = time.monotonic()
+
+    def build_in_background(self, engine):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def run():
+            try:
+                self.build(engine)
+            except Exception as e:
+                print("Error building search index:", e)
+            finally:
+                self._building = False
+
+        threading.Thread(target=run, name='search-index-build', daemon=True).start()
+
+
+def tokenize(value):
+    return [word for word in TOKEN.findall((value or '').lower()) if word not in STOPWORDS]
+
+
+class CommentIndex:
+    def __init__(self):
+        # term -> (CommentIDs in ascending order, term frequency in each,
+        # then per block the highest frequency and lowest length / frequency)
+        self.postings = {}
+        # indexed by CommentID: the number of terms, and whether it is live
+        self.lengths = array('I')
+        self.live = bytearray()
+        self.documents = 0
+        self.total_length = 0
+        self.deleted = 0
+        self.last_id = 0
+        self.built_at = None
+        self.refreshed_at = None
+        self.reconciled_at = None
+        self._results = {}
+        self._lock = threading.RLock()
+        self._building = False
+
+    @property
+    def ready(self):
+        return self.built_at is not None
+
+    @property
+    def stale(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > COMMENT_INDEX_REFRESH
+
+    @property
+    def unreconciled(self):
+        return self.reconciled_at is None or time.monotonic() - self.reconciled_at > COMMENT_INDEX_RECONCILE
+
+    @property
+    def needs_rebuild(self):
+        return self.deleted > COMMENT_INDEX_MAX_DELETED * max(self.documents, 1)
+
+    def _grow(self, comment_id):
+        if comment_id >= len(self.live):
+            extra = max(comment_id + 1, len(self.live) * 2) - len(self.live)
+            self.live.extend(bytes(extra))
+            self.lengths.extend(array('I', bytes(extra * self.lengths.itemsize)))
+
+    def add(self, comment_id, content):
+        terms = tokenize(content)
+        with self._lock:
+            self._grow(comment_id)
+            if self.live[comment_id]:
+                return
+            length = self.lengths[comment_id] = len(terms)
+            for term, count in Counter(terms).items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array('I'), array('H'), array('H'), array('d'))
+                ids, frequencies, block_frequencies, block_ratios = posting
+                if count > 65535:
+                    count = 65535
+                if ids and ids[-1] > comment_id:
+                    position = bisect.bisect_left(ids, comment_id)
+                    ids.insert(position, comment_id)
+                    frequencies.insert(position, count)
+                    # every block from here on shifts by one
+                    del block_frequencies[position // BM25_BLOCK:], block_ratios[position // BM25_BLOCK:]
+                    for start in range(len(block_frequencies) * BM25_BLOCK, len(ids), BM25_BLOCK):
+                        block = zip(ids[start:start + BM25_BLOCK], frequencies[start:start + BM25_BLOCK])
+                        block_frequencies.append(max(frequencies[start:start + BM25_BLOCK]))
+                        block_ratios.append(min(self.lengths[i] / tf for i, tf in block))
+                elif len(ids) % BM25_BLOCK:
+                    ids.append(comment_id)
+                    frequencies.append(count)
+                    if count > block_frequencies[-1]:
+                        block_frequencies[-1] = count
+                    if length / count < block_ratios[-1]:
+                        block_ratios[-1] = length / count
+                else:
+                    ids.append(comment_id)
+                    frequencies.append(count)
+                    block_frequencies.append(count)
+                    block_ratios.append(length / count)
+            self.live[comment_id] = 1
+            self.documents += 1
+            self.total_length += len(terms)
+            self.last_id = max(self.last_id, comment_id)
+            self._results = {}
+
+    def remove(self, comment_id):
+        with self._lock:
+            if comment_id < len(self.live) and self.live[comment_id]:
+                self.live[comment_id] = 0
+                self.documents -= 1
+                self.total_length -= self.lengths[comment_id]
+                self.deleted += 1
+                self._results = {}
+
+    def _idf(self, posting):
+        # deleted comments are still in the postings, so they count towards
+        # the collection size as well
+        total = self.documents + self.deleted
+        return math.log(1 + (total - len(posting[0]) + 0.5) / (len(posting[0]) + 0.5))
+
+    def _score(self, scores, idf, posting, average, candidates_only):
+        top = idf * (BM25_K1 + 1)
+        base = BM25_K1 * (1 - BM25_B)
+        scale = BM25_K1 * BM25_B / average
+        live, lengths = self.live, self.lengths
+        ids, frequencies = posting[:2]
+        if candidates_only and len(scores) * 20 < len(ids):
+            for comment_id in list(scores):
+                position = bisect.bisect_left(ids, comment_id)
+                if position < len(ids) and ids[position] == comment_id:
+                    tf = frequencies[position]
+                    scores[comment_id] += top * tf / (tf + base + scale * lengths[comment_id])
+        elif candidates_only:
+            for comment_id, tf in zip(ids, frequencies):
+                if comment_id in scores:
+                    scores[comment_id] += top * tf / (tf + base + scale * lengths[comment_id])
+        else:
+            get = scores.get
+            for comment_id, tf in zip(ids, frequencies):
+                if live[comment_id]:
+                    scores[comment_id] = get(comment_id, 0.0) + top * tf / (tf + base + scale * lengths[comment_id])
+
+    def _score_blocks(self, scores, idf, posting, average, limit, rest):
+        # the first term, a block at a time from the block with the highest
+        # possible score, until even that plus every other term matching is
+        # below the top `limit` found so far. A comment in a block left out
+        # may still be scored by the other terms, but could not have made
+        # the results anyway.
+        top = idf * (BM25_K1 + 1)
+        base = BM25_K1 * (1 - BM25_B)
+        scale = BM25_K1 * BM25_B / average
+        live, lengths = self.live, self.lengths
+        ids, frequencies, block_frequencies, block_ratios = posting
+        # tf / (tf + base + scale * length) = 1 / (1 + base / tf + scale * length / tf)
+        bounds = sorted(((top / (1 + base / most + scale * ratio), block) for block, (most, ratio)
+                         in enumerate(zip(block_frequencies, block_ratios))), reverse=True)
+        best = []
+        for bound, block in bounds:
+            if len(best) == limit and bound + rest < best[0]:
+                break
+            start = block * BM25_BLOCK
+            for comment_id, tf in zip(ids[start:start + BM25_BLOCK], frequencies[start:start + BM25_BLOCK]):
+                if live[comment_id]:
+                    score = scores[comment_id] = top * tf / (tf + base + scale * lengths[comment_id])
+                    if len(best) < limit:
+                        heapq.heappush(best, score)
+                    elif score > best[0]:
+                        heapq.heapreplace(best, score)
+
+    def _rank(self, terms, limit):
+        # BM25 with MaxScore pruning: terms go in order of the most they can
+        # add to a score, and once the terms left could not lift an unseen
+        # comment into the top `limit`, they only add to comments already found
+        weighted = sorted(((self._idf(self.postings[term]), self.postings[term])
+                           for term in terms if term in self.postings), key=lambda item: -item[0])
+        if not weighted or not self.documents:
+            return []
+        average = self.total_length / self.documents or 1
+        remaining = [idf * (BM25_K1 + 1) for idf, _ in weighted]
+        for position in range(len(remaining) - 2, -1, -1):
+            remaining[position] += remaining[position + 1]
+        remaining.append(0.0)
+        scores = {}
+        self._score_blocks(scores, weighted[0][0], weighted[0][1], average, limit, remaining[1])
+        for position, (idf, posting) in enumerate(weighted[1:], 1):
+            candidates_only = False
+            if len(scores) >= limit:
+                candidates_only = remaining[position] <= heapq.nlargest(limit, scores.values())[-1]
+            self._score(scores, idf, posting, average, candidates_only)
+        # ties go to the newer comment
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+
+    def search(self, query, limit=COMMENT_RESULT_LIMIT):
+        terms = tuple(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            # common queries are answered again until the next write
+            found = self._results.get((terms, limit))
+            if found is None:
+                if len(self._results) >= 256:
+                    self._results = {}
+                found = self._results[(terms, limit)] = self._rank(terms, limit)
+            return found
+
+    def build(self, engine):
+        index = CommentIndex()
+        with engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True, yield_per=10000).execute(text('''
+                SELECT CommentID, Content FROM Comments ORDER BY CommentID
+            '''))
+            for comment_id, content in rows:
+                index.add(comment_id, content)
+
+        with self._lock:
+            for attribute in ('postings', 'lengths', 'live', 'documents', 'total_length', 'deleted', 'last_id'):
+                setattr(self, attribute, getattr(index, attribute))
+            self._results = {}
+            self.built_at = self.refreshed_at = self.reconciled_at = time.monotonic()
+        # comments written while the build ran
+        self.refresh(engine)
+
+    def reconcile(self, engine):
+        # Comments are only dropped if they were indexed before the IDs were
+        # read, so one a refresh adds meanwhile is not taken for deleted.
+        indexed = bytes(self.live)
+        present = bytearray(len(indexed))
+        missing = []
+        with engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True, yield_per=10000).execute(text('''
+                SELECT CommentID FROM Comments
+            '''))
+            for comment_id, in rows:
+                if comment_id < len(present):
+                    present[comment_id] = 1
+                    if not indexed[comment_id]:
+                        missing.append(comment_id)
+                elif comment_id >= len(self.live) or not self.live[comment_id]:
+                    missing.append(comment_id)
+            for start in range(0, len(missing), 1000):
+                for comment_id, content in conn.execute(text('''
+                    SELECT CommentID, Content FROM Comments WHERE CommentID IN :ids
+                ''').bindparams(bindparam('ids', expanding=True)), {'ids': missing[start:start + 1000]}):
+                    self.add(comment_id, content)
+        for comment_id, live in enumerate(indexed):
+            if live and not present[comment_id]:
+                self.remove(comment_id)
+        self.reconciled_at = time.monotonic()
+
+    def _in_background(self, task, engine, name):
+        # one build or reconcile at a time
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def run():
+            try:
+                task(engine)
+            except Exception as e:
+                print("Error in {}:".format(name), e)
+            finally:
+                self._building = False
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+    def build_in_background(self, engine):
+        self._in_background(self.build, engine, 'comment-index-build')
+
+    def maintain(self, engine):
+        # run before a search: picks up other workers' new comments, drops
+        # the ones they deleted, and rebuilds once enough are deleted
+        if self.needs_rebuild:
+            self.build_in_background(engine)
+        elif self.ready and self.unreconciled:
+            self._in_background(self.reconcile, engine, 'comment-index-reconcile')
+        if self.ready and self.stale:
+            try:
+                self.refresh(engine)
+            except Exception as e:
+                print("Error refreshing comment index:", e)
+
+    def refresh(self, engine):
+        after = max(self.last_id - COMMENT_REFRESH_LOOKBACK, 0)
+        with engine.connect() as conn:
+            ids = [row[0] for row in conn.execute(text('''
+                SELECT CommentID FROM Comments WHERE CommentID > :after
+            '''), {'after': after})]
+            missing = [comment_id for comment_id in ids if comment_id >= len(self.live) or not self.live[comment_id]]
+            if missing:
+                rows = conn.execute(text('''
+                    SELECT CommentID, Content FROM Comments WHERE CommentID IN :ids ORDER BY CommentID
+                ''').bindparams(bindparam('ids', expanding=True)), {'ids': missing}).fetchall()
+                for comment_id, content in rows:
+                    self.add(comment_id, content)
+        self.refreshed_at = time.monotonic()
+
+
+def snippet(content, terms, words=SNIPPET_WORDS):
+    # the stretch of `words` words with the most distinct query terms, as
+    # escaped HTML with the matches in <mark>
+    content = content or ''
+    tokens = list(TOKEN.finditer(content))
+    wanted = set(terms)
+    hits = [position for position, token in enumerate(tokens) if token.group().lower() in wanted][:50]
+    start = 0
+    if hits and len(tokens) > words:
+        best = max(hits, key=lambda first: len({tokens[position].group().lower() for position in hits
+                                                 if first <= position < first + words}))
+        # a couple of words of context before the first match
+        start = max(0, min(best - 2, len(tokens) - words))
+    window = tokens[start:start + words]
+    begin = window[0].start() if window and start else 0
+    end = window[-1].end() if window and start + words < len(tokens) else len(content)
+    parts = [Markup('&hellip;') if begin else Markup('')]
+    position = begin
+    for token in window:
+        if token.group().lower() in wanted:
+            parts.append(escape(content[position:token.start()]))
+            parts.append(Markup('<mark>{}</mark>').format(token.group()))
+            position = token.end()
+    parts.append(escape(content[position:end]))
+    if end < len(content):
+        parts.append(Markup('&hellip;'))
+    return Markup('').join(parts)
+
+
+COMMENT_HITS_QUERY = text('''
+    SELECT com.CommentID, com.Content, c.CourseID, c.CourseNumber, c.Title, p.ProfessorID, p.Name AS ProfessorName
+    FROM Comments com
+    JOIN Courses c ON c.CourseID = com.CourseID
+    JOIN Professors p ON p.ProfessorID = c.ProfessorID
+    WHERE com.CommentID IN :ids
+''').bindparams(bindparam('ids', expanding=True))
+
+
+def sql_comment_search(conn, query, limit=COMMENT_RESULT_LIMIT):
+    # every term as a substring, newest first: the fallback until the index is built
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+    sql = '''
+        SELECT com.CommentID, com.Content, c.CourseID, c.CourseNumber, c.Title, p.ProfessorID,
+            p.Name AS ProfessorName
+        FROM Comments com
+        JOIN Courses c ON c.CourseID = com.CourseID
+        JOIN Professors p ON p.ProfessorID = c.ProfessorID
+        WHERE 1=1
+    '''
+    params = {'limit': limit}
+    for position, term in enumerate(terms):
+        sql += " AND com.Content LIKE :term{} ESCAPE '{}'".format(position, LIKE_ESCAPE)
+        params['term{}'.format(position)] = like_pattern(term)
+    sql += ' ORDER BY com.CommentID DESC LIMIT :limit'
+    return [(row, None) for row in conn.execute(text(sql), params)]
+
+
+def search_comments(engine, query, limit=COMMENT_RESULT_LIMIT):
+    # ranked hits with their course and professor. engine is where the
+    # comments are read from; the index itself follows the primary.
+    if comment_index.ready:
+        ranked = comment_index.search(query, limit)
+        if not ranked:
+            return []
+        with engine.connect() as conn:
+            rows = {row.CommentID: row for row in conn.execute(COMMENT_HITS_QUERY, {'ids': [i for i, _ in ranked]})}
+        # a comment deleted by another worker is still in this one's index
+        hits = [(rows[comment_id], score) for comment_id, score in ranked if comment_id in rows]
+    else:
+        with engine.connect() as conn:
+            hits = sql_comment_search(conn, query, limit)
+    terms = tokenize(query)
+    return [dict(row._mapping, Score=score, Snippet=snippet(row.Content, terms)) for row, score in hits]
+
+
+def like_pattern(value):
+    value = value.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace('%', LIKE_ESCAPE + '%').replace('_', LIKE_ESCAPE + '_')
+    return '%' + value + '%'
+
+
+def sql_search(conn, professor=None, course_number=None, limit=SEARCH_RESULT_LIMIT):
+    query = '''
+        SELECT DISTINCT p.ProfessorID, p.Name as ProfessorName
+        FROM Professors p
+        JOIN Courses c ON p.ProfessorID = c.ProfessorID
+        WHERE 1=1
+    '''
+    params = {'limit': limit}
+    if professor:
+        query += " AND p.Name LIKE :professor ESCAPE '{}'".format(LIKE_ESCAPE)
+        params['professor'] = like_pattern(professor.strip())
+    if course_number:
+        query += " AND c.CourseNumber LIKE :course_number ESCAPE '{}'".format(LIKE_ESCAPE)
+        params['course_number'] = like_pattern(course_number.strip())
+    query += ' ORDER BY p.Name, p.ProfessorID LIMIT :limit'
+    return [tuple(row) for row in conn.execute(text(query), params)]
+
+
+search_index = SearchIndex()
+comment_index = CommentIndex()
@@ -0,0 +1,171 @@
+from sqlalchemy import text
+
+from db import get_engine
+
+# CourseStats, ProfessorStats and DepartmentStats are kept current by
+# triggers (schema migrations 4, 8, 9 and 12). These recompute them from
+# Ratings and Comments: rebuild() replaces the tables to correct drift,
+# check() reports where they disagree. Both scan every rating and comment,
+# so run them from a scheduled job rather than a request:
+#
+#     flask --app app rebuild-stats
+#     flask --app app check-stats
+
+# SQL's own aggregates, which leave out a rating without a score; check()
+# holds the triggers to AverageScore rather than to their own sums
+RATINGS_BY_COURSE = '''
+    SELECT CourseID, SUM(Score) AS RatingSum, COUNT(Score) AS RatingCount, AVG(Score) AS AverageScore
+    FROM Ratings
+    GROUP BY CourseID
+'''
+
+COMMENTS_BY_COURSE = '''
+    SELECT CourseID, COUNT(*) AS CommentCount
+    FROM Comments
+    GROUP BY CourseID
+'''
+
+RECOMPUTE_COURSES = '''
+    SELECT
+        c.CourseID,
+        COALESCE(com.CommentCount, 0) AS CommentCount,
+        COALESCE(r.RatingSum, 0) AS RatingSum,
+        COALESCE(r.RatingCount, 0) AS RatingCount,
+        r.AverageScore
+    FROM Courses c
+    LEFT JOIN ({ratings}) AS r ON r.CourseID = c.CourseID
+    LEFT JOIN ({comments}) AS com ON com.CourseID = c.CourseID
+'''.format(ratings=RATINGS_BY_COURSE, comments=COMMENTS_BY_COURSE)
+
+# a professor's score is the mean of their course averages; a course whose
+# ratings have no score has no average and is not one of the rated courses
+RECOMPUTE_PROFESSORS = '''
+    SELECT
+        p.ProfessorID,
+        COALESCE(SUM(r.RatingSum), 0) AS RatingSum,
+        COALESCE(SUM(r.RatingCount), 0) AS RatingCount,
+        COUNT(r.AverageScore) AS RatedCourses,
+        COALESCE(SUM(r.AverageScore), 0) AS CourseAverageSum,
+        AVG(r.AverageScore) AS AverageScore
+    FROM Professors p
+    LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+    LEFT JOIN ({ratings}) AS r ON r.CourseID = c.CourseID
+    GROUP BY p.ProfessorID
+'''.format(ratings=RATINGS_BY_COURSE)
+
+RECOMPUTE_DEPARTMENTS = '''
+    SELECT
+        COALESCE(p.Department, '') AS Department,
+        COALESCE(SUM(com.CommentCount), 0) AS CommentCount,
+        COALESCE(SUM(r.RatingSum), 0) AS RatingSum,
+        COALESCE(SUM(r.RatingCount), 0) AS RatingCount
+    FROM Professors p
+    LEFT JOIN Courses c ON c.ProfessorID = p.ProfessorID
+    LEFT JOIN ({ratings}) AS r ON r.CourseID = c.CourseID
+    LEFT JOIN ({comments}) AS com ON com.CourseID = c.CourseID
+    GROUP BY COALESCE(p.Department, '')
+'''.format(ratings=RATINGS_BY_COURSE, comments=COMMENTS_BY_COURSE)
+
+# RatingSum is DECIMAL(14, 2) on MySQL and REAL on SQLite
+TOLERANCE = 0.005
+
+
+def rebuild(engine=None):
+    engine = engine or get_engine()
+    # one transaction: readers see the old totals until it commits, and
+    # rating and comment writes wait for it instead of being lost
+    with engine.begin() as conn:
+        conn.execute(text('DELETE FROM CourseStats'))
+        courses = conn.execute(text('''
+            INSERT INTO CourseStats (CourseID, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT CourseID, CommentCount, RatingSum, RatingCount,
+                CASE WHEN RatingCount > 0 THEN RatingSum * 1.0 / RatingCount END
+            FROM ({}) AS totals
+        '''.format(RECOMPUTE_COURSES))).rowcount
+        conn.execute(text('''
+            UPDATE Courses
+            SET AverageRating = (SELECT ROUND(s.AverageRating, 2) FROM CourseStats s WHERE s.CourseID = Courses.CourseID)
+        '''))
+        conn.execute(text('DELETE FROM ProfessorStats'))
+        professors = conn.execute(text('''
+            INSERT INTO ProfessorStats (ProfessorID, RatingSum, RatingCount, RatedCourses, CourseAverageSum, AverageScore)
+            SELECT ProfessorID, RatingSum, RatingCount, RatedCourses, CourseAverageSum,
+                CASE WHEN RatedCourses > 0 THEN CourseAverageSum / RatedCourses END
+            FROM ({}) AS totals
+        '''.format(RECOMPUTE_PROFESSORS))).rowcount
+        conn.execute(text('DELETE FROM DepartmentStats'))
+        departments = conn.execute(text('''
+            INSERT INTO DepartmentStats (Department, CommentCount, RatingSum, RatingCount, AverageRating)
+            SELECT Department, CommentCount, RatingSum, RatingCount,
+                CASE WHEN RatingCount > 0 THEN RatingSum * 1.0 / RatingCount END
+            FROM ({}) AS totals
+        '''.format(RECOMPUTE_DEPARTMENTS))).rowcount
+    return {'courses': courses, 'professors': professors, 'departments': departments}
+
+
+def average(total, count):
+    return float(total) / count if count else None
+
+
+def differs(have, want):
+    if have is None or want is None:
+        return (have is None) != (want is None)
+    return abs(float(have) - float(want)) > TOLERANCE
+
+
+def compare(table, expected, stored, counts, amounts, averages):
+    # expected and stored map a key to a row; averages maps each stored
+    # average column to a function of the expected row
+    problems = []
+    for key in sorted(set(expected) | set(stored)):
+        want = expected.get(key)
+        have = stored.get(key)
+        if have is None:
+            problems.append("{} has no row for {}".format(table, key))
+            continue
+        if want is None:
+            # e.g. a department whose last professor moved away keeps an empty row
+            if any(getattr(have, column) for column in counts) or any(
+                    differs(getattr(have, column), 0) for column in amounts):
+                problems.append("{} has totals for {}, which no longer exists".format(table, key))
+            continue
+        for column in counts:
+            if getattr(have, column) != getattr(want, column):
+                problems.append("{} {}: {} is {}, expected {}".format(
+                    table, key, column, getattr(have, column), getattr(want, column)))
+        for column in amounts:
+            if differs(getattr(have, column), getattr(want, column)):
+                problems.append("{} {}: {} is {}, expected {}".format(
+                    table, key, column, getattr(have, column), getattr(want, column)))
+        for column, expected_average in averages.items():
+            if differs(getattr(have, column), expected_average(want)):
+                problems.append("{} {}: {} is {}, expected {}".format(
+                    table, key, column, getattr(have, column), expected_average(want)))
+    return problems
+
+
+def check(engine=None):
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        def rows(query, key):
+            return {getattr(row, key): row for row in conn.execute(text(query))}
+
+        courses = rows(RECOMPUTE_COURSES, 'CourseID'), rows('''
+            SELECT CourseID, CommentCount, RatingSum, RatingCount, AverageRating FROM CourseStats
+        ''', 'CourseID')
+        professors = rows(RECOMPUTE_PROFESSORS, 'ProfessorID'), rows('''
+            SELECT ProfessorID, RatingSum, RatingCount, RatedCourses, CourseAverageSum, AverageScore FROM ProfessorStats
+        ''', 'ProfessorID')
+        departments = rows(RECOMPUTE_DEPARTMENTS, 'Department'), rows('''
+            SELECT Department, CommentCount, RatingSum, RatingCount, AverageRating FROM DepartmentStats
+        ''', 'Department')
+
+    return (
+        compare('CourseStats', *courses, counts=('CommentCount', 'RatingCount'), amounts=('RatingSum',),
+                averages={'AverageRating': lambda row: row.AverageScore}) +
+        compare('ProfessorStats', *professors, counts=('RatingCount', 'RatedCourses'),
+                amounts=('RatingSum', 'CourseAverageSum'),
+                averages={'AverageScore': lambda row: row.AverageScore}) +
+        compare('DepartmentStats', *departments, counts=('CommentCount', 'RatingCount'), amounts=('RatingSum',),
+                averages={'AverageRating': lambda row: average(row.RatingSum, row.RatingCount)})
+    )
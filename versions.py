@@ -0,0 +1,165 @@
+import hashlib
+import os
+import time
+
+from flask import Response, g, has_request_context, make_response, request
+from sqlalchemy import bindparam, exc, text
+
+import replicas
+from cache import cached as read_through, get_cache
+from db import get_engine
+
+# Version counters behind ETags. Every write bumps the scopes it touched in
+# its own short autocommit statement, after the write itself committed, so
+# no write transaction holds these rows locked.
+LEADERBOARDS = 'leaderboards'
+
+# Versions are also cached for VERSION_TTL seconds, so a revalidation that
+# ends in a 304 reads neither the database nor a template. A bump drops the
+# cached version at once in its own process (in every process with the
+# shared cache backend); other workers see it within VERSION_TTL.
+VERSION_TTL = float(os.environ.get('VERSION_TTL', 1))
+# part of every ETag and fragment key, so a deploy that changes the markup
+# does not answer 304 for pages rendered by the previous release
+RELEASE = os.environ.get('RELEASE', os.environ.get('GAE_VERSION', ''))
+
+
+def professor_scope(prof_id):
+    return 'professor:{}'.format(prof_id)
+
+
+def version_key(scope):
+    return 'version:' + scope
+
+
+def bump(*scopes):
+    now = time.time()
+    with get_engine().connect() as conn:
+        for scope in scopes:
+            updated = conn.execute(text('''
+                UPDATE DataVersions SET Version = Version + 1, UpdatedAt = :now WHERE Scope = :scope
+            '''), {'scope': scope, 'now': now}).rowcount
+            if not updated:
+                try:
+                    conn.execute(text('''
+                        INSERT INTO DataVersions (Scope, Version, UpdatedAt) VALUES (:scope, 1, :now)
+                    '''), {'scope': scope, 'now': now})
+                except exc.IntegrityError:
+                    # another worker created the row first
+                    conn.rollback()
+                    conn.execute(text('''
+                        UPDATE DataVersions SET Version = Version + 1, UpdatedAt = :now WHERE Scope = :scope
+                    '''), {'scope': scope, 'now': now})
+            conn.commit()
+    get_cache().delete(*[version_key(scope) for scope in scopes])
+
+
+CURRENT_QUERY = text('''
+    SELECT Scope, Version, UpdatedAt FROM DataVersions WHERE Scope IN :scopes
+''').bindparams(bindparam('scopes', expanding=True))
+
+
+def current(conn, *scopes):
+    rows = conn.execute(CURRENT_QUERY, {'scopes': list(scopes)})
+    found = {row.Scope: (row.Version, row.UpdatedAt) for row in rows}
+    return [found.get(scope, (0, None)) for scope in scopes]
+
+
+def etag(versions, *parts):
+    digest = hashlib.sha1()
+    for version, _ in versions:
+        digest.update(str(version).encode('utf-8'))
+        digest.update(b'/')
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'/')
+    return digest.hexdigest()
+
+
+def lookup(*scopes):
+    # cached versions, None where there is none
+    cache = get_cache()
+    return [cache.get(version_key(scope)) for scope in scopes]
+
+
+def remember(scopes, found):
+    cache = get_cache()
+    for scope, version in zip(scopes, found):
+        cache.set(version_key(scope), tuple(version), VERSION_TTL)
+
+
+def cached_current(*scopes):
+    # a client that just wrote skips the cache, which may hold a version
+    # read from a replica that has not seen the write yet
+    found = [None] * len(scopes) if replicas.reading_own_writes() else lookup(*scopes)
+    missing = [scope for scope, version in zip(scopes, found) if version is None]
+    if missing:
+        fresh = dict(zip(missing, read_engine_versions(*missing)))
+        remember(missing, [fresh[scope] for scope in missing])
+        found = [fresh[scope] if version is None else version for scope, version in zip(scopes, found)]
+    return found
+
+
+def read_engine_versions(*scopes):
+    # as the engine this request reads has them, queried once per request
+    known = g.setdefault('engine_versions', {}) if has_request_context() else {}
+    missing = [scope for scope in scopes if scope not in known]
+    if missing:
+        with replicas.read_engine().connect() as conn:
+            known.update(zip(missing, current(conn, *missing)))
+    return [known[scope] for scope in scopes]
+
+
+def read(*scopes):
+    # Versions no newer than any row this request reads after them. A cached
+    # version is never ahead of the primary, so it will do for a request
+    # that reads the primary; a replica can be behind it, so a request that
+    # reads one asks the replica.
+    if replicas.read_engine() is get_engine():
+        return cached_current(*scopes)
+    return read_engine_versions(*scopes)
+
+
+def cached(scope, key, loader, ttl=None):
+    # cache.cached() with the key under the scope's version, read before the
+    # loader runs. A write bumps the version after it commits, so rows a
+    # loader read before the write (or from a replica that is behind) are
+    # stored under the old version and never served as the new one, even
+    # when the set lands after the write's invalidation.
+    return read_through('{}:v{}'.format(key, read(scope)[0][0]), loader, ttl)
+
+
+def not_modified(tag, if_none_match):
+    return bool(if_none_match) and if_none_match.contains(tag)
+
+
+def conditional(scopes, page):
+    # A 304 needs only the cached versions. A page that is rendered is
+    # tagged with the versions its data is cached under (read()), which are
+    # no newer than its rows; a cached version can be ahead of a replica.
+    # There is no Last-Modified: HTTP dates have whole seconds, so a page
+    # from between two writes in the same second would get a 304 after the
+    # second one.
+    found = cached_current(*scopes)
+    tag = etag(found, RELEASE, request.full_path)
+    if not_modified(tag, request.if_none_match):
+        response = Response(status=304)
+    else:
+        found = read(*scopes)
+        tag = etag(found, RELEASE, request.full_path)
+        g.data_versions = dict(zip(scopes, found))
+        response = make_response(page())
+        if response.status_code != 200:
+            return response
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def fragment_key(scope, *parts):
+    # None outside a conditional() response: the fragment is rendered
+    # without caching
+    found = g.get('data_versions', {}).get(scope) if g else None
+    if found is None:
+        return None
+    return ':'.join([scope, 'fragment', str(found[0]), RELEASE] + [str(part) for part in parts])
@@ -0,0 +1,350 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from sqlalchemy import bindparam, exc, text
+
+from db import get_engine
+
+# With WRITE_BEHIND on, ratings and reviews are acknowledged once they are in
+# a local SQLite journal (synced to disk) and a background thread writes them
+# to the database in batches. Off, the same code applies each one inline.
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0').lower() not in ('0', 'false', 'no')
+WRITE_BEHIND_PATH = os.environ.get('WRITE_BEHIND_PATH', os.path.join('instance', 'write_behind.db'))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.2))
+# a batch claimed by a worker that died is picked up again after this long
+WRITE_BEHIND_LEASE = float(os.environ.get('WRITE_BEHIND_LEASE', 60))
+APPLIED_RETENTION = 7 * 24 * 3600
+MIN_COMMENT_LENGTH = 10
+MIN_SCORE = 1
+MAX_SCORE = 5
+
+RATING = 'rating'
+REVIEW = 'review'
+
+APPLIED = 'applied'
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+REPLAYED = 'replayed'
+
+FIELDS = ('token', 'kind', 'course_id', 'user_id', 'professor_id', 'score', 'would_take_again', 'comment')
+
+
+def valid_score(score):
+    # the stats triggers skip a rating without a score, so none is accepted
+    return score is not None and MIN_SCORE <= score <= MAX_SCORE
+
+
+def rating(course_id, score, professor_id=None, user_id=0):
+    return {'token': None, 'kind': RATING, 'course_id': course_id, 'user_id': user_id,
+            'professor_id': professor_id, 'score': score, 'would_take_again': None, 'comment': None}
+
+
+def review(user_id, course_id, score, would_take_again, comment, professor_id=None):
+    return {'token': None, 'kind': REVIEW, 'course_id': course_id, 'user_id': user_id,
+            'professor_id': professor_id, 'score': score, 'would_take_again': would_take_again, 'comment': comment}
+
+
+# A user has reviewed a course once they have both a rating and a comment on
+# it, which is when the Reviews key (schema migration 13) is there.
+ALREADY_REVIEWED = '''
+    SELECT 1 FROM Reviews WHERE UserID = :user_id AND CourseID = :course_id
+'''
+
+# Inserted before the review's rating and comment. The primary key is the
+# check: of two transactions inserting the same key, the second waits for
+# the first and fails once it commits.
+INSERT_REVIEW_KEY = text('''
+    INSERT INTO Reviews (UserID, CourseID) VALUES (:user_id, :course_id)
+''')
+
+INSERT_RATING = text('''
+    INSERT INTO Ratings (Score, WouldTakeAgain, CourseID, UserID)
+    VALUES (:score, :would_take_again, :course_id, :user_id)
+''')
+
+INSERT_COMMENT = text('''
+    INSERT INTO Comments (Content, CourseID, UserID) VALUES (:comment, :course_id, :user_id)
+''')
+
+APPLIED_TOKENS = text('''
+    SELECT Token FROM WriteBehindApplied WHERE Token IN :tokens
+''').bindparams(bindparam('tokens', expanding=True))
+
+
+def already_reviewed(conn, user_id, course_id):
+    return conn.execute(text(ALREADY_REVIEWED), {'user_id': user_id, 'course_id': course_id}).first() is not None
+
+
+def add_review_key(conn, write):
+    # False if the user has reviewed the course. A failed insert undoes
+    # only itself, on MySQL and SQLite, so the rest of the batch goes on.
+    try:
+        conn.execute(INSERT_REVIEW_KEY, write)
+    except exc.IntegrityError as e:
+        # Reviews has no constraint but its key: MySQL's duplicate key
+        # error, or SQLite naming the table
+        if getattr(e.orig, 'args', (None,))[0] == 1062 or 'failed: Reviews.' in str(e.orig):
+            return False
+        raise
+    return True
+
+
+def apply_writes(conn, writes):
+    # Journal tokens make a batch safe to apply twice: a worker that dies
+    # between the database commit and clearing its journal rows replays
+    # them, and the ones already applied are skipped.
+    tokens = [write['token'] for write in writes if write['token']]
+    done = set()
+    for start in range(0, len(tokens), 500):
+        done.update(row[0] for row in conn.execute(APPLIED_TOKENS, {'tokens': tokens[start:start + 500]}))
+
+    results = []
+    ratings = []
+    for write in writes:
+        if write['token'] in done:
+            results.append(REPLAYED)
+        elif write['kind'] == RATING:
+            ratings.append(write)
+            results.append(APPLIED)
+        elif add_review_key(conn, write):
+            conn.execute(INSERT_RATING, write)
+            conn.execute(INSERT_COMMENT, write)
+            results.append(APPLIED)
+        else:
+            results.append(DUPLICATE)
+    if ratings:
+        conn.execute(INSERT_RATING, ratings)
+
+    now = time.time()
+    new_tokens = [{'token': token, 'now': now} for token in tokens if token not in done]
+    if new_tokens:
+        conn.execute(text('INSERT INTO WriteBehindApplied (Token, AppliedAt) VALUES (:token, :now)'), new_tokens)
+    return results
+
+
+class QueueStats:
+    def __init__(self):
+        self.enqueued = 0
+        self.applied = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failures = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class WriteQueue:
+    def __init__(self, path=WRITE_BEHIND_PATH, batch_size=WRITE_BEHIND_BATCH_SIZE, interval=WRITE_BEHIND_INTERVAL,
+                 lease=WRITE_BEHIND_LEASE):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self.stats = QueueStats()
+        self.on_flush = None
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._since_flush = 0
+        self._pruned_at = 0
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS pending (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                token TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                course_id INTEGER NOT NULL,
+                user_id INTEGER,
+                professor_id TEXT,
+                score REAL,
+                would_take_again INTEGER,
+                comment TEXT,
+                claimed_at REAL
+            )
+        ''')
+        # one pending review per user and course, on top of the database check
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_review ON pending (user_id, course_id) WHERE kind = 'review'
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # the submission is acknowledged as soon as this insert returns
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, write):
+        write = dict(write, token=str(uuid.uuid4()))
+        try:
+            self._connect().execute(
+                'INSERT INTO pending ({}) VALUES ({})'.format(', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+                [write[field] for field in FIELDS])
+        except sqlite3.IntegrityError as e:
+            # only idx_pending_review means a duplicate; any other constraint
+            # is a bad write
+            if str(e) != 'UNIQUE constraint failed: pending.user_id, pending.course_id':
+                raise
+            return DUPLICATE
+        self.stats.enqueued += 1
+        self._since_flush += 1
+        if self._since_flush >= self.batch_size:
+            self._wake.set()
+        return QUEUED
+
+    def pending(self):
+        return self._connect().execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('''
+                SELECT id, {} FROM pending
+                WHERE claimed_at IS NULL OR claimed_at < ?
+                ORDER BY id LIMIT ?
+            '''.format(', '.join(FIELDS)), (now - self.lease, self.batch_size)).fetchall()
+            conn.executemany('UPDATE pending SET claimed_at = ? WHERE id = ?', [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [row[0] for row in rows], [dict(zip(FIELDS, row[1:])) for row in rows]
+
+    def _finish(self, ids):
+        self._connect().executemany('DELETE FROM pending WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def _release(self, ids):
+        self._connect().executemany('UPDATE pending SET claimed_at = NULL WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def _apply_one_by_one(self, engine, ids, writes):
+        # Only reached when a whole batch failed. Rows the database rejects
+        # (a course deleted since, bad data) are dropped so they cannot block
+        # the queue; a connection problem stops here and retries the rest.
+        results = []
+        for position, (row_id, write) in enumerate(zip(ids, writes)):
+            try:
+                with engine.begin() as conn:
+                    results.extend(apply_writes(conn, [write]))
+            except (exc.OperationalError, exc.InterfaceError):
+                self._finish(ids[:position])
+                self._release(ids[position:])
+                if self.on_flush:
+                    self.on_flush([write for write, result in zip(writes, results) if result == APPLIED])
+                raise
+            except exc.DBAPIError as e:
+                print("Error: dropping queued {} for course {}:".format(write['kind'], write['course_id']), e)
+                self.stats.dropped += 1
+                results.append(None)
+        return results
+
+    def flush(self, engine=None):
+        engine = engine or get_engine()
+        self._since_flush = 0
+        ids, writes = self._claim()
+        if not writes:
+            return 0
+        try:
+            with engine.begin() as conn:
+                results = apply_writes(conn, writes)
+        except (exc.OperationalError, exc.InterfaceError):
+            self._release(ids)
+            raise
+        except exc.DBAPIError:
+            results = self._apply_one_by_one(engine, ids, writes)
+        self._finish(ids)
+
+        self.stats.batches += 1
+        self.stats.applied += results.count(APPLIED)
+        self.stats.duplicates += results.count(DUPLICATE)
+        if self.on_flush:
+            self.on_flush([write for write, result in zip(writes, results) if result == APPLIED])
+        if time.time() - self._pruned_at > 3600:
+            self._pruned_at = time.time()
+            with engine.begin() as conn:
+                conn.execute(text('DELETE FROM WriteBehindApplied WHERE AppliedAt < :cutoff'),
+                             {'cutoff': time.time() - APPLIED_RETENTION})
+        return len(writes)
+
+    def _run(self):
+        failures = 0
+        while not self._stopping:
+            self._wake.wait(self.interval if not failures else min(self.interval * 2 ** failures, 30))
+            self._wake.clear()
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+                failures = 0
+            except Exception as e:
+                failures += 1
+                self.stats.failures += 1
+                print("Error flushing write-behind queue:", e)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        # whatever is left stays in the journal for the next start
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+_queue = None
+_on_flush = None
+_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                _queue = WriteQueue()
+                _queue.on_flush = _on_flush
+    return _queue
+
+
+def start(on_flush=None):
+    global _on_flush
+    _on_flush = on_flush
+    if WRITE_BEHIND:
+        queue = get_queue()
+        queue.on_flush = on_flush
+        queue.start()
+
+
+def submit(write):
+    # Turns away a review that is already in the database before it is
+    # queued; apply_writes is what enforces it.
+    if write['kind'] == REVIEW:
+        with get_engine().connect() as conn:
+            if already_reviewed(conn, write['user_id'], write['course_id']):
+                return DUPLICATE
+    if WRITE_BEHIND:
+        return get_queue().enqueue(write)
+    with get_engine().begin() as conn:
+        result = apply_writes(conn, [write])[0]
+    if result == APPLIED and _on_flush:
+        _on_flush([write])
+    return result